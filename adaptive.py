@@ -0,0 +1,130 @@
+import collections
+import time
+
+import numpy as np
+
+
+class ResolutionController:
+    """
+    Chooses input resolution of the model to keep p95 latency under the SLO.
+    Latency of every request (and queue depth at that moment) is observed, p95 of the last `window` requests is compared
+    with the SLO: above it (or queue deeper than queue_high) the next smaller resolution is used, below up_ratio * SLO
+    (with queue not deeper than queue_low) the next bigger one. Hysteresis: after a switch the window starts empty,
+    next switch needs min_samples new requests and min_dwell seconds.
+    Args:
+        resolutions (list): input sizes (multiples of 32), the biggest is used first
+        slo (float): p95 latency target in seconds
+        window (int): requests of moving p95
+        up_ratio (float): p95 below up_ratio * slo switches up
+        queue_high, queue_low (int): queue depth which switches down / allows switching up, None ignores queue
+        min_samples (int), min_dwell (float): hysteresis
+    Metrics: resolution, p95, switches (list of events), requests per resolution
+    """
+    def __init__(self, resolutions=(608, 512, 416, 320), slo=0.2, window=100, up_ratio=0.6, queue_high=None, queue_low=0,
+                 min_samples=20, min_dwell=2.0):
+        self.resolutions = sorted(resolutions, reverse=True)
+        self.slo = slo
+        self.window = window
+        self.up_ratio = up_ratio
+        self.queue_high = queue_high
+        self.queue_low = queue_low
+        self.min_samples = min_samples
+        self.min_dwell = min_dwell
+
+        self.level = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.last_switch = time.perf_counter()
+        self.switches = []
+        self.requests = collections.Counter()
+
+    @property
+    def resolution(self):
+        return self.resolutions[self.level]
+
+    def p95(self):
+        return float(np.percentile(self.latencies, 95)) if self.latencies else 0.0
+
+    def observe(self, latency, queue_depth=0, resolution=None):
+        """
+        Latency (seconds) of a finished request and queue depth now. resolution is the one the request was served with,
+        requests served before the last switch do not count. Returns new resolution if it switched, else None
+        """
+        resolution = resolution or self.resolution
+        self.requests[resolution] += 1
+        if resolution != self.resolution:
+            return None
+        self.latencies.append(latency)
+
+        now = time.perf_counter()
+        if len(self.latencies) < self.min_samples or now - self.last_switch < self.min_dwell:
+            return None
+
+        p95 = self.p95()
+        overloaded = p95 > self.slo or (self.queue_high is not None and queue_depth > self.queue_high)
+        idle = p95 < self.up_ratio * self.slo and (self.queue_low is None or queue_depth <= self.queue_low)
+        if overloaded and self.level < len(self.resolutions) - 1:
+            return self.switch(self.level + 1, p95, queue_depth, now)
+        if idle and not overloaded and self.level > 0:
+            return self.switch(self.level - 1, p95, queue_depth, now)
+        return None
+
+    def switch(self, level, p95, queue_depth, now):
+        self.switches.append({"time" : now, "from" : self.resolution, "to" : self.resolutions[level], "p95_ms" : p95 * 1000, "queue_depth" : queue_depth})
+        self.level = level
+        self.latencies.clear()
+        self.last_switch = now
+        return self.resolution
+
+    def metrics(self):
+        return {
+            "resolution" : self.resolution,
+            "p95_ms" : self.p95() * 1000,
+            "slo_ms" : self.slo * 1000,
+            "switches" : len(self.switches),
+            "last_switches" : self.switches[-10:],
+            "requests_per_resolution" : dict(self.requests),
+        }
+
+
+if __name__ == "__main__":
+    import argparse
+    import asyncio
+    import cv2
+    import torch
+    from model import YOLOv4
+    from server import InferenceServer, load, request
+
+    parser = argparse.ArgumentParser(description="Synthetic load spike on the server with adaptive resolution: resolution and p95 of every phase")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[320, 256, 192, 128])
+    parser.add_argument("--slo", type=float, default=1.0, help="p95 latency target in seconds")
+    parser.add_argument("--phases", nargs="+", default=["1:20", "6:40", "1:30"], help="clients:seconds of load phases")
+    parser.add_argument("--max_batch", type=int, default=4)
+    parser.add_argument("--window", type=int, default=20)
+    parser.add_argument("--min_dwell", type=float, default=3.0)
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--weights", default=None)
+    args = parser.parse_args()
+
+    controller = ResolutionController(args.resolutions, slo=args.slo, window=args.window, min_samples=min(args.window, 10), min_dwell=args.min_dwell)
+    m = YOLOv4(weights_path=args.weights).eval().to("cuda" if torch.cuda.is_available() else "cpu")
+    server = InferenceServer(m, max_batch=args.max_batch, controller=controller)
+    body = cv2.imencode(".jpg", np.random.RandomState(0).randint(0, 255, (480, 640, 3), dtype=np.uint8))[1].tobytes()
+
+    async def main():
+        await server.start("127.0.0.1", args.port)
+        t_start = time.perf_counter()
+        print(f"SLO p95 {args.slo * 1000:.0f}ms")
+        for phase in args.phases:
+            clients, seconds = (int(v) for v in phase.split(":"))
+            switches_before = len(controller.switches)
+            rps, latencies, rejected = await load("127.0.0.1", args.port, body, concurrency=clients, duration=float(seconds))
+            p95 = np.percentile(latencies, 95) * 1000 if len(latencies) else float("nan")
+            events = ", ".join(f"{s['from']}->{s['to']} at {s['time'] - t_start:.0f}s" for s in controller.switches[switches_before:])
+            print(f"{clients} clients for {seconds}s: {rps:.1f} req/s, p95 {p95:.0f}ms, resolution now {controller.resolution}, switches: {events or 'none'}")
+        _, metrics, connection = await request("127.0.0.1", args.port, "GET", "/metrics")
+        connection[1].close()
+        await connection[1].wait_closed()
+        print("requests per resolution:", metrics["adaptive"]["requests_per_resolution"])
+        await server.stop()
+
+    asyncio.run(main())
@@ -0,0 +1,212 @@
+import glob
+import hashlib
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+import utils
+from dataloader import make_dataloader
+from detection_cache import weights_hash
+from letterbox import LetterboxBuffer
+
+IMG_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def list_images(source):
+    """
+    Image paths of a txt file with one path per line, or of a folder (recursively, sorted)
+    """
+    if os.path.isdir(source):
+        paths = [path for path in glob.glob(os.path.join(source, "**", "*"), recursive=True) if path.lower().endswith(IMG_EXTENSIONS)]
+        return sorted(paths)
+    with open(source, "r") as file:
+        return [path.rstrip() for path in file.read().splitlines() if path.strip()]
+
+
+class LetterboxedImages(Dataset):
+    """
+    Decodes images of given ids and letterboxes them to uint8 [3, img_size, img_size] (in dataloader workers).
+    Items are (image id, image, padding, original (width, height)), unreadable images have width and height 0.
+    """
+    def __init__(self, paths, ids, img_size):
+        self.paths = paths
+        self.ids = ids
+        self.img_size = img_size
+        self.buffer = None
+
+    def __getitem__(self, index):
+        image_id = self.ids[index]
+        if self.buffer is None:
+            self.buffer = LetterboxBuffer(1, self.img_size, dtype=torch.uint8)
+        img = cv2.imread(self.paths[image_id], cv2.IMREAD_COLOR)
+        if img is None:
+            return image_id, torch.zeros(3, self.img_size, self.img_size, dtype=torch.uint8), torch.tensor([0, 0, 1, 1.0]), torch.zeros(2)
+        padding = self.buffer.put(0, img).clone()
+        return image_id, self.buffer.batch(1)[0].clone(), padding, self.buffer.sizes[0].clone()
+
+    def __len__(self):
+        return len(self.ids)
+
+
+class ChunkWriter:
+    """
+    Detections of images are collected by chunk (chunk_size consecutive image ids) and every complete chunk is written
+    to chunk-<n>.npz (tmp file + rename, so a chunk file is always complete). Columns of a chunk:
+        image_ids [n], sizes [n, 2] (width, height, 0 for unreadable images), offsets [n + 1] (detections of image i are offsets[i]:offsets[i + 1]),
+        boxes [M, 4] float32 (x1, y1, x2, y2 in pixels of the image), scores [M] float32, classes [M] int16
+    """
+    def __init__(self, out_dir, n_images, chunk_size):
+        self.out_dir = out_dir
+        self.n_images = n_images
+        self.chunk_size = chunk_size
+        self.pending = {}
+
+    def chunk_path(self, chunk):
+        return os.path.join(self.out_dir, f"chunk-{chunk:06d}.npz")
+
+    def chunk_ids(self, chunk):
+        return range(chunk * self.chunk_size, min((chunk + 1) * self.chunk_size, self.n_images))
+
+    def n_chunks(self):
+        return (self.n_images + self.chunk_size - 1) // self.chunk_size
+
+    def done_chunks(self):
+        return {chunk for chunk in range(self.n_chunks()) if os.path.exists(self.chunk_path(chunk))}
+
+    def add(self, image_id, size, detections):
+        """
+        detections: [N, 6] x1, y1, x2, y2, score, class. Returns True if it completed a chunk
+        """
+        chunk = image_id // self.chunk_size
+        self.pending.setdefault(chunk, {})[image_id] = (size, detections)
+        if len(self.pending[chunk]) == len(self.chunk_ids(chunk)):
+            self.write(chunk)
+            return True
+        return False
+
+    def write(self, chunk):
+        results = self.pending.pop(chunk)
+        ids = sorted(results)
+        detections = [results[i][1] for i in ids]
+        offsets = np.concatenate([[0], np.cumsum([len(d) for d in detections])]).astype(np.int64)
+        detections = np.concatenate(detections) if detections else np.zeros((0, 6), dtype=np.float32)
+
+        tmp_path = self.chunk_path(chunk) + ".tmp.npz"
+        np.savez(tmp_path, image_ids=np.array(ids, dtype=np.int64), sizes=np.array([results[i][0] for i in ids], dtype=np.int32), offsets=offsets,
+                 boxes=detections[:, :4].astype(np.float32), scores=detections[:, 4].astype(np.float32), classes=detections[:, 5].astype(np.int16))
+        os.replace(tmp_path, self.chunk_path(chunk))
+
+
+def run_settings(paths, model, img_size, confidence_threshold, iou_threshold, chunk_size):
+    # Output of a job is reused only with the same images, weights and settings
+    return {
+        "images" : hashlib.sha1("\n".join(paths).encode()).hexdigest(),
+        "n_images" : len(paths),
+        "weights" : weights_hash(model)[:16],
+        "img_size" : img_size,
+        "confidence_threshold" : confidence_threshold,
+        "iou_threshold" : iou_threshold,
+        "chunk_size" : chunk_size,
+    }
+
+
+@torch.no_grad()
+def run(source, out_dir, model, img_size=608, batch_size=16, num_workers=4, chunk_size=10000, confidence_threshold=0.25, iou_threshold=0.5,
+        max_det=300, device=None, log_every=30.0):
+    """
+    Detections of all images of source (txt list or folder) into chunked .npz files of out_dir (see ChunkWriter).
+    out_dir also gets images.txt (image id is its line number) and meta.json with settings. Killed job started again
+    with the same arguments continues after the last complete chunk, with different ones it raises ValueError.
+    Returns dict with images done in this run and images per second.
+    """
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = model.to(device).eval()
+
+    paths = list_images(source)
+    os.makedirs(out_dir, exist_ok=True)
+    settings = run_settings(paths, model, img_size, confidence_threshold, iou_threshold, chunk_size)
+
+    meta_path = os.path.join(out_dir, "meta.json")
+    if os.path.exists(meta_path):
+        with open(meta_path) as file:
+            previous = json.load(file)
+        if previous != settings:
+            changed = [k for k in settings if previous.get(k) != settings[k]]
+            raise ValueError(f"{out_dir} has results of a job with different {', '.join(changed)}, use another out_dir")
+    else:
+        with open(os.path.join(out_dir, "images.txt"), "w") as file:
+            file.write("\n".join(paths))
+        with open(meta_path, "w") as file:
+            json.dump(settings, file)
+
+    writer = ChunkWriter(out_dir, len(paths), chunk_size)
+    done = writer.done_chunks()
+    ids = [i for chunk in range(writer.n_chunks()) if chunk not in done for i in writer.chunk_ids(chunk)]
+    print(f"{len(paths)} images, {len(done)} of {writer.n_chunks()} chunks done, {len(ids)} images to go")
+    if not ids:
+        return {"images" : 0, "images_per_s" : 0.0}
+
+    ds = LetterboxedImages(paths, ids, img_size)
+    dl = make_dataloader(ds, batch_size=batch_size, num_workers=num_workers, shuffle=False)
+
+    n = 0
+    t0 = t_log = time.time()
+    for image_ids, images, padding, sizes in dl:
+        anchors, _ = model(images.to(device, non_blocking=True))
+        for image_id, detections, pad, size in zip(image_ids.tolist(), utils.non_max_suppression(anchors, confidence_threshold, iou_threshold, max_det), padding, sizes):
+            detections = utils.unletterbox(detections.cpu(), pad, size.tolist()) if size[0] > 0 else detections.new_zeros(0, 6)
+            writer.add(image_id, size.tolist(), detections.numpy())
+        n += len(image_ids)
+
+        if time.time() - t_log > log_every:
+            t_log = time.time()
+            speed = n / (t_log - t0)
+            print(f"{n}/{len(ids)} images, {speed:.1f} img/s, {(len(ids) - n) / speed / 60:.1f} min left")
+
+    elapsed = time.time() - t0
+    return {"images" : n, "images_per_s" : n / elapsed}
+
+
+def read_detections(out_dir):
+    """
+    All complete chunks of out_dir concatenated: dict of image_ids, paths, sizes, offsets and boxes, scores, classes (see ChunkWriter)
+    """
+    with open(os.path.join(out_dir, "images.txt")) as file:
+        paths = file.read().split("\n")
+    chunks = [np.load(path) for path in sorted(glob.glob(os.path.join(out_dir, "chunk-*.npz"))) if not path.endswith(".tmp.npz")]
+    if not chunks:
+        return None
+    result = {key : np.concatenate([c[key] for c in chunks]) for key in ("image_ids", "sizes", "boxes", "scores", "classes")}
+    counts = np.concatenate([np.diff(c["offsets"]) for c in chunks])
+    result["offsets"] = np.concatenate([[0], np.cumsum(counts)])
+    result["paths"] = [paths[i] for i in result["image_ids"]]
+    return result
+
+
+if __name__ == "__main__":
+    import argparse
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Resumable batch inference over a list or folder of images into chunked .npz detections")
+    parser.add_argument("source", help="txt file with image paths or folder with images")
+    parser.add_argument("out_dir")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--n_classes", type=int, default=80)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--bs", type=int, default=16)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--chunk_size", type=int, default=10000, help="images per output file and per checkpoint")
+    parser.add_argument("--conf", type=float, default=0.25)
+    parser.add_argument("--iou", type=float, default=0.5)
+    parser.add_argument("--max_det", type=int, default=300)
+    args = parser.parse_args()
+
+    model = YOLOv4(n_classes=args.n_classes, weights_path=args.weights, img_dim=args.img_size)
+    stats = run(args.source, args.out_dir, model, args.img_size, args.bs, args.workers, args.chunk_size, args.conf, args.iou, args.max_det)
+    print(f"{stats['images']} images, {stats['images_per_s']:.1f} img/s")
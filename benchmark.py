@@ -0,0 +1,483 @@
+"""
+Benchmarks of the data pipeline on synthetic data.
+    python benchmark.py labels --n 2000
+    python benchmark.py images --n 200
+    python benchmark.py jitter --bs 16
+    python benchmark.py mosaic --bs 16 64
+    python benchmark.py uint8 --workers 2
+    python benchmark.py rect --n 32 --img_size 416
+    python benchmark.py shards --n 1000
+    python benchmark.py decode --n 20
+    python benchmark.py letterbox --bs 16
+Every subcommand creates its synthetic dataset in --root (images/ and labels/ folders + train.txt) if it does not exist.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+
+def make_synthetic_dataset(root, n, width=1280, height=720, max_boxes=8, seed=0):
+    """
+    Random JPEGs with random YOLO labels, returns path of train.txt
+    """
+    list_path = os.path.join(root, f"train_{n}_{width}x{height}.txt")
+    if os.path.exists(list_path):
+        return list_path
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(os.path.join(root, "images"), exist_ok=True)
+    os.makedirs(os.path.join(root, "labels"), exist_ok=True)
+
+    paths = []
+    for i in range(n):
+        name = f"{width}x{height}_{i:06d}"
+        img_path = os.path.join(root, "images", name + ".JPG")
+        if not os.path.exists(img_path):
+            #SMOOTH NOISE, SO JPEG SIZE IS CLOSE TO PHOTO
+            small = rng.integers(0, 255, (height // 16 + 1, width // 16 + 1, 3), dtype=np.uint8)
+            Image.fromarray(small).resize((width, height), Image.BILINEAR).save(img_path, quality=90)
+
+        n_boxes = rng.integers(1, max_boxes + 1)
+        wh = rng.uniform(0.05, 0.4, (n_boxes, 2))
+        xy = rng.uniform(wh / 2, 1 - wh / 2)
+        cls = rng.integers(0, 80, (n_boxes, 1))
+        np.savetxt(os.path.join(root, "labels", name + ".txt"), np.concatenate([cls, xy, wh], 1), fmt=["%d", "%.6f", "%.6f", "%.6f", "%.6f"])
+        paths.append(img_path)
+
+    with open(list_path, "w") as file:
+        file.write("\n".join(paths) + "\n")
+    return list_path
+
+
+def bench_labels(args):
+    from dataset import ListDataset
+
+    list_path = make_synthetic_dataset(args.root, args.n, 64, 64)
+
+    ds = ListDataset(list_path)
+    t0 = time.time()
+    indexed_ds = ListDataset(list_path, label_index=os.path.join(args.root, "label_index"))
+    build_time = time.time() - t0
+
+    def run(d):
+        order = np.random.default_rng(0).integers(0, len(d), args.samples)
+        t0 = time.time()
+        for index in order:
+            d.load_boxes(index)
+        return (time.time() - t0) / args.samples * 1e6
+
+    print(f"Label index build/validation: {build_time:.2f}s for {len(ds)} files")
+    print(f"Label loading per sample: text files {run(ds):.1f}us, packed index {run(indexed_ds):.1f}us (mosaic loads 4 per sample)")
+
+
+def bench_image_cache(args):
+    from dataset import ListDataset
+
+    list_path = make_synthetic_dataset(args.root, args.n, args.width, args.height)
+
+    t0 = time.time()
+    cached_ds = ListDataset(list_path, img_size=args.img_size, train=args.train, image_cache=os.path.join(args.root, f"image_cache_{args.img_size}"))
+    build_time = time.time() - t0
+    ds = ListDataset(list_path, img_size=args.img_size, train=args.train)
+
+    def run(d):
+        t0 = time.time()
+        for i in range(args.samples):
+            d[i % len(d)]
+        return args.samples / (time.time() - t0)
+
+    print(f"Image cache build/validation: {build_time:.2f}s for {len(ds)} images")
+    print(f"Samples per second ({'mosaic' if args.train else 'letterbox'}): decoding files {run(ds):.1f}, image cache {run(cached_ds):.1f}")
+
+
+def bench_jitter(args):
+    import random
+    import torch
+    import torchvision.transforms as transforms
+    import augmentations
+    from dataset import ListDataset
+
+    ds = ListDataset.__new__(ListDataset)
+    ds.profiler = None
+    rng = np.random.default_rng(0)
+    pil_imgs = [Image.fromarray(rng.integers(0, 255, (args.img_size * 9 // 16, args.img_size, 3), dtype=np.uint8)) for _ in range(args.bs)]
+
+    def jitter_params():
+        return (random.uniform(0.75, 1.25), random.uniform(0.75, 1.25), random.uniform(-0.05, 0.05), random.uniform(0.75, 1.25))
+
+    t0 = time.time()
+    for _ in range(args.repeats):
+        tensors = [transforms.functional.to_tensor(ds.apply_jitter(img, jitter_params())) for img in pil_imgs]
+    pil_time = (time.time() - t0) / args.repeats
+
+    batch = torch.stack(tensors)
+    print(f"Batch {args.bs}, {tuple(batch.shape[2:])} images")
+    print(f"PIL, 4 passes per image: {pil_time * 1000:.1f}ms per batch (mosaic jitters 4 tiles per sample: ~{pil_time * 4000:.1f}ms)")
+
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for device in devices:
+        for dtype in (torch.float32, torch.uint8):
+            x = batch.to(device)
+            x = (x * 255).to(torch.uint8) if dtype == torch.uint8 else x
+            params = augmentations.sample_jitter_params(args.bs, device=device)
+            augmentations.color_jitter(x, **params)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.time()
+            for _ in range(args.repeats):
+                augmentations.color_jitter(x, **augmentations.sample_jitter_params(args.bs, device=device))
+            if device == "cuda":
+                torch.cuda.synchronize()
+            print(f"Batched tensor jitter ({device}, {str(dtype).split('.')[-1]}): {(time.time() - t0) / args.repeats * 1000:.1f}ms per batch")
+
+
+def bench_mosaic(args):
+    import random
+    import torch
+    from dataset import ListDataset
+
+    ds = ListDataset.__new__(ListDataset)
+    ds.train, ds.batch_jitter, ds.uint8, ds.profiler = True, False, False, None
+    ds.cross_offset, ds.bbox_minsize = 0.2, 0.01
+
+    #ALREADY LOADED TILES (16:9, 4:3 AND PORTRAIT) WITH 8 BOXES EACH, SO ONLY CONVERSION TO TENSOR AND ASSEMBLY ARE TIMED
+    shapes = [(args.img_size, args.img_size * 9 // 16), (args.img_size, args.img_size * 3 // 4), (args.img_size * 3 // 4, args.img_size)]
+    rng = np.random.default_rng(0)
+    g = torch.Generator().manual_seed(0)
+
+    def sample():
+        tiles = [Image.fromarray(rng.integers(0, 255, (h, w, 3), dtype=np.uint8)) for w, h in random.choices(shapes, k=4)]
+        boxes = [torch.cat([torch.randint(0, 80, (8, 1), generator=g).double(), torch.rand(8, 2, generator=g).double() * 0.6 + 0.2, torch.rand(8, 2, generator=g).double() * 0.3 + 0.05], 1) for _ in range(4)]
+        targets = torch.cat([torch.cat([torch.full((8, 1), float(n)), b.float()], 1) for n, b in enumerate(boxes)])
+        return tiles, boxes, targets
+
+    for bs in args.bs:
+        batch = [sample() for _ in range(bs)]
+
+        ds.batch_mosaic = False
+        t0 = time.time()
+        for _ in range(args.repeats):
+            torch.stack([ds.assemble_mosaic([ds.image_to_tensor(tile) for tile in tiles], boxes, args.img_size)[0] for tiles, boxes, _ in batch])
+        per_sample = (time.time() - t0) / args.repeats
+
+        ds.batch_mosaic = True
+        t0 = time.time()
+        for _ in range(args.repeats):
+            ds.mosaic_collate_fn([("", [ds.image_to_tensor(tile) for tile in tiles], targets) for tiles, _, targets in batch])
+        batched = (time.time() - t0) / args.repeats
+
+        print(f"Batch {bs}: per-sample mosaic + stack {per_sample * 1000:.1f}ms, batch mosaic in collate {batched * 1000:.1f}ms ({per_sample / batched:.2f}x)")
+
+
+class _ConstantBatches:
+    """
+    Dataset of ready batches, so DataLoader time is only worker -> main process transfer
+    """
+    def __init__(self, batch, n):
+        self.batch = batch
+        self.n = n
+
+    def __getitem__(self, index):
+        return self.batch.clone()
+
+    def __len__(self):
+        return self.n
+
+
+def bench_uint8(args):
+    import torch
+    from torch.utils.data import DataLoader
+    from dataset import ListDataset
+
+    def run(dl):
+        it = iter(dl)
+        next(it) #Workers start
+        t0 = time.time()
+        n_imgs = n_bytes = 0
+        for batch in it:
+            imgs = batch[1] if isinstance(batch, (tuple, list)) else batch
+            n_imgs += len(imgs)
+            n_bytes += imgs.numel() * imgs.element_size()
+        elapsed = time.time() - t0
+        return n_imgs / elapsed, n_bytes / elapsed / 2**20
+
+    #IPC ONLY
+    for dtype in (torch.float32, torch.uint8):
+        batch = torch.zeros(args.bs, 3, args.img_size, args.img_size, dtype=dtype)
+        dl = DataLoader(_ConstantBatches(batch, args.batches + 1), batch_size=None, num_workers=args.workers)
+        img_s, mb_s = run(dl)
+        print(f"IPC, {str(dtype).split('.')[-1]} batches {batch.numel() * batch.element_size() / 2**20:.1f}MB: {img_s:.1f} img/s, {mb_s:.0f} MB/s")
+
+    #LOADER WITH IMAGE CACHE, SO DECODING DOES NOT HIDE THE DIFFERENCE
+    list_path = make_synthetic_dataset(args.root, args.n, args.width, args.height)
+    cache = os.path.join(args.root, f"image_cache_{args.img_size}")
+    for uint8 in (False, True):
+        ds = ListDataset(list_path, img_size=args.img_size, train=bool(args.train), image_cache=cache, batch_mosaic=bool(args.train), uint8=uint8)
+        dl = DataLoader(ds, batch_size=args.bs, shuffle=True, num_workers=args.workers, collate_fn=ds.collate_fn)
+        img_s, mb_s = run(dl)
+        print(f"ListDataset ({'mosaic' if args.train else 'letterbox'}, {'uint8' if uint8 else 'float32'}): {img_s:.1f} img/s, {mb_s:.0f} MB/s of images")
+
+
+def bench_rect(args):
+    import torch
+    import utils
+    from torch.utils.data import DataLoader
+    from dataset import ListDataset
+    from model import YOLOv4
+    from multiscale import AspectRatioBatchSampler
+
+    list_path = make_synthetic_dataset(args.root, args.n, args.width, args.height)
+    ds = ListDataset(list_path, img_size=args.img_size, train=False)
+    model = YOLOv4(n_classes=80, img_dim=args.img_size).eval()
+
+    def run(dl):
+        pixels = 0
+        t0 = time.time()
+        with torch.no_grad():
+            for batch in dl:
+                imgs = batch[1]
+                y_hat, _ = model(imgs)
+                utils.non_max_suppression(y_hat, 0.001, 0.6)
+                pixels += imgs.shape[0] * imgs.shape[2] * imgs.shape[3]
+        return time.time() - t0, pixels
+
+    square_time, square_pixels = run(DataLoader(ds, batch_size=args.bs, collate_fn=ds.collate_fn))
+    rect_time, rect_pixels = run(DataLoader(ds, batch_sampler=AspectRatioBatchSampler(ds, args.bs), collate_fn=ds.collate_fn))
+
+    content = args.n * args.img_size * int(args.img_size * min(args.width, args.height) / max(args.width, args.height))
+    print(f"{args.n} images {args.width}x{args.height}, img_size {args.img_size}, batch {args.bs}")
+    print(f"Square letterbox: {square_time:.2f}s, padding {1 - content / square_pixels:.0%} of pixels")
+    print(f"Aspect ratio buckets: {rect_time:.2f}s, padding {1 - content / rect_pixels:.0%} of pixels ({square_time / rect_time:.2f}x faster)")
+
+
+def bench_shards(args):
+    import shutil
+    from dataset import ListDataset
+    from shards import ShardDataset, write_shards, read_shard
+
+    list_path = make_synthetic_dataset(args.root, args.n, args.width, args.height)
+    shards_dir = os.path.join(args.root, f"shards_{args.n}_{args.width}x{args.height}")
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    t0 = time.time()
+    write_shards(list_path, shards_dir, args.samples_per_shard)
+    print(f"Conversion: {time.time() - t0:.2f}s for {args.n} samples")
+
+    ds = ListDataset(list_path, img_size=args.img_size, train=False)
+    order = np.random.default_rng(0).permutation(len(ds))
+    shard_ds = ShardDataset(shards_dir, shuffle_buffer=args.shuffle_buffer, img_size=args.img_size, train=False)
+
+    def evict():
+        # Drops files from page cache, so reads go to the disk as on a cold network filesystem
+        if not args.cold:
+            return
+        for path in ds.img_files + ds.label_files + shard_ds.shards:
+            if os.path.exists(path):
+                fd = os.open(path, os.O_RDONLY)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+                os.close(fd)
+
+    #RAW READS
+    evict()
+    t0 = time.time()
+    n_bytes = 0
+    for i in order:
+        with open(ds.img_files[i], "rb") as file:
+            n_bytes += len(file.read())
+        if os.path.exists(ds.label_files[i]):
+            with open(ds.label_files[i], "rb") as file:
+                n_bytes += len(file.read())
+    random_time = time.time() - t0
+
+    evict()
+    t0 = time.time()
+    for shard in shard_ds.shards:
+        for _ in read_shard(shard):
+            pass
+    shard_time = time.time() - t0
+    print(f"Reading files: random access {args.n / random_time:.0f} samples/s ({n_bytes / random_time / 2**20:.0f} MB/s), shards {args.n / shard_time:.0f} samples/s")
+
+    #FULL SAMPLES (LETTERBOX)
+    evict()
+    t0 = time.time()
+    for i in order:
+        ds[i]
+    random_time = time.time() - t0
+
+    evict()
+    t0 = time.time()
+    for _ in shard_ds:
+        pass
+    shard_time = time.time() - t0
+    print(f"Samples (decode + letterbox): random access {args.n / random_time:.1f}/s, shards with shuffle buffer {args.shuffle_buffer} {args.n / shard_time:.1f}/s")
+    if not args.cold:
+        print("Files were read from page cache, use --cold 1 to evict them before every pass")
+
+
+def bench_decode(args):
+    import torch
+    from dataset import ListDataset
+
+    list_path = make_synthetic_dataset(args.root, args.n, args.width, args.height)
+    ds = ListDataset(list_path, img_size=args.img_size, train=False)
+    draft_ds = ListDataset(list_path, img_size=args.img_size, train=False, jpeg_draft=True)
+
+    def run(d):
+        t0 = time.time()
+        imgs = [d.load_image(i, args.img_size)[0] for i in range(len(d))]
+        return (time.time() - t0) / len(d), imgs
+
+    full_time, full_imgs = run(ds)
+    draft_time, draft_imgs = run(draft_ds)
+
+    assert all(a.size == b.size for a, b in zip(full_imgs, draft_imgs)), "Resized sizes differ"
+    assert all(torch.equal(ds[i][2], draft_ds[i][2]) for i in range(len(ds))), "Boxes differ"
+    diff = np.mean([np.abs(np.asarray(a, dtype=np.float32) - np.asarray(b, dtype=np.float32)).mean() for a, b in zip(full_imgs, draft_imgs)])
+
+    print(f"{args.width}x{args.height} JPEG -> {full_imgs[0].size[0]}x{full_imgs[0].size[1]}")
+    print(f"Full decode + resize: {full_time * 1000:.1f}ms, draft decode + resize: {draft_time * 1000:.1f}ms ({full_time / draft_time:.2f}x faster)")
+    print(f"Mean absolute pixel difference: {diff:.2f} (0-255), boxes are the same")
+
+
+def bench_letterbox(args):
+    import cv2
+    import torch
+    from letterbox import LetterboxBuffer, letterbox_reference
+    from utils import xyxy2xywh
+
+    rng = np.random.default_rng(0)
+    # Landscape and portrait camera frames
+    frames = [rng.integers(0, 255, (args.height, args.width, 3), dtype=np.uint8) if i % 2 == 0 else
+              rng.integers(0, 255, (args.width, args.height, 3), dtype=np.uint8) for i in range(args.bs)]
+
+    def stretch():
+        # As video_demo.py used to do it
+        xs = []
+        for frame in frames:
+            sized = cv2.resize(frame, (args.img_size, args.img_size))
+            sized = cv2.cvtColor(sized, cv2.COLOR_BGR2RGB)
+            x = torch.from_numpy(sized)
+            x = x.permute(2, 0, 1)
+            x = x.float()
+            x /= 255
+            xs.append(x)
+        return torch.stack(xs)
+
+    def reference():
+        return torch.stack([letterbox_reference(frame, args.img_size) for frame in frames])
+
+    buffers = {dtype : LetterboxBuffer(args.bs, args.img_size, dtype=dtype, pin_memory=True) for dtype in (torch.float32, torch.uint8)}
+
+    def fused(dtype):
+        def run():
+            for i, frame in enumerate(frames):
+                buffers[dtype].put(i, frame)
+            return buffers[dtype].batch()
+        return run
+
+    def timeit(fn):
+        fn()
+        t0 = time.time()
+        for _ in range(args.repeats):
+            fn()
+        return (time.time() - t0) / args.repeats
+
+    diff = (fused(torch.float32)() - reference()).abs().max().item()
+    assert diff < 1e-6, f"LetterboxBuffer differs from step by step letterbox by {diff}"
+
+    #BOXES GO BACK TO PIXELS OF THE FRAME
+    buffer = buffers[torch.float32]
+    h, w = frames[1].shape[:2]
+    box = torch.tensor([[0.25 * w, 0.5 * h, 0.75 * w, 0.75 * h]])
+    pad_x, pad_y, t_w, t_h = buffer.padding[1].tolist()
+    canvas = torch.cat([(box[:, 0::2] * t_w / w + pad_x), (box[:, 1::2] * t_h / h + pad_y)], 1)[:, [0, 2, 1, 3]]
+    back = buffer.unletterbox(1, torch.cat([xyxy2xywh(canvas), torch.ones(1, 1)], 1))
+    assert torch.allclose(back[:, :4], box, atol=1e-3), f"unletterbox {back} != {box}"
+
+    base = timeit(stretch)
+    print(f"{args.bs} frames {args.width}x{args.height} -> {args.img_size}x{args.img_size} batch, ms per batch:")
+    print(f"video_demo.py stretch resize + cvtColor + permute + float + /255 + stack: {base * 1000:.1f}")
+    for name, fn in [("step by step letterbox + stack", reference), ("LetterboxBuffer float32", fused(torch.float32)), ("LetterboxBuffer uint8", fused(torch.uint8))]:
+        t = timeit(fn)
+        print(f"{name}: {t * 1000:.1f} ({base / t:.2f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--root", default="synthetic_dataset")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = subparsers.add_parser("labels", help="label loading: text files vs packed index")
+    p.add_argument("--n", type=int, default=2000)
+    p.add_argument("--samples", type=int, default=5000)
+    p.set_defaults(func=bench_labels)
+
+    p = subparsers.add_parser("images", help="samples per second: decoding JPEGs vs pre-resized image cache")
+    p.add_argument("--n", type=int, default=200)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--img_size", type=int, default=608)
+    p.add_argument("--samples", type=int, default=100)
+    p.add_argument("--train", type=int, default=1, help="1 for mosaic, 0 for letterbox")
+    p.set_defaults(func=bench_image_cache)
+
+    p = subparsers.add_parser("jitter", help="colour jitter per batch: PIL passes vs batched tensor ops")
+    p.add_argument("--bs", type=int, default=16)
+    p.add_argument("--img_size", type=int, default=608)
+    p.add_argument("--repeats", type=int, default=5)
+    p.set_defaults(func=bench_jitter)
+
+    p = subparsers.add_parser("mosaic", help="mosaic assembly: per sample in __getitem__ vs whole batch in collate")
+    p.add_argument("--bs", type=int, nargs="+", default=[16, 64])
+    p.add_argument("--img_size", type=int, default=608)
+    p.add_argument("--repeats", type=int, default=5)
+    p.set_defaults(func=bench_mosaic)
+
+    p = subparsers.add_parser("uint8", help="worker -> main process transfer and loader throughput: float32 vs uint8 batches")
+    p.add_argument("--n", type=int, default=200)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--img_size", type=int, default=608)
+    p.add_argument("--bs", type=int, default=16)
+    p.add_argument("--batches", type=int, default=50)
+    p.add_argument("--workers", type=int, default=2)
+    p.add_argument("--train", type=int, default=0, help="1 for mosaic, 0 for letterbox")
+    p.set_defaults(func=bench_uint8)
+
+    p = subparsers.add_parser("rect", help="validation epoch time: square letterbox vs aspect ratio buckets")
+    p.add_argument("--n", type=int, default=32)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--img_size", type=int, default=416)
+    p.add_argument("--bs", type=int, default=8)
+    p.set_defaults(func=bench_rect)
+
+    p = subparsers.add_parser("shards", help="reading samples: random access files vs sequential tar shards")
+    p.add_argument("--n", type=int, default=1000)
+    p.add_argument("--width", type=int, default=640)
+    p.add_argument("--height", type=int, default=480)
+    p.add_argument("--img_size", type=int, default=416)
+    p.add_argument("--samples_per_shard", type=int, default=250)
+    p.add_argument("--shuffle_buffer", type=int, default=200)
+    p.add_argument("--cold", type=int, default=1, help="1 evicts files from page cache before every pass (posix_fadvise)")
+    p.set_defaults(func=bench_shards)
+
+    p = subparsers.add_parser("decode", help="load_image time of big JPEGs: full decode vs reduced-scale (draft) decode")
+    p.add_argument("--n", type=int, default=20)
+    p.add_argument("--width", type=int, default=4000)
+    p.add_argument("--height", type=int, default=3000)
+    p.add_argument("--img_size", type=int, default=608)
+    p.set_defaults(func=bench_decode)
+
+    p = subparsers.add_parser("letterbox", help="inference preprocessing: step by step tensors vs letterbox into preallocated batch")
+    p.add_argument("--bs", type=int, default=16)
+    p.add_argument("--width", type=int, default=1920)
+    p.add_argument("--height", type=int, default=1080)
+    p.add_argument("--img_size", type=int, default=608)
+    p.add_argument("--repeats", type=int, default=20)
+    p.set_defaults(func=bench_letterbox)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,206 @@
+import itertools
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+import torch.multiprocessing as mp
+
+
+def available_cores():
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+
+
+def private_memory_mb(pid):
+    """
+    Memory used only by the process (private pages of /proc/<pid>/smaps_rollup) in MB, None where it is not available
+    """
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as file:
+            kb = sum(int(line.split()[1]) for line in file if line.startswith(("Private_Clean", "Private_Dirty")))
+        return kb / 1024
+    except OSError:
+        return None
+
+
+def _worker(model, cores, threads, inputs, outputs):
+    # Runs in its own process: model parameters are the shared memory of the parent, not a copy
+    if cores and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass
+    outputs.put(("ready", os.getpid(), None))
+
+    with torch.no_grad():
+        while True:
+            item = inputs.get()
+            if item is None:
+                break
+            job_id, x = item
+            try:
+                outputs.put((job_id, model(x)[0], None))
+            except Exception as e:
+                outputs.put((job_id, None, repr(e)))
+
+
+class CPUInferencePool:
+    """
+    K processes running YOLOv4 on CPU, every one pinned to its own cores with its own amount of intra-op threads.
+    Weights are put into shared memory once (model.share_memory()), workers map them instead of having K copies.
+    Batches go to the first free worker, submit returns Future of anchors (model output).
+    Args:
+        model: YOLOv4 (its parameters are moved to shared memory)
+        workers (int): processes
+        threads (int): intra-op threads of every worker, available cores // workers by default
+        pin (bool): pin every worker to its own `threads` cores
+    Usage:
+        with CPUInferencePool(m, workers=4, threads=4) as pool:
+            anchors = pool.submit(x).result()
+    """
+    def __init__(self, model, workers=2, threads=None, pin=True):
+        self.model = model.eval()
+        self.model.share_memory()
+        self.workers_n = workers
+        cores = available_cores()
+        self.threads = threads or max(1, len(cores) // workers)
+        if pin and workers * self.threads <= len(cores):
+            self.cores = [cores[i * self.threads:(i + 1) * self.threads] for i in range(workers)]
+        else:
+            self.cores = [None] * workers
+
+        self.processes = []
+        self.pids = []
+        self.futures = {}
+        self.job_ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def start(self):
+        ctx = mp.get_context("spawn")
+        self.inputs = ctx.Queue()
+        self.outputs = ctx.Queue()
+        self.processes = [ctx.Process(target=_worker, args=(self.model, cores, self.threads, self.inputs, self.outputs), daemon=True)
+                          for cores in self.cores]
+        for process in self.processes:
+            process.start()
+
+        self.pids = []
+        while len(self.pids) < self.workers_n:
+            try:
+                _, pid, _ = self.outputs.get(timeout=1)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    raise RuntimeError("Worker process died on start")
+                continue
+            self.pids.append(pid)
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+        return self
+
+    def collect(self):
+        while True:
+            job_id, out, error = self.outputs.get()
+            if job_id is None:
+                break
+            with self.lock:
+                future = self.futures.pop(job_id)
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(out)
+
+    def submit(self, x):
+        future = Future()
+        job_id = next(self.job_ids)
+        with self.lock:
+            self.futures[job_id] = future
+        self.inputs.put((job_id, x))
+        return future
+
+    def map(self, batches):
+        return [future.result() for future in [self.submit(x) for x in batches]]
+
+    def stop(self):
+        for _ in self.processes:
+            self.inputs.put(None)
+        for process in self.processes:
+            process.join()
+        self.outputs.put((None, None, None))
+        self.collector.join()
+        self.processes = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def memory(self):
+        """
+        Private memory of every worker in MB (the model is not in it, it is shared)
+        """
+        return [private_memory_mb(pid) for pid in self.pids]
+
+
+def throughput(pool, x, n_batches):
+    # Images per second with every worker busy, after one warm up batch per worker
+    pool.map([x] * pool.workers_n)
+    t0 = time.perf_counter()
+    pool.map([x] * n_batches)
+    return n_batches * len(x) / (time.perf_counter() - t0)
+
+
+def autotune(model, img_size=416, batch_size=1, n_batches=None, configs=None, verbose=True):
+    """
+    Measures images per second of every (workers, threads) configuration on the cores of this machine.
+    configs: list of (workers, threads), by default every power of 2 of workers with threads = cores // workers
+    Returns list of dicts (workers, threads, images_per_s, private_mb) sorted from the fastest
+    """
+    cores = len(available_cores())
+    if configs is None:
+        configs = [(k, max(1, cores // k)) for k in [2 ** i for i in range(cores.bit_length())] if k <= cores]
+    x = torch.rand(batch_size, 3, img_size, img_size)
+
+    results = []
+    for workers, threads in configs:
+        with CPUInferencePool(model, workers, threads) as pool:
+            ips = throughput(pool, x, n_batches or 4 * workers)
+            memory = pool.memory()
+        results.append({"workers" : workers, "threads" : threads, "images_per_s" : ips, "private_mb" : memory})
+        if verbose:
+            mb = f"{max(memory):.0f}" if all(m is not None for m in memory) else "?"
+            print(f"workers {workers:>3} x threads {threads:>3}: {ips:.2f} img/s, private memory of a worker {mb} MB (weights are shared, not in it)")
+    return sorted(results, key=lambda r: -r["images_per_s"])
+
+
+if __name__ == "__main__":
+    import argparse
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Auto tunes processes x intra-op threads of CPU inference with shared weights")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--img_size", type=int, default=416)
+    parser.add_argument("--bs", type=int, default=1)
+    parser.add_argument("--batches", type=int, default=None, help="batches per configuration, 4 per worker by default")
+    parser.add_argument("--configs", nargs="+", default=None, help="workers x threads, f.e. 1x8 2x4 4x2")
+    args = parser.parse_args()
+
+    m = YOLOv4(weights_path=args.weights)
+    weights_mb = sum(p.numel() * p.element_size() for p in m.state_dict().values()) / 2**20
+    configs = [tuple(int(v) for v in c.split("x")) for c in args.configs] if args.configs else None
+
+    print(f"{len(available_cores())} cores, weights {weights_mb:.0f} MB")
+    #WORKERS GIVE THE SAME OUTPUT AS THE MODEL IN THIS PROCESS
+    x = torch.rand(1, 3, 128, 128)
+    with torch.no_grad():
+        expected = m.eval()(x)[0]
+    with CPUInferencePool(m, workers=2, threads=1, pin=False) as pool:
+        assert all(torch.allclose(out, expected, atol=1e-4) for out in pool.map([x, x])), "Worker output differs"
+
+    best = autotune(m, args.img_size, args.bs, args.batches, configs)[0]
+    print(f"Best: {best['workers']} workers x {best['threads']} threads, {best['images_per_s']:.2f} img/s")
@@ -0,0 +1,118 @@
+import random
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+
+def seed_worker(worker_id):
+    """
+    worker_init_fn, which seeds random, numpy and torch of every worker with its own seed.
+    torch.initial_seed() inside worker is base seed of the DataLoader + worker id, base seed is drawn from DataLoader generator
+    every epoch, so mosaic crops and jitter differ between workers and epochs and are reproducible with fixed seed.
+    """
+    seed = torch.initial_seed() % 2**32
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def make_dataloader(dataset, batch_size=1, shuffle=False, collate_fn=None, batch_sampler=None, num_workers=0, persistent_workers=True, prefetch_factor=2, pin_memory=True, seed=None):
+    """
+    DataLoader with seeded workers.
+    Args:
+        batch_sampler: if given, batch_size and shuffle are ignored (f.e. multiscale.MultiScaleBatchSampler)
+        num_workers (int): worker processes, 0 loads in the main process
+        persistent_workers (bool): keep workers (and opened memory maps of caches) between epochs
+        prefetch_factor (int): batches loaded in advance by every worker
+        pin_memory (bool): pinned batches for faster copy to GPU, ignored without CUDA
+        seed (int): seed of worker base seeds and shuffling, None takes them from global torch RNG
+    """
+    kwargs = {}
+    if num_workers > 0:
+        kwargs.update(persistent_workers=persistent_workers, prefetch_factor=prefetch_factor)
+    if batch_sampler is not None:
+        kwargs.update(batch_sampler=batch_sampler)
+    else:
+        kwargs.update(batch_size=batch_size, shuffle=shuffle)
+
+    generator = torch.Generator().manual_seed(seed) if seed is not None else None
+
+    return DataLoader(dataset, collate_fn=collate_fn, num_workers=num_workers, pin_memory=pin_memory and torch.cuda.is_available(),
+                      worker_init_fn=seed_worker, generator=generator, **kwargs)
+
+
+def probe_throughput(dl, n_batches=50, step_time=0.0, starved_threshold=0.001):
+    """
+    Iterates n_batches of dl as training would, sleeping step_time seconds after every batch instead of the training step.
+    Main process waiting for a batch longer than starved_threshold seconds means the workers did not keep up.
+    Returns dict with startup time (first batch), images per second, mean wait for a batch in ms and share of starved batches.
+    """
+    t0 = time.time()
+    it = iter(dl)
+    next(it)
+    startup = time.time() - t0
+
+    waits = []
+    n_imgs = 0
+    t0 = time.time()
+    for _ in range(n_batches):
+        t_wait = time.time()
+        try:
+            batch = next(it)
+        except StopIteration:
+            break
+        waits.append(time.time() - t_wait)
+        n_imgs += len(batch[1])
+        if step_time:
+            time.sleep(step_time)
+    elapsed = time.time() - t0
+
+    waits = np.array(waits)
+    return {
+        "startup_s" : startup,
+        "images_per_s" : n_imgs / elapsed,
+        "mean_wait_ms" : waits.mean() * 1000,
+        "starved" : (waits > starved_threshold).mean(),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import ListDataset
+
+    parser = argparse.ArgumentParser(description="Images per second and worker starvation of ListDataset loading")
+    parser.add_argument("list_path")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--bs", type=int, default=16)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--train", type=int, default=1)
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--prefetch_factor", type=int, default=2)
+    parser.add_argument("--step_time", type=float, default=0.0, help="seconds of simulated training step")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    ds = ListDataset(args.list_path, img_size=args.img_size, train=bool(args.train))
+
+    #EVERY WORKER HAS ITS OWN RANDOM STATE
+    class RandomDraws(torch.utils.data.Dataset):
+        def __getitem__(self, index):
+            return torch.utils.data.get_worker_info().id, random.random(), np.random.rand(), torch.rand(1).item()
+
+        def __len__(self):
+            return 4
+
+    def random_draws():
+        return [tuple(float(v) for v in d) for d in make_dataloader(RandomDraws(), batch_size=None, num_workers=2, seed=args.seed)]
+
+    draws = random_draws()
+    assert len(set(d[1:] for d in draws)) == len(draws), "Workers have the same random state"
+    assert draws == random_draws(), "Seeding is not deterministic"
+
+    for workers in args.workers:
+        dl = make_dataloader(ds, batch_size=args.bs, shuffle=True, collate_fn=ds.collate_fn, num_workers=workers, prefetch_factor=args.prefetch_factor, seed=args.seed)
+        stats = probe_throughput(dl, args.batches, args.step_time)
+        print(f"workers {workers}: startup {stats['startup_s']:.2f}s, {stats['images_per_s']:.1f} img/s, "
+              f"mean wait {stats['mean_wait_ms']:.1f}ms, starved {stats['starved'] * 100:.0f}% of batches")
@@ -6,21 +6,68 @@ import numpy as np
 import os
 import torch.nn.functional as F
 import utils
+import augmentations
 import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from label_index import LabelIndex
+from image_cache import ImageCache, resized_shape
+from profiling import StageProfiler, profiled, timed
+
+
+def label_path_from_img_path(img_path, img_dir="images", labels_dir="labels", img_extensions=[".JPG"]):
+    """
+    Label path of image: last img_dir folder of the path becomes labels_dir and image extension becomes .txt
+    (other places of the path, which contain img_dir or extension, stay untouched)
+    """
+    parts = re.split(r"([\\/])", img_path)
+    for i in range(len(parts) - 3, -1, -2):
+        if parts[i] == img_dir:
+            parts[i] = labels_dir
+            break
+
+    root, ext = os.path.splitext(parts[-1])
+    if ext.lower() in [e.lower() for e in img_extensions]:
+        parts[-1] = root + ".txt"
+
+    return "".join(parts)
+
+
+def image_size(img):
+    """
+    (width, height) of PIL image or of HWC array
+    """
+    if isinstance(img, np.ndarray):
+        return img.shape[1], img.shape[0]
+    return img.size
+
+
+def empty_batch(shape, dtype):
+    """
+    Uninitialized batch tensor. Inside dataloader worker it is allocated in shared memory (as default_collate does),
+    so sending the batch to the main process does not copy it once more.
+    """
+    if torch.utils.data.get_worker_info() is None:
+        return torch.empty(shape, dtype=dtype)
+    storage = torch.empty(0, dtype=dtype)._typed_storage()._new_shared(int(np.prod(shape)))
+    return torch.empty(0, dtype=dtype).new(storage).view(shape)
 
 
 class ListDataset(Dataset):
-    def __init__(self, list_path, img_dir = "images", labels_dir="labels",  img_extensions=[".JPG"], img_size=608, train=True, bbox_minsize = 0.01, brightness_range=0.25, contrast_range=0.25, hue_range=0.05, saturation_range=0.25, cross_offset = 0.2):
-        with open(list_path, "r") as file:
-            self.img_files = file.read().splitlines()
+    def __init__(self, list_path, img_dir = "images", labels_dir="labels",  img_extensions=[".JPG"], img_size=608, train=True, bbox_minsize = 0.01, brightness_range=0.25, contrast_range=0.25, hue_range=0.05, saturation_range=0.25, cross_offset = 0.2, label_index=None, image_cache=None, batch_jitter=False, batch_mosaic=False, uint8=False, jpeg_draft=False, profile=False):
+        # Without list_path images come from elsewhere (shards.ShardDataset overrides open_image and load_boxes)
+        self.img_files = []
+        if list_path is not None:
+            with open(list_path, "r") as file:
+                self.img_files = [path.rstrip() for path in file.read().splitlines()]
 
+        self.label_files = [label_path_from_img_path(path, img_dir, labels_dir, img_extensions) for path in self.img_files]
 
-        self.label_files = []
-        for path in self.img_files:
-            path = path.replace(img_dir, labels_dir)
-            for ext in img_extensions:
-                path = path.replace(ext, ".txt")
-            self.label_files.append(path)
+        # Folder of packed label index (label_index.py), if None every label file is read on every access
+        self.label_index = LabelIndex(self.label_files, label_index) if label_index else None
+
+        # Folder of pre-resized uint8 image cache (image_cache.py), if None every image is decoded from its file
+        self.image_cache = ImageCache(self.img_files, image_cache, img_size) if image_cache else None
 
         self.img_size = img_size
         self.to_tensor =  transforms.ToTensor()
@@ -36,52 +83,59 @@ class ListDataset(Dataset):
 
         self.cross_offset = cross_offset
 
-    def __getitem__(self, index):
+        # Colour jitter on the whole batch with tensor ops (augmentations.py) instead of PIL passes for every image
+        self.batch_jitter = batch_jitter
 
-        img_path = self.img_files[index % len(self.img_files)].rstrip()
-        label_path = self.label_files[index % len(self.img_files)].rstrip()
+        # Mosaic assembled for the whole batch with batched ops in mosaic_collate_fn instead of tile by tile in __getitem__
+        self.batch_mosaic = batch_mosaic
 
+        # Images stay uint8 (0-255) through workers, collate and IPC, YOLOv4 converts them to float on the training device
+        self.uint8 = uint8
 
-        # Getting image
-        img = Image.open(img_path).convert('RGB')
-        width, height = img.size
+        # JPEGs are decoded at reduced scale (1/2, 1/4 or 1/8 in DCT domain), which is still not smaller than img_size
+        self.jpeg_draft = jpeg_draft
 
-        if os.path.exists(label_path):
-            boxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
+        # Timing histograms of loading stages, shared by dataloader workers (profiling.py)
+        self.profiler = StageProfiler() if profile else None
 
-        #RESIZING
-        if width > height:
-            ratio = height/width
-            t_width = self.img_size
-            t_height = int(ratio * self.img_size) 
-            
+    @profiled("sample")
+    def __getitem__(self, index):
+        # Batch samplers from multiscale.py pass (index, img_size) so every image of a batch has the same resolution
+        if isinstance(index, tuple):
+            index, img_size = index
         else:
-            ratio = width/height
-            t_width = int(ratio * self.img_size)
-            t_height = self.img_size
+            img_size = self.img_size
+
+        # Aspect ratio buckets (multiscale.AspectRatioBatchSampler) pass (height, width) of letterbox canvas, image is resized to its long side
+        canvas = None
+        if isinstance(img_size, tuple):
+            canvas = img_size
+            img_size = max(canvas)
+
+        index = index % len(self.img_files)
+        img_path = self.img_files[index]
 
-        img = transforms.functional.resize(img, (t_height, t_width))
+
+        # Getting image (already resized)
+        img, ratio = self.load_image(index, img_size)
+        t_width, t_height = image_size(img)
+
+        boxes = self.load_boxes(index)
         
-        #IF TRAIN APPLY BRIGHTNESS CONTRAST HUE SATURTATION
-        if self.train:
+        #IF TRAIN APPLY BRIGHTNESS CONTRAST HUE SATURTATION (with batch_jitter it is done for the whole batch in collate_fn)
+        jitter = None
+        if self.train and not self.batch_jitter:
             brightness_rnd = random.uniform(1- self.brightness_range, 1 + self.brightness_range)
             contrast_rnd = random.uniform(1 - self.contrast_range, 1 + self.contrast_range)
             hue_rnd = random.uniform(-self.hue_range, self.hue_range)
             saturation_rnd = random.uniform(1 - self.saturation_range, 1 + self.saturation_range)
 
-            img = transforms.functional.adjust_brightness(img, brightness_rnd)
-            img = transforms.functional.adjust_contrast(img, contrast_rnd)
-            img = transforms.functional.adjust_hue(img, hue_rnd)
-            img = transforms.functional.adjust_saturation(img, saturation_rnd)
+            jitter = (brightness_rnd, contrast_rnd, hue_rnd, saturation_rnd)
+            img = self.apply_jitter(img, jitter)
 
 
         #CONVERTING TO TENSOR
-        tensor_img = transforms.functional.to_tensor(img)
-
-        # Handle grayscaled images
-        if len(tensor_img.shape) != 3:
-            tensor_img = tensor_img.unsqueeze(0)
-            tensor_img = tensor_img.expand((3, img.shape[1:]))
+        tensor_img = self.image_to_tensor(img)
 
 
 
@@ -89,62 +143,43 @@ class ListDataset(Dataset):
 
         # Apply augmentations for train it would be mosaic
         if self.train:
-            mossaic_img = torch.zeros(3, self.img_size, self.img_size)
-
-            #FINDING CROSS POINT
-            cross_x = int(random.uniform(self.img_size * self.cross_offset, self.img_size * (1 - self.cross_offset)))
-            cross_y = int(random.uniform(self.img_size * self.cross_offset, self.img_size * (1 - self.cross_offset)))
-
-            fragment_img, fragment_bbox = self.get_mosaic(0, cross_x, cross_y, tensor_img, boxes)
-            mossaic_img[:, 0:cross_y, 0:cross_x] = fragment_img
-            boxes = fragment_bbox
-            
-
+            tiles = [tensor_img]
+            tiles_boxes = [boxes]
             for n in range(1, 4):
-                raw_fragment_img, raw_fragment_bbox = self.get_img_for_mosaic(brightness_rnd, contrast_rnd, hue_rnd, saturation_rnd)
-                fragment_img, fragment_bbox = self.get_mosaic(n, cross_x, cross_y, raw_fragment_img, raw_fragment_bbox)
-                boxes = torch.cat([boxes, fragment_bbox])
+                raw_fragment_img, raw_fragment_bbox = self.get_img_for_mosaic(jitter, img_size)
+                tiles.append(raw_fragment_img)
+                tiles_boxes.append(raw_fragment_bbox)
 
-                if n == 1:
-                    mossaic_img[:, 0 : cross_y, cross_x : self.img_size] = fragment_img
-                elif n == 2:
-                    mossaic_img[:, cross_y : self.img_size, 0 : cross_x] = fragment_img
-                elif n == 3:
-                    mossaic_img[:, cross_y : self.img_size, cross_x : self.img_size] = fragment_img
+            # With batch_mosaic tiles (HWC uint8) are cropped, resized and pasted for the whole batch in mosaic_collate_fn, first column of targets is tile number
+            if self.batch_mosaic:
+                targets = torch.zeros((sum(len(b) for b in tiles_boxes), 6))
+                targets[:, 0] = torch.cat([torch.full((len(b),), n) for n, b in enumerate(tiles_boxes)])
+                targets[:, 1:] = torch.cat(tiles_boxes)
+                return img_path, tiles, targets
 
             #Set mossaic to return tensor
-            tensor_img = mossaic_img
+            tensor_img, boxes = self.assemble_mosaic(tiles, tiles_boxes, img_size)
 
 
         # For validation it would be letterbox
         else:
-            xyxy_bboxes = utils.xywh2xyxy(boxes[:, 1:])
-
-            #IMG
-            padding = abs((t_width - t_height))//2
-            padded_img = torch.zeros(3, self.img_size, self.img_size)
-            if t_width > t_height:
-                padded_img[:, padding:padding+t_height] = tensor_img
-            else:
-                padded_img[:, :, padding:padding+t_width] = tensor_img
-
-            tensor_img = padded_img
-            
-            relative_padding = padding/self.img_size
-            #BOXES
-            if t_width > t_height:
-                #Change y's relative position
-                xyxy_bboxes[:, 1] *= ratio
-                xyxy_bboxes[:, 3] *= ratio
-                xyxy_bboxes[:, 1] += relative_padding
-                xyxy_bboxes[:, 3] += relative_padding
-            else:#x's
-                xyxy_bboxes[:, 0] *= ratio
-                xyxy_bboxes[:, 2] *= ratio
-                xyxy_bboxes[:, 0] += relative_padding
-                xyxy_bboxes[:, 2] += relative_padding
-
-            boxes[:, 1:] = utils.xyxy2xywh(xyxy_bboxes)
+            with timed(self.profiler, "letterbox"):
+                xyxy_bboxes = utils.xywh2xyxy(boxes[:, 1:])
+
+                #IMG
+                canvas_h, canvas_w = canvas if canvas is not None else (img_size, img_size)
+                pad_x = (canvas_w - t_width) // 2
+                pad_y = (canvas_h - t_height) // 2
+                padded_img = tensor_img.new_zeros(3, canvas_h, canvas_w)
+                padded_img[:, pad_y:pad_y + t_height, pad_x:pad_x + t_width] = tensor_img
+
+                tensor_img = padded_img
+
+                #BOXES
+                xyxy_bboxes[:, 0::2] = (xyxy_bboxes[:, 0::2] * t_width + pad_x) / canvas_w
+                xyxy_bboxes[:, 1::2] = (xyxy_bboxes[:, 1::2] * t_height + pad_y) / canvas_h
+
+                boxes[:, 1:] = utils.xyxy2xywh(xyxy_bboxes)
 
 
         
@@ -152,42 +187,128 @@ class ListDataset(Dataset):
         targets = torch.zeros((len(boxes), 6))
         targets[:, 1:] = boxes
 
+        # Rectangular letterbox also returns where the image is inside canvas (pad x, pad y, width, height in pixels), see utils.unletterbox
+        if canvas is not None and not self.train:
+            return img_path, tensor_img, targets, torch.tensor([pad_x, pad_y, t_width, t_height], dtype=torch.float32)
 
         return img_path, tensor_img, targets
 
-    def get_img_for_mosaic(self, brightness_rnd, contrast_rnd, hue_rnd, saturation_rnd):
-        random_index = random.randrange(0, len(self.img_files))
-        img_path = self.img_files[random_index].rstrip()
-        label_path = self.label_files[random_index].rstrip()
-
-        
-
-        # Getting image
-        img = Image.open(img_path).convert('RGB')
-        width, height = img.size
-
-        if os.path.exists(label_path):
-            boxes = torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
+    @profiled("mosaic")
+    def assemble_mosaic(self, tiles, tiles_boxes, img_size):
+        mossaic_img = tiles[0].new_zeros(3, img_size, img_size)
+
+        #FINDING CROSS POINT
+        cross_x = int(random.uniform(img_size * self.cross_offset, img_size * (1 - self.cross_offset)))
+        cross_y = int(random.uniform(img_size * self.cross_offset, img_size * (1 - self.cross_offset)))
+
+        boxes = []
+        for n in range(4):
+            fragment_img, fragment_bbox = self.get_mosaic(n, cross_x, cross_y, tiles[n], tiles_boxes[n], img_size)
+            boxes.append(fragment_bbox)
+
+            if n == 0:
+                mossaic_img[:, 0:cross_y, 0:cross_x] = fragment_img
+            elif n == 1:
+                mossaic_img[:, 0 : cross_y, cross_x : img_size] = fragment_img
+            elif n == 2:
+                mossaic_img[:, cross_y : img_size, 0 : cross_x] = fragment_img
+            elif n == 3:
+                mossaic_img[:, cross_y : img_size, cross_x : img_size] = fragment_img
+
+        return mossaic_img, torch.cat(boxes)
+
+    def load_image(self, index, img_size):
+        """
+        Returns RGB image resized to img_size on the long side and ratio of its short side to long side.
+        Image is PIL, or HWC uint8 array view of image cache, if the cache has it in this size already
+        """
+        img, width, height = self.open_image(index, img_size)
 
         #RESIZING
-        if width > height:
-            ratio = height/width
-            t_width = self.img_size
-            t_height = int(ratio * self.img_size) 
-            
-        else:
-            ratio = width/height
-            t_width = int(ratio * self.img_size)
-            t_height = self.img_size
-
-        img = transforms.functional.resize(img, (t_height, t_width))
-
+        t_width, t_height, ratio = resized_shape(width, height, img_size)
+        if image_size(img) != (t_width, t_height):
+            with timed(self.profiler, "resize"):
+                if isinstance(img, np.ndarray):
+                    img = Image.fromarray(img)
+                img = transforms.functional.resize(img, (t_height, t_width))
+
+        return img, ratio
+
+    @profiled("decode")
+    def open_image(self, index, img_size=None):
+        """
+        Returns RGB image and its original width and height.
+        Image from cache is already resized and is not copied: it is HWC uint8 array view of the memory map, PIL image otherwise
+        """
+        if self.image_cache is not None:
+            return self.image_cache.get(index)
+
+        return self.decode_image(self.img_files[index], img_size)
+
+    def decode_image(self, file, img_size=None):
+        """
+        Decodes image (path or file object) to RGB, returns it and its original width and height.
+        With jpeg_draft JPEG is decoded at the smallest scale, which is at least img_size on the long side, boxes are relative so they do not change
+        """
+        img = Image.open(file)
+        width, height = img.size
+        if self.jpeg_draft and img_size is not None and img.format == "JPEG":
+            t_width, t_height, _ = resized_shape(width, height, img_size)
+            img.draft("RGB", (t_width, t_height))
+        return img.convert('RGB'), width, height
+
+    @profiled("labels")
+    def load_boxes(self, index):
+        if self.label_index is not None:
+            return torch.from_numpy(self.label_index.boxes(index).astype(np.float64))
+
+        label_path = self.label_files[index]
+        if not os.path.exists(label_path):
+            return torch.zeros((0, 5), dtype=torch.float64)
+        return torch.from_numpy(np.loadtxt(label_path).reshape(-1, 5))
+
+    @profiled("jitter")
+    def apply_jitter(self, img, jitter):
+        brightness_rnd, contrast_rnd, hue_rnd, saturation_rnd = jitter
+
+        # PIL adjustments make new images anyway, so array from image cache is copied only here
+        if isinstance(img, np.ndarray):
+            img = Image.fromarray(img)
         img = transforms.functional.adjust_brightness(img, brightness_rnd)
         img = transforms.functional.adjust_contrast(img, contrast_rnd)
         img = transforms.functional.adjust_hue(img, hue_rnd)
         img = transforms.functional.adjust_saturation(img, saturation_rnd)
+        return img
+
+    def get_img_for_mosaic(self, jitter, img_size):
+        random_index = random.randrange(0, len(self.img_files))
+
+
+        # Getting image (already resized)
+        img, _ = self.load_image(random_index, img_size)
+
+        boxes = self.load_boxes(random_index)
+
+        #SAME JITTER AS THE FIRST PICTURE OF MOSAIC
+        if jitter is not None:
+            img = self.apply_jitter(img, jitter)
 
         #CONVERTING TO TENSOR
+        tensor_img = self.image_to_tensor(img)
+
+        return tensor_img, boxes
+
+    @profiled("to_tensor")
+    def image_to_tensor(self, img):
+        # Array from image cache becomes tensor view of the memory map, PIL image is copied
+        arr = img if isinstance(img, np.ndarray) else np.array(img)
+
+        # Batch mosaic tiles stay HWC uint8 until mosaic_collate_fn assembles the batch
+        if self.train and self.batch_mosaic:
+            return torch.from_numpy(arr)
+        if self.uint8:
+            return torch.from_numpy(arr).permute(2, 0, 1)
+
         tensor_img = transforms.functional.to_tensor(img)
 
         # Handle grayscaled images
@@ -195,32 +316,32 @@ class ListDataset(Dataset):
             tensor_img = tensor_img.unsqueeze(0)
             tensor_img = tensor_img.expand((3, img.shape[1:]))
 
-        return tensor_img, boxes
+        return tensor_img
 
 
     # N is spatial parameter if 0 TOP LEFT, if 1 TOP RIGHT, if 2 BOTTOM LEFT, if 3 BOTTOM RIGHT
-    def get_mosaic(self, n, cross_x, cross_y, tensor_img, boxes):
+    def get_mosaic(self, n, cross_x, cross_y, tensor_img, boxes, img_size):
         t_height = tensor_img.shape[1]
         t_width = tensor_img.shape[2]
 
         xyxy_bboxes = utils.xywh2xyxy(boxes[:, 1:])
 
-        relative_cross_x = cross_x / self.img_size
-        relative_cross_y = cross_y / self.img_size
+        relative_cross_x = cross_x / img_size
+        relative_cross_y = cross_y / img_size
 
         #CALCULATING TARGET WIDTH AND HEIGHT OF PICTURE
         if n == 0:
             width_of_nth_pic = cross_x 
             height_of_nth_pic = cross_y
         elif n == 1:
-            width_of_nth_pic = self.img_size - cross_x
+            width_of_nth_pic = img_size - cross_x
             height_of_nth_pic = cross_y
         elif n == 2:
             width_of_nth_pic = cross_x
-            height_of_nth_pic = self.img_size - cross_y
+            height_of_nth_pic = img_size - cross_y
         elif n == 3:
-            width_of_nth_pic = self.img_size - cross_x
-            height_of_nth_pic = self.img_size - cross_y
+            width_of_nth_pic = img_size - cross_x
+            height_of_nth_pic = img_size - cross_y
 
         #self.img_size - width_of_1st_pic
         #selg.img_size - height_of_1st_pic  
@@ -320,8 +441,114 @@ class ListDataset(Dataset):
         return tensor_img, boxes
 
 
+    @profiled("batch_mosaic")
+    def mosaic_collate_fn(self, batch):
+        """
+        Batch-level mosaic. Crops of all 4 x B tiles are sampled at once, then every output pixel gets
+        its source pixel (nearest resize, as in get_mosaic) through one index gather from all uint8 tiles packed together.
+        """
+        paths, tiles, tiles_targets = list(zip(*batch))
+        B = len(batch)
+        S = max(tiles[0][0].shape[:2])
+
+        #ALL TILES PACKED INTO ONE [TOTAL PIXELS, 3] UINT8 TENSOR
+        tile_list = [tile for sample_tiles in tiles for tile in sample_tiles]
+        t_h = torch.tensor([tile.shape[0] for tile in tile_list], dtype=torch.float64).view(B, 4)
+        t_w = torch.tensor([tile.shape[1] for tile in tile_list], dtype=torch.float64).view(B, 4)
+        sizes = (t_h * t_w).view(-1).long()
+        offsets = torch.cat([sizes.new_zeros(1), sizes.cumsum(0)[:-1]]).view(B, 4)
+        src = torch.cat([tile.reshape(-1, 3) for tile in tile_list])
+
+        #CROSS POINTS AND SIZES OF QUADRANTS (tile n goes to quadrant n: TOP LEFT, TOP RIGHT, BOTTOM LEFT, BOTTOM RIGHT)
+        cross_x = (torch.rand(B, dtype=torch.float64) * (1 - 2 * self.cross_offset) + self.cross_offset).mul(S).floor()
+        cross_y = (torch.rand(B, dtype=torch.float64) * (1 - 2 * self.cross_offset) + self.cross_offset).mul(S).floor()
+        right = torch.tensor([0., 1., 0., 1.], dtype=torch.float64)
+        bottom = torch.tensor([0., 0., 1., 1.], dtype=torch.float64)
+        q_x0 = right * cross_x[:, None]
+        q_y0 = bottom * cross_y[:, None]
+        q_w = torch.where(right.bool(), S - cross_x[:, None], cross_x[:, None])
+        q_h = torch.where(bottom.bool(), S - cross_y[:, None], cross_y[:, None])
+
+        #CROPS, SAME DISTRIBUTION AS get_mosaic
+        def randint(low, high):
+            return low + (torch.rand(B, 4, dtype=torch.float64) * (high - low + 1)).floor()
+
+        cut_x1 = randint(0, (t_w * 0.33).floor())
+        cut_y1 = randint(0, (t_h * 0.33).floor())
+        enlarge_x = (t_w - cut_x1) / q_w < (t_h - cut_y1) / q_h
+        cut_x2_rnd = randint(cut_x1 + (t_w * 0.67).floor(), t_w)
+        cut_y2_rnd = randint(cut_y1 + (t_h * 0.67).floor(), t_h)
+        cut_x2 = torch.where(enlarge_x, cut_x2_rnd, (cut_x1 + (cut_y2_rnd - cut_y1) / q_h * q_w).floor())
+        cut_y2 = torch.where(enlarge_x, (cut_y1 + (cut_x2_rnd - cut_x1) / q_w * q_h).floor(), cut_y2_rnd)
+        crop_w = cut_x2 - cut_x1
+        crop_h = cut_y2 - cut_y1
+
+        #SOURCE COLUMN OF EVERY OUTPUT COLUMN FOR TOP AND BOTTOM ROW BANDS, SOURCE ROW OF EVERY OUTPUT ROW FOR LEFT AND RIGHT COLUMN BANDS
+        pos = torch.arange(S, dtype=torch.float64)
+        col_band = (pos[None] >= cross_x[:, None]).long()
+        row_band = (pos[None] >= cross_y[:, None]).long()
+        col_tiles = torch.stack([col_band, col_band + 2], 1)
+        row_tiles = torch.stack([2 * row_band, 2 * row_band + 1], 1)
+
+        def per_tile(param, n):
+            return param.gather(1, n.view(B, -1)).view(n.shape)
+
+        src_x = per_tile(cut_x1, col_tiles) + ((pos - per_tile(q_x0, col_tiles)) * per_tile(crop_w / q_w, col_tiles)).floor()
+        src_x = torch.min(src_x, per_tile(cut_x2 - 1, col_tiles)).long()
+        src_y = per_tile(cut_y1, row_tiles) + ((pos - per_tile(q_y0, row_tiles)) * per_tile(crop_h / q_h, row_tiles)).floor()
+        src_y = torch.min(src_y, per_tile(cut_y2 - 1, row_tiles)).long()
+
+        # Flat index is offset + y * width of tile + x; row part depends on column band, column part on row band (int32 halves memory traffic)
+        row_index = (per_tile(offsets, row_tiles) + src_y * per_tile(t_w, row_tiles).long()).int()
+        src_x = src_x.int()
+
+        # Chunks of 8 samples keep index small
+        imgs = empty_batch((B, 3, S, S), torch.uint8 if self.uint8 else torch.float32)
+        for start in range(0, B, 8):
+            end = min(start + 8, B)
+            rows = torch.where(col_band[start:end, None, :].bool(), row_index[start:end, 1, :, None], row_index[start:end, 0, :, None])
+            cols = torch.where(row_band[start:end, :, None].bool(), src_x[start:end, 1, None, :], src_x[start:end, 0, None, :])
+            pixels = src.index_select(0, (rows + cols).view(-1))
+            imgs[start:end] = pixels.view(end - start, S, S, 3).permute(0, 3, 1, 2)
+        if not self.uint8:
+            imgs.div_(255)
+
+        #BOXES OF ALL TILES AT ONCE
+        targets = torch.cat(tiles_targets, 0)
+        sample = torch.cat([torch.full((len(t),), i, dtype=torch.long) for i, t in enumerate(tiles_targets)])
+        tile = targets[:, 0].long()
+
+        def box_tile(param):
+            return param[sample, tile]
+
+        xyxy_bboxes = utils.xywh2xyxy(targets[:, 2:].double())
+        xyxy_bboxes[:, 0::2] = ((xyxy_bboxes[:, 0::2] - (box_tile(cut_x1) / box_tile(t_w))[:, None]) / (box_tile(crop_w) / box_tile(t_w))[:, None]).clamp(0, 1)
+        xyxy_bboxes[:, 1::2] = ((xyxy_bboxes[:, 1::2] - (box_tile(cut_y1) / box_tile(t_h))[:, None]) / (box_tile(crop_h) / box_tile(t_h))[:, None]).clamp(0, 1)
+
+        #FILTER TO THROUGH OUT ALL SMALL BBOXES
+        filter_minbbox = (xyxy_bboxes[:, 2] - xyxy_bboxes[:, 0] > self.bbox_minsize) & (xyxy_bboxes[:, 3] - xyxy_bboxes[:, 1] > self.bbox_minsize)
+
+        # RESIZING AND SHIFTING TO MOSAIC
+        xyxy_bboxes[:, 0::2] = xyxy_bboxes[:, 0::2] * (box_tile(q_w) / S)[:, None] + (box_tile(q_x0) / S)[:, None]
+        xyxy_bboxes[:, 1::2] = xyxy_bboxes[:, 1::2] * (box_tile(q_h) / S)[:, None] + (box_tile(q_y0) / S)[:, None]
+
+        targets[:, 0] = sample.to(targets.dtype)
+        targets[:, 2:] = utils.xyxy2xywh(xyxy_bboxes).to(targets.dtype)
+        targets = targets[filter_minbbox]
+
+        if self.batch_jitter:
+            with timed(self.profiler, "batch_jitter"):
+                jitter = augmentations.sample_jitter_params(len(imgs), self.brightness_range, self.contrast_range, self.hue_range, self.saturation_range)
+                imgs = augmentations.color_jitter(imgs, **jitter)
+
+        return paths, imgs, targets
+
+    @profiled("collate")
     def collate_fn(self, batch):
-        paths, imgs, targets = list(zip(*batch))
+        if self.train and self.batch_mosaic:
+            return self.mosaic_collate_fn(batch)
+
+        paths, imgs, targets, *padding = list(zip(*batch))
         # Remove empty placeholder targets
         targets = [boxes for boxes in targets if boxes is not None]
         # Add sample index to targets
@@ -329,8 +556,29 @@ class ListDataset(Dataset):
             boxes[:, 0] = i
         targets = torch.cat(targets, 0)
 
-        return paths, torch.stack(imgs), targets
-
+        imgs = torch.stack(imgs, 0, out=empty_batch((len(imgs),) + imgs[0].shape, imgs[0].dtype))
+        if self.train and self.batch_jitter:
+            with timed(self.profiler, "batch_jitter"):
+                jitter = augmentations.sample_jitter_params(len(imgs), self.brightness_range, self.contrast_range, self.hue_range, self.saturation_range)
+                imgs = augmentations.color_jitter(imgs, **jitter)
+
+        if padding:
+            return paths, imgs, targets, torch.stack(padding[0])
+        return paths, imgs, targets
+
+    def image_sizes(self):
+        """
+        (width, height) of every image, from image cache if there is one, otherwise from image headers
+        """
+        if self.image_cache is not None:
+            return self.image_cache.original_sizes()
+
+        def original_size(img_path):
+            with Image.open(img_path) as img: #Only header is read
+                return img.size
+
+        with ThreadPoolExecutor(8) as pool:
+            return list(pool.map(original_size, self.img_files))
 
     def __len__(self):
         return len(self.img_files)
\ No newline at end of file
@@ -0,0 +1,240 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision.ops import batched_nms, nms
+
+import utils
+from evaluation import MAPEvaluator
+
+# Replays of cached candidates: class aware NMS of utils.non_max_suppression (score is objectness * class probability)
+# and class agnostic NMS of utils.get_bboxes_from_anchors (objectness)
+MODES = ("nms", "anchors")
+
+
+def weights_hash(model):
+    """
+    sha1 of model state dict (names, dtypes, shapes and values)
+    """
+    h = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        h.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        h.update(tensor.numpy().tobytes())
+    return h.hexdigest()
+
+
+def label_files_hash(label_files):
+    """
+    sha1 of path, size and modification time of every label file, so edited labels give a new hash without reading them
+    """
+    h = hashlib.sha1()
+    for path in label_files:
+        try:
+            stat = os.stat(path)
+            h.update(f"{path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+        except FileNotFoundError:
+            h.update(f"{path}:missing\n".encode())
+    return h.hexdigest()
+
+
+def preprocessing_hash(dataset):
+    """
+    sha1 of dataset settings (every simple attribute, f.e. img_size, train), of the image list and of its label files
+    """
+    settings = {k: v for k, v in sorted(vars(dataset).items()) if v is None or isinstance(v, (bool, int, float, str))}
+    settings["class"] = type(dataset).__name__
+    settings["img_files"] = hashlib.sha1("\n".join(dataset.img_files).encode()).hexdigest()
+    settings["label_files"] = label_files_hash(getattr(dataset, "label_files", []))
+    return hashlib.sha1(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+
+
+class DetectionCache:
+    """
+    On-disk cache of pre-NMS top-k candidates of a model over a dataset.
+    It lives in cache_dir/<weights hash>_<preprocessing hash>, so new weights, changed preprocessing or edited labels give new cache
+    (old one is never reused).
+    Candidates are the top_k of every image by objectness. Class score (objectness * class probability) is never above objectness,
+    so both replays (see MODES) get every candidate above their threshold, while it is above objectness of the last kept candidate.
+    Files:
+        candidates.npy - [N images, top_k, 7] float32 (x1, y1, x2, y2, objectness, probability of top class, class), memory-mapped on load
+        targets.npy, target_offsets.npy - ground truth of all images packed in one array
+        shapes.npy - [N, 2] network input height and width of every image
+        meta.json - image paths (row of each image) and settings, written last, so interrupted build is never valid
+    """
+    def __init__(self, cache_dir, model, dataset, top_k=1000):
+        self.dataset = dataset
+        self.top_k = top_k
+        self.n_classes = model.yolo1.num_classes
+
+        self.key = f"{weights_hash(model)[:16]}_{preprocessing_hash(dataset)[:16]}"
+        self.path = os.path.join(cache_dir, self.key)
+
+        self.meta = None
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    def build(self, model, batch_size=8, num_workers=0, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        model = model.to(device).eval()
+        n = len(self.dataset)
+
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        candidates = np.lib.format.open_memmap(os.path.join(tmp_path, "candidates.npy"), mode="w+", dtype=np.float32, shape=(n, self.top_k, 7))
+        shapes = np.zeros((n, 2), dtype=np.int64)
+        targets = []
+        paths = []
+
+        dl = DataLoader(self.dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=self.dataset.collate_fn, shuffle=False)
+        row = 0
+        with torch.no_grad():
+            for batch_paths, images, batch_targets in dl:
+                anchors, _ = model(images.to(device))
+
+                cls_conf, cls_idx = anchors[..., 5:].max(2)
+                objectness, top = anchors[..., 4].topk(min(self.top_k, anchors.size(1)), dim=1)
+
+                boxes = utils.xywh2xyxy(anchors[..., :4].gather(1, top[..., None].expand(-1, -1, 4)).view(-1, 4)).view(len(images), -1, 4)
+                cls_conf = cls_conf.gather(1, top)
+                cls_idx = cls_idx.gather(1, top).float()
+
+                batch_candidates = torch.cat([boxes, objectness[..., None], cls_conf[..., None], cls_idx[..., None]], 2).cpu().numpy()
+                candidates[row:row + len(images), :batch_candidates.shape[1]] = batch_candidates
+                shapes[row:row + len(images)] = images.shape[2:]
+
+                batch_targets = batch_targets.clone()
+                batch_targets[:, 0] += row
+                targets.append(batch_targets.numpy().astype(np.float32))
+                paths.extend(batch_paths)
+                row += len(images)
+
+        candidates.flush()
+        del candidates
+
+        targets = np.concatenate(targets) if targets else np.zeros((0, 6), dtype=np.float32)
+        target_offsets = np.searchsorted(targets[:, 0], np.arange(n + 1)).astype(np.int64)
+        np.save(os.path.join(tmp_path, "targets.npy"), targets)
+        np.save(os.path.join(tmp_path, "target_offsets.npy"), target_offsets)
+        np.save(os.path.join(tmp_path, "shapes.npy"), shapes)
+
+        meta = {"paths" : paths, "top_k" : self.top_k, "n_classes" : self.n_classes, "key" : self.key}
+        with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+            json.dump(meta, file)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp_path, self.path)
+        self.meta = None
+
+    def load(self):
+        if self.meta is not None:
+            return
+
+        with open(os.path.join(self.path, "meta.json")) as file:
+            self.meta = json.load(file)
+        self.candidates = np.load(os.path.join(self.path, "candidates.npy"), mmap_mode="r")
+        self.targets = np.load(os.path.join(self.path, "targets.npy"))
+        self.target_offsets = np.load(os.path.join(self.path, "target_offsets.npy"))
+        self.shapes = np.load(os.path.join(self.path, "shapes.npy"))
+        self.rows = {path: i for i, path in enumerate(self.meta["paths"])}
+
+    def get(self, img_path):
+        """
+        Cached [top_k, 7] candidates of one image
+        """
+        self.load()
+        return torch.from_numpy(np.array(self.candidates[self.rows[img_path]]))
+
+    def detections(self, confidence_threshold, iou_threshold, max_det=300, chunk=256, mode="nms"):
+        """
+        Replays NMS from cache, as utils.non_max_suppression (mode "nms") or utils.get_bboxes_from_anchors (mode "anchors") does it.
+        Yields (rows, detections) in chunks, detections are in utils.non_max_suppression format
+        (score is objectness * class probability, or objectness in mode "anchors")
+        """
+        if mode not in MODES:
+            raise ValueError(f"Please use one of suggested modes: {', '.join(MODES)}.")
+        self.load()
+        n = len(self.meta["paths"])
+        for start in range(0, n, chunk):
+            rows = range(start, min(start + chunk, n))
+            block = torch.from_numpy(np.array(self.candidates[start:rows.stop]))
+            batch_detections = []
+            for img_candidates in block:
+                boxes, objectness, cls_conf, cls_idx = img_candidates[:, :4], img_candidates[:, 4], img_candidates[:, 5], img_candidates[:, 6]
+                if mode == "nms":
+                    scores = objectness * cls_conf
+                    keep = (scores > confidence_threshold).nonzero()[:, 0]
+                    keep = keep[batched_nms(boxes[keep], scores[keep], cls_idx[keep].long(), iou_threshold)[:max_det]]
+                else:
+                    # Objectness threshold and class agnostic NMS
+                    scores = objectness
+                    keep = (scores > confidence_threshold).nonzero()[:, 0]
+                    keep = keep[nms(boxes[keep], scores[keep], iou_threshold)[:max_det]]
+                batch_detections.append(torch.stack([*boxes[keep].unbind(1), scores[keep], cls_idx[keep]], 1))
+            yield rows, batch_detections
+
+    def evaluate(self, confidence_threshold, iou_threshold, max_det=100, mode="nms"):
+        self.load()
+        evaluator = MAPEvaluator(self.n_classes, max_det=max_det)
+        for rows, batch_detections in self.detections(confidence_threshold, iou_threshold, max_det, mode=mode):
+            # Images are grouped by network input shape, because evaluator takes one shape per update
+            for shape in np.unique(self.shapes[rows.start:rows.stop], axis=0):
+                same_shape = [i for i in rows if (self.shapes[i] == shape).all()]
+                targets = np.concatenate([self.targets[self.target_offsets[i]:self.target_offsets[i + 1]] for i in same_shape])
+                targets = torch.from_numpy(targets.copy())
+                targets[:, 0] = torch.from_numpy(np.searchsorted(same_shape, targets[:, 0].numpy().astype(np.int64))).float()
+                evaluator.update([batch_detections[i - rows.start] for i in same_shape], targets, tuple(shape))
+        return evaluator.compute()
+
+    def sweep(self, confidence_thresholds, iou_thresholds, max_det=100, mode="nms"):
+        """
+        Returns {(confidence_threshold, iou_threshold): evaluate result}
+        """
+        return {(c, i): self.evaluate(c, i, max_det, mode) for c in confidence_thresholds for i in iou_thresholds}
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from dataset import ListDataset
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Cache pre-NMS detections of a checkpoint and sweep NMS thresholds")
+    parser.add_argument("list_path", help="txt file with image paths (validation set)")
+    parser.add_argument("--weights", required=True)
+    parser.add_argument("--n_classes", type=int, default=80)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--cache_dir", default="detection_cache")
+    parser.add_argument("--top_k", type=int, default=1000)
+    parser.add_argument("--bs", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--conf", type=float, nargs="+", default=[0.001, 0.01, 0.05, 0.1, 0.25])
+    parser.add_argument("--iou", type=float, nargs="+", default=[0.4, 0.5, 0.6, 0.7])
+    parser.add_argument("--mode", choices=MODES, default="nms", help="nms: utils.non_max_suppression, anchors: utils.get_bboxes_from_anchors")
+    args = parser.parse_args()
+
+    model = YOLOv4(n_classes=args.n_classes, weights_path=args.weights, img_dim=args.img_size)
+    ds = ListDataset(args.list_path, img_size=args.img_size, train=False)
+    cache = DetectionCache(args.cache_dir, model, ds, top_k=args.top_k)
+
+    if not cache.exists():
+        t0 = time.time()
+        cache.build(model, batch_size=args.bs, num_workers=args.workers)
+        print(f"Built cache {cache.path} in {time.time() - t0:.1f}s")
+
+    t0 = time.time()
+    results = cache.sweep(args.conf, args.iou, mode=args.mode)
+    print(f"Swept {len(results)} settings in {time.time() - t0:.1f}s")
+    print("conf    iou    mAP    mAP50")
+    for (c, i), result in results.items():
+        print(f"{c:<7} {i:<6} {result['mAP']:.4f} {result['mAP50']:.4f}")
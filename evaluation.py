@@ -0,0 +1,238 @@
+import numpy as np
+import torch
+
+
+def box_iou(box1, box2):
+    """
+    IoU matrix [N, M] of two sets of x1y1x2y2 boxes (numpy)
+    """
+    area1 = (box1[:, 2] - box1[:, 0]) * (box1[:, 3] - box1[:, 1])
+    area2 = (box2[:, 2] - box2[:, 0]) * (box2[:, 3] - box2[:, 1])
+
+    lt = np.maximum(box1[:, None, :2], box2[None, :, :2])
+    rb = np.minimum(box1[:, None, 2:], box2[None, :, 2:])
+    wh = np.clip(rb - lt, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+
+    return inter / (area1[:, None] + area2[None, :] - inter + 1e-16)
+
+
+def match_detections(det_boxes, det_cls, gt_boxes, gt_cls, iou_thresholds):
+    """
+    COCO matching of detections of one image (sorted by score, descending) to ground truth, vectorized over detections and IoU thresholds.
+    Every detection in score order takes the free ground truth of its class with the highest IoU >= threshold,
+    a detection losing its best ground truth to a better scored one can still take another one.
+    Vectorized in rounds: every undecided detection picks its best free ground truth, detections before the first one
+    which picked the same ground truth as a better scored detection are decided as the score order would decide them,
+    the rest picks again in the next round (usually a few rounds, not one per detection).
+    Returns bool [N, T] array, True if detection is true positive at threshold
+    """
+    T = len(iou_thresholds)
+    tp = np.zeros((len(det_boxes), T), dtype=bool)
+    if len(det_boxes) == 0 or len(gt_boxes) == 0:
+        return tp
+
+    iou = box_iou(det_boxes, gt_boxes)
+    iou[det_cls[:, None] != gt_cls[None, :]] = 0
+
+    #ONLY DETECTIONS OVERLAPPING SOME GROUND TRUTH ENOUGH CAN MATCH
+    dets = np.nonzero((iou >= iou_thresholds.min()).any(1))[0]
+    iou = iou[dets]
+    D, G = iou.shape
+    order = np.arange(D)[:, None]
+    gts = np.arange(G)[None, :, None]
+
+    taken = np.zeros((G, T), dtype=bool)
+    undecided = np.ones((D, T), dtype=bool)
+    while undecided.any():
+        candidates = np.where(taken[None], -1, iou[:, :, None])
+        best = candidates.argmax(1)
+        # Taken ground truths only add up, a detection without a free one now stays false positive
+        active = undecided & (np.take_along_axis(candidates, best[:, None], 1)[:, 0] >= iou_thresholds[None])
+        undecided &= active
+
+        #FIRST DETECTION PICKING A GROUND TRUTH, WHICH A BETTER SCORED ONE ALREADY PICKED, ENDS THE DECIDED PREFIX
+        wanted = np.cumsum((best[:, None] == gts) & active[:, None], 0)
+        lost = active & (np.take_along_axis(wanted, best[:, None], 1)[:, 0] > 1)
+        first_lost = np.where(lost.any(0), lost.argmax(0), D)
+        matched = active & (order < first_lost[None])
+
+        d, t = np.nonzero(matched)
+        tp[dets[d], t] = True
+        taken[best[d, t], t] = True
+        undecided &= ~matched
+    return tp
+
+
+def average_precision(tp, n_gt):
+    """
+    COCO style 101 point interpolated AP of detections sorted by score.
+    tp is bool [N, T] array, returns AP for every threshold [T]
+    """
+    if len(tp) == 0:
+        return np.zeros(tp.shape[1])
+
+    tpc = tp.cumsum(0)
+    fpc = (~tp).cumsum(0)
+    recall = tpc / n_gt
+    precision = tpc / (tpc + fpc)
+
+    #PRECISION ENVELOPE
+    precision = np.maximum.accumulate(precision[::-1], axis=0)[::-1]
+
+    recall_points = np.linspace(0, 1, 101)
+    ap = np.zeros(tp.shape[1])
+    for t in range(tp.shape[1]):
+        idx = np.searchsorted(recall[:, t], recall_points, side="left")
+        valid = idx < len(recall)
+        ap[t] = precision[idx[valid], t].sum() / len(recall_points)
+    return ap
+
+
+class MAPEvaluator:
+    """
+    Streaming mAP evaluator. Matching is done in update, so only compact per-detection
+    records (score, class, true positive flag for every threshold) and per-class ground truth counts are kept.
+    Args:
+        n_classes (int): amount of classes
+        iou_thresholds (iterable): IoU thresholds, default is COCO 0.5:0.95:0.05
+        max_det (int): maximum detections per image, bounds memory
+    """
+    def __init__(self, n_classes, iou_thresholds=None, max_det=100):
+        if iou_thresholds is None:
+            iou_thresholds = np.linspace(0.5, 0.95, 10)
+
+        self.n_classes = n_classes
+        self.iou_thresholds = np.asarray(iou_thresholds, dtype=np.float32)
+        self.max_det = max_det
+        self.reset()
+
+    def reset(self):
+        self.scores = []
+        self.classes = []
+        self.tps = []
+        self.n_gt = np.zeros(self.n_classes, dtype=np.int64)
+        self.n_images = 0
+
+    def update(self, detections, targets, img_size):
+        """
+        detections: list (one per image) of [N, 6] tensors: x1, y1, x2, y2 (pixels), score, class (utils.non_max_suppression output)
+        targets: [M, 6] tensor of dataset format: img index, class, x, y, w, h (relative)
+        img_size: (height, width) of network input
+        """
+        height, width = img_size
+        targets = targets.detach().cpu().float().numpy()
+        scale = np.array([width, height, width, height], dtype=np.float32)
+
+        gt_xyxy = np.empty((len(targets), 4), dtype=np.float32)
+        gt_xyxy[:, :2] = targets[:, 2:4] - targets[:, 4:6] / 2
+        gt_xyxy[:, 2:] = targets[:, 2:4] + targets[:, 4:6] / 2
+        gt_xyxy *= scale
+        gt_img = targets[:, 0].astype(np.int64)
+        gt_cls = targets[:, 1].astype(np.int64)
+
+        self.n_gt += np.bincount(gt_cls, minlength=self.n_classes)[:self.n_classes]
+
+        for i, det in enumerate(detections):
+            det = det.detach().cpu().float().numpy()
+            det = det[np.argsort(-det[:, 4], kind="stable")][:self.max_det]
+            det_cls = det[:, 5].astype(np.int64)
+
+            img_filter = gt_img == i
+            tp = match_detections(det[:, :4], det_cls, gt_xyxy[img_filter], gt_cls[img_filter], self.iou_thresholds)
+
+            self.scores.append(det[:, 4].astype(np.float32))
+            self.classes.append(det_cls.astype(np.int16))
+            self.tps.append(tp)
+
+        self.n_images += len(detections)
+
+    def compute(self):
+        """
+        Returns dict with mAP (0.5:0.95), mAP50, mAP75 and ap_per_class [n_classes, T] (nan for classes without ground truth)
+        """
+        T = len(self.iou_thresholds)
+        ap_per_class = np.full((self.n_classes, T), np.nan)
+
+        if self.scores:
+            scores = np.concatenate(self.scores)
+            classes = np.concatenate(self.classes)
+            tps = np.concatenate(self.tps)
+        else:
+            scores = np.zeros(0, dtype=np.float32)
+            classes = np.zeros(0, dtype=np.int16)
+            tps = np.zeros((0, T), dtype=bool)
+
+        order = np.argsort(-scores, kind="stable")
+        classes, tps = classes[order], tps[order]
+
+        for c in range(self.n_classes):
+            if self.n_gt[c] == 0:
+                continue
+            ap_per_class[c] = average_precision(tps[classes == c], self.n_gt[c])
+
+        def mean_ap(ap):
+            return float(np.nanmean(ap)) if not np.isnan(ap).all() else 0.0
+
+        result = {"mAP" : mean_ap(ap_per_class), "ap_per_class" : ap_per_class}
+        for threshold in (50, 75):
+            #ONLY IF THIS THRESHOLD IS EVALUATED
+            idx = np.nonzero(np.abs(self.iou_thresholds - threshold / 100) < 1e-6)[0]
+            if len(idx):
+                result[f"mAP{threshold}"] = mean_ap(ap_per_class[:, idx[0]])
+
+        return result
+
+
+if __name__ == "__main__":
+    import time
+
+    #HAND COMPUTED REFERENCE
+    # Class 0: two ground truths, detections TP (0.9), FP (0.8), TP (0.7) at every threshold
+    #   precision [1, 1/2, 2/3], recall [1/2, 1/2, 1] -> AP = (51 * 1 + 50 * 2/3) / 101
+    # Class 1: one ground truth, one detection with IoU 0.62 -> TP for 0.5, 0.55, 0.6 only -> mAP 0.3, AP50 1
+    # Class 2: competing detections, ground truths [0, 0, 10, 10], [1, 0, 11, 10]. Detection [0, 0, 10, 10] (0.95) takes the first one,
+    #   [0.5, 0, 10.5, 10] (0.85) has IoU 0.905 with both and takes the free second one -> TP up to 0.9, FP at 0.95 -> AP (9 + 51 / 101) / 10
+    evaluator = MAPEvaluator(n_classes=3)
+    targets = torch.tensor([[0, 0, 0.25, 0.25, 0.5, 0.5],
+                            [1, 0, 0.75, 0.75, 0.5, 0.5],
+                            [1, 1, 0.125, 0.125, 0.25, 0.25],
+                            [0, 2, 0.05, 0.05, 0.1, 0.1],
+                            [0, 2, 0.06, 0.05, 0.1, 0.1]])
+    detections = [torch.tensor([[0, 0, 50, 50, 0.9, 0],
+                                [0, 0, 10, 10, 0.95, 2],
+                                [0.5, 0, 10.5, 10, 0.85, 2]]),
+                  torch.tensor([[0, 0, 20, 20, 0.8, 0],
+                                [50, 50, 100, 100, 0.7, 0],
+                                [0, 0, 25, 15.5, 0.6, 1]])]
+    evaluator.update(detections, targets, (100, 100))
+    result = evaluator.compute()
+
+    ap_class0 = (51 + 50 * 2 / 3) / 101
+    assert abs(result["ap_per_class"][0].mean() - ap_class0) < 1e-6, result
+    assert abs(result["ap_per_class"][1].mean() - 0.3) < 1e-6, result
+    ap_class2 = (9 + 51 / 101) / 10
+    assert abs(result["ap_per_class"][2].mean() - ap_class2) < 1e-6, result
+    assert abs(result["mAP"] - (ap_class0 + 0.3 + ap_class2) / 3) < 1e-6, result
+    assert abs(result["mAP50"] - (ap_class0 + 1 + 1) / 3) < 1e-6, result
+    print("Reference check passed:", {k: v for k, v in result.items() if k != "ap_per_class"})
+
+    #SPEED ON 5000 IMAGES
+    n_images, bs, n_classes = 5000, 32, 80
+    g = torch.Generator().manual_seed(0)
+    evaluator = MAPEvaluator(n_classes=n_classes)
+    t0 = time.time()
+    for _ in range(n_images // bs):
+        n_gt = 8 * bs
+        targets = torch.cat([torch.randint(0, bs, (n_gt, 1), generator=g).float(),
+                             torch.randint(0, n_classes, (n_gt, 1), generator=g).float(),
+                             torch.rand(n_gt, 2, generator=g) * 0.6 + 0.2,
+                             torch.rand(n_gt, 2, generator=g) * 0.3 + 0.05], 1)
+        detections = []
+        for _ in range(bs):
+            xy = torch.rand(100, 2, generator=g) * 500
+            wh = torch.rand(100, 2, generator=g) * 100 + 10
+            detections.append(torch.cat([xy, xy + wh, torch.rand(100, 1, generator=g), torch.randint(0, n_classes, (100, 1), generator=g).float()], 1))
+        evaluator.update(detections, targets, (608, 608))
+    result = evaluator.compute()
+    print(f"{evaluator.n_images} images, {sum(len(s) for s in evaluator.scores)} detections evaluated in {time.time() - t0:.2f}s")
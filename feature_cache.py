@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from detection_cache import weights_hash, preprocessing_hash
+
+
+FEATURE_NAMES = ("x5", "x4", "x3")
+
+
+class FeatureStore:
+    """
+    Memory-mapped fp16 store of backbone outputs (x5, x4, x3) for frozen-backbone fine-tuning.
+    Dataset should be deterministic (f.e. ListDataset with train=False), otherwise one random augmentation is frozen into the store.
+    Store lives in root/<backbone weights hash>_<preprocessing hash>, so it is rebuilt when backbone or preprocessing change.
+    """
+    def __init__(self, root, model, dataset):
+        self.dataset = dataset
+        self.key = f"{weights_hash(model.backbone)[:16]}_{preprocessing_hash(dataset)[:16]}"
+        self.path = os.path.join(root, self.key)
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, "meta.json"))
+
+    def build(self, model, batch_size=8, num_workers=0, device=None):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+
+        n = len(self.dataset)
+        if n == 0:
+            raise ValueError("Dataset is empty, there are no features to store")
+        backbone = model.backbone.to(device).eval()
+
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        features = None
+        targets = []
+        paths = []
+
+        dl = DataLoader(self.dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=self.dataset.collate_fn, shuffle=False)
+        row = 0
+        with torch.no_grad():
+            for batch_paths, images, batch_targets in dl:
+                outputs = backbone(model.prepare_input(images.to(device)))
+
+                #SHAPES ARE KNOWN ONLY AFTER FIRST BATCH
+                if features is None:
+                    features = [np.lib.format.open_memmap(os.path.join(tmp_path, f"{name}.npy"), mode="w+", dtype=np.float16, shape=(n,) + tuple(output.shape[1:]))
+                                for name, output in zip(FEATURE_NAMES, outputs)]
+
+                for feature, output in zip(features, outputs):
+                    feature[row:row + len(images)] = output.half().cpu().numpy()
+
+                batch_targets = batch_targets.clone()
+                batch_targets[:, 0] += row
+                targets.append(batch_targets.numpy().astype(np.float32))
+                paths.extend(batch_paths)
+                row += len(images)
+
+        for feature in features:
+            feature.flush()
+        del features
+
+        targets = np.concatenate(targets) if targets else np.zeros((0, 6), dtype=np.float32)
+        target_offsets = np.searchsorted(targets[:, 0], np.arange(n + 1)).astype(np.int64)
+        np.save(os.path.join(tmp_path, "targets.npy"), targets)
+        np.save(os.path.join(tmp_path, "target_offsets.npy"), target_offsets)
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+            json.dump({"paths" : paths, "key" : self.key, "img_size" : int(images.shape[2])}, file)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp_path, self.path)
+
+    def disk_footprint(self):
+        return sum(os.path.getsize(os.path.join(self.path, f)) for f in os.listdir(self.path))
+
+    def feature_dataset(self):
+        return FeatureDataset(self.path)
+
+
+class FeatureDataset(Dataset):
+    """
+    Returns (path, (x5, x4, x3), targets) from FeatureStore, features are fp16.
+    Use YOLOv4.forward_features to run neck and head on them.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, "meta.json")) as file:
+            meta = json.load(file)
+
+        self.img_files = meta["paths"]
+        self.img_size = meta["img_size"]
+        self.features = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r") for name in FEATURE_NAMES]
+        self.targets = np.load(os.path.join(path, "targets.npy"))
+        self.target_offsets = np.load(os.path.join(path, "target_offsets.npy"))
+
+    def __getitem__(self, index):
+        features = tuple(torch.from_numpy(np.array(feature[index])) for feature in self.features)
+        targets = torch.from_numpy(self.targets[self.target_offsets[index]:self.target_offsets[index + 1]].copy())
+        return self.img_files[index], features, targets
+
+    def collate_fn(self, batch):
+        paths, features, targets = list(zip(*batch))
+        # Add sample index to targets
+        for i, boxes in enumerate(targets):
+            boxes[:, 0] = i
+        targets = torch.cat(targets, 0)
+
+        features = tuple(torch.stack(level) for level in zip(*features))
+        return paths, features, targets
+
+    def __len__(self):
+        return len(self.img_files)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from dataset import ListDataset
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Precompute backbone features and compare epoch time of frozen-backbone training")
+    parser.add_argument("list_path", help="txt file with image paths (training set)")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--n_classes", type=int, default=80)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--root", default="features")
+    parser.add_argument("--bs", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = YOLOv4(n_classes=args.n_classes, weights_path=args.weights, img_dim=args.img_size).to(device)
+    model.freeze_backbone()
+    ds = ListDataset(args.list_path, img_size=args.img_size, train=False)
+    store = FeatureStore(args.root, model, ds)
+
+    if not store.exists():
+        t0 = time.time()
+        store.build(model, batch_size=args.bs, num_workers=args.workers, device=device)
+        print(f"Built feature store in {time.time() - t0:.1f}s")
+    print(f"Disk footprint: {store.disk_footprint() / 2**30:.2f} GiB ({store.disk_footprint() / len(ds) / 2**20:.2f} MiB per image)")
+
+    params = [p for p in model.parameters() if p.requires_grad]
+    optimizer = torch.optim.SGD(params, lr=1e-4)
+    model.train()
+
+    def run_epoch(dl, from_features):
+        t0 = time.time()
+        for paths, x, y in dl:
+            if from_features:
+                x = tuple(level.to(device).float() for level in x)
+                _, loss = model.forward_features(x, y.to(device))
+            else:
+                _, loss = model(x.to(device), y.to(device))
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return time.time() - t0
+
+    feature_ds = store.feature_dataset()
+    full_time = run_epoch(DataLoader(ds, batch_size=args.bs, num_workers=args.workers, collate_fn=ds.collate_fn), False)
+    cached_time = run_epoch(DataLoader(feature_ds, batch_size=args.bs, num_workers=args.workers, collate_fn=feature_ds.collate_fn), True)
+    print(f"Epoch with backbone forward: {full_time:.1f}s, from cached features: {cached_time:.1f}s, speedup {full_time / cached_time:.2f}x")
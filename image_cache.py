@@ -0,0 +1,138 @@
+import json
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+import torchvision.transforms as transforms
+
+
+def resized_shape(width, height, img_size):
+    """
+    Size of image resized to img_size on the long side (aspect preserved): (t_width, t_height, ratio of short side to long side)
+    """
+    if width > height:
+        ratio = height/width
+        t_width = img_size
+        t_height = int(ratio * img_size)
+    else:
+        ratio = width/height
+        t_width = int(ratio * img_size)
+        t_height = img_size
+    return t_width, t_height, ratio
+
+
+def image_mtime(img_path):
+    try:
+        return os.stat(img_path).st_mtime
+    except FileNotFoundError:
+        return -1.0
+
+
+class ImageCache:
+    """
+    Every image decoded once, resized to img_size on the long side and stored as uint8 HWC RGB in one memory-mapped file.
+    Table has offset, height, width, original width and original height of every image.
+    Cache is rebuilt when image list, img_size or mtime of any image changes.
+    Args:
+        img_files (list): image paths
+        path (str): folder of the cache
+        img_size (int): long side of stored images
+        workers (int): threads used to decode images (PIL releases GIL while decoding and resizing)
+    """
+    def __init__(self, img_files, path, img_size=608, workers=8):
+        self.img_files = img_files
+        self.path = path
+        self.img_size = img_size
+        self.workers = workers
+
+        self._data = None
+        self._table = None
+
+        mtimes = self.current_mtimes()
+        if not self.is_valid(mtimes):
+            self.build(mtimes)
+
+    def current_mtimes(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            return np.array(list(pool.map(image_mtime, self.img_files)), dtype=np.float64)
+
+    def is_valid(self, mtimes):
+        try:
+            with open(os.path.join(self.path, "meta.json")) as file:
+                meta = json.load(file)
+            stored_mtimes = np.load(os.path.join(self.path, "mtimes.npy"))
+        except (FileNotFoundError, ValueError):
+            return False
+        return meta["img_size"] == self.img_size and meta["files"] == self.img_files and np.array_equal(stored_mtimes, mtimes)
+
+    def build(self, mtimes):
+        def original_size(img_path):
+            with Image.open(img_path) as img: #Only header is read
+                return img.size
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            sizes = list(pool.map(original_size, self.img_files))
+
+        table = np.zeros((len(self.img_files), 5), dtype=np.int64)
+        offset = 0
+        for i, (width, height) in enumerate(sizes):
+            t_width, t_height, _ = resized_shape(width, height, self.img_size)
+            table[i] = offset, t_height, t_width, width, height
+            offset += t_height * t_width * 3
+
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        data = np.memmap(os.path.join(tmp_path, "images.u8"), dtype=np.uint8, mode="w+", shape=(max(offset, 1),))
+
+        def store(i):
+            start, t_height, t_width = table[i, :3]
+            img = Image.open(self.img_files[i]).convert('RGB')
+            img = transforms.functional.resize(img, (int(t_height), int(t_width)))
+            data[start:start + t_height * t_width * 3] = np.asarray(img).reshape(-1)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            list(pool.map(store, range(len(self.img_files))))
+        data.flush()
+        del data
+
+        np.save(os.path.join(tmp_path, "table.npy"), table)
+        np.save(os.path.join(tmp_path, "mtimes.npy"), mtimes)
+        # Written last, cache without it is never valid
+        with open(os.path.join(tmp_path, "meta.json"), "w") as file:
+            json.dump({"img_size" : self.img_size, "files" : self.img_files}, file)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp_path, self.path)
+
+    def _load(self):
+        # Memory map is opened lazily, so every dataloader worker opens its own instead of getting a pickled copy.
+        # Copy on write: tensors made from its views are writable, but writes stay in memory of the process and never reach the file
+        self._data = np.memmap(os.path.join(self.path, "images.u8"), dtype=np.uint8, mode="c")
+        self._table = np.load(os.path.join(self.path, "table.npy"))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        state["_table"] = None
+        return state
+
+    def get(self, index):
+        """
+        Returns (HWC uint8 view of the stored image, original width, original height)
+        """
+        if self._data is None:
+            self._load()
+        start, t_height, t_width, width, height = self._table[index]
+        arr = self._data[start:start + t_height * t_width * 3].reshape(t_height, t_width, 3)
+        return arr, int(width), int(height)
+
+    def original_sizes(self):
+        if self._table is None:
+            self._load()
+        return [(int(width), int(height)) for width, height in self._table[:, 3:5]]
+
+    def __len__(self):
+        return len(self.img_files)
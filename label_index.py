@@ -0,0 +1,141 @@
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+
+def label_mtime(label_path):
+    try:
+        return os.stat(label_path).st_mtime
+    except FileNotFoundError:
+        return -1.0
+
+
+def read_labels(label_path):
+    """
+    Parses and validates YOLO label file (class x y w h per line, coordinates relative).
+    Returns (boxes [N, 5] float32, list of problems). Missing file means no boxes.
+    """
+    if not os.path.exists(label_path):
+        return np.zeros((0, 5), dtype=np.float32), []
+
+    with open(label_path, "r") as file:
+        rows = [line.split() for line in file.read().splitlines() if line.strip()]
+
+    problems = []
+    valid_rows = []
+    for n, row in enumerate(rows):
+        if len(row) != 5:
+            problems.append(f"{label_path}:{n + 1} has {len(row)} values instead of 5")
+            continue
+        try:
+            values = [float(v) for v in row]
+        except ValueError:
+            problems.append(f"{label_path}:{n + 1} is not numeric")
+            continue
+
+        cls, x, y, w, h = values
+        if cls < 0 or cls != int(cls):
+            problems.append(f"{label_path}:{n + 1} has bad class {row[0]}")
+        elif not (0 <= x <= 1 and 0 <= y <= 1 and 0 < w <= 1 and 0 < h <= 1):
+            problems.append(f"{label_path}:{n + 1} has box outside of the image {row[1:]}")
+        else:
+            valid_rows.append(values)
+
+    return np.array(valid_rows, dtype=np.float32).reshape(-1, 5), problems
+
+
+class LabelIndex:
+    """
+    All label boxes of a dataset in one contiguous float32 array + offsets array, saved as .npy and memory-mapped.
+    Boxes of image i are boxes[offsets[i]:offsets[i + 1]].
+    Index is rebuilt when list of label files or mtime of any of them changes.
+    Args:
+        label_files (list): label path of every image
+        path (str): folder of the index
+        workers (int): processes used to parse label files
+        strict (bool): raise ValueError on invalid labels, otherwise invalid rows are dropped with warning
+    """
+    def __init__(self, label_files, path, workers=8, strict=False):
+        self.label_files = label_files
+        self.path = path
+        self.workers = workers
+        self.strict = strict
+
+        self._boxes = None
+        self._offsets = None
+
+        mtimes = self.current_mtimes()
+        if not self.is_valid(mtimes):
+            self.build(mtimes)
+
+    def current_mtimes(self):
+        with ThreadPoolExecutor(self.workers) as pool:
+            return np.array(list(pool.map(label_mtime, self.label_files, chunksize=1024)), dtype=np.float64)
+
+    def is_valid(self, mtimes):
+        try:
+            with open(os.path.join(self.path, "files.json")) as file:
+                files = json.load(file)
+            stored_mtimes = np.load(os.path.join(self.path, "mtimes.npy"))
+        except (FileNotFoundError, ValueError):
+            return False
+        return files == self.label_files and np.array_equal(stored_mtimes, mtimes)
+
+    def build(self, mtimes):
+        if self.workers > 1:
+            with ProcessPoolExecutor(self.workers) as pool:
+                results = list(pool.map(read_labels, self.label_files, chunksize=256))
+        else:
+            results = [read_labels(path) for path in self.label_files]
+
+        problems = [problem for _, file_problems in results for problem in file_problems]
+        if problems:
+            if self.strict:
+                raise ValueError(f"{len(problems)} invalid labels, first: " + "; ".join(problems[:10]))
+            print(f"[Warning] Dropped {len(problems)} invalid label rows, first: " + "; ".join(problems[:10]))
+
+        counts = np.array([len(boxes) for boxes, _ in results], dtype=np.int64)
+        offsets = np.zeros(len(results) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        boxes = np.concatenate([boxes for boxes, _ in results]) if results else np.zeros((0, 5), dtype=np.float32)
+
+        tmp_path = self.path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        np.save(os.path.join(tmp_path, "boxes.npy"), boxes)
+        np.save(os.path.join(tmp_path, "offsets.npy"), offsets)
+        np.save(os.path.join(tmp_path, "mtimes.npy"), mtimes)
+        # Written last, index without it is never valid
+        with open(os.path.join(tmp_path, "files.json"), "w") as file:
+            json.dump(self.label_files, file)
+
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(tmp_path, self.path)
+
+    def _load(self):
+        # Memory maps are opened lazily, so every dataloader worker opens its own instead of getting a pickled copy
+        try:
+            self._boxes = np.load(os.path.join(self.path, "boxes.npy"), mmap_mode="r")
+        except ValueError: #Empty array can not be memory-mapped
+            self._boxes = np.load(os.path.join(self.path, "boxes.npy"))
+        self._offsets = np.load(os.path.join(self.path, "offsets.npy"))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_boxes"] = None
+        state["_offsets"] = None
+        return state
+
+    def boxes(self, index):
+        """
+        Read-only [N, 5] float32 view of boxes of image
+        """
+        if self._boxes is None:
+            self._load()
+        return self._boxes[self._offsets[index]:self._offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.label_files)
@@ -0,0 +1,165 @@
+import queue
+import threading
+
+import cv2
+import numpy as np
+import torch
+
+import utils
+
+
+class LetterboxBuffer:
+    """
+    Preallocated batch of letterboxed images (the same letterbox as ListDataset does for validation: centered, zero padding).
+    put() resizes uint8 HWC frame into a reused staging array and writes it into its slot of the batch with channel swap,
+    layout change and scaling in one pass, only padding around the image is cleared. Nothing is allocated per frame.
+    Every thread has its own staging array, so threads may put frames into different slots at once.
+    Args:
+        batch_size (int): slots
+        img_size (int or (height, width)): canvas
+        dtype: torch.float32 / float16 (scaled to 0-1) or torch.uint8 (YOLOv4 converts it on its device)
+        pin_memory (bool): pinned buffer for asynchronous copy to GPU
+        fill (float): value of padding
+    Usage:
+        buffer.put(i, frame) for every frame, anchors, _ = model(buffer.batch(n).to(device, non_blocking=True)),
+        bboxes, labels = utils.get_bboxes_from_anchors(anchors, ...), buffer.unletterbox(i, bboxes[i]) are boxes in pixels of frame i
+    """
+    def __init__(self, batch_size, img_size, dtype=torch.float32, pin_memory=False, fill=0.0):
+        self.canvas_h, self.canvas_w = (img_size, img_size) if isinstance(img_size, int) else img_size
+        self.buffer = torch.full((batch_size, 3, self.canvas_h, self.canvas_w), fill, dtype=dtype)
+        if pin_memory and torch.cuda.is_available():
+            self.buffer = self.buffer.pin_memory()
+        self.scale = 1 / 255 if dtype.is_floating_point else 1
+        self.fill = fill
+
+        # Pad x, pad y, width, height of the image inside canvas (as ListDataset returns for aspect ratio buckets) and size of frame
+        self.padding = torch.zeros(batch_size, 4)
+        self.sizes = torch.zeros(batch_size, 2)
+
+        self.local = threading.local()
+
+    def staging(self):
+        if not hasattr(self.local, "staging"):
+            self.local.staging = np.empty(self.canvas_h * self.canvas_w * 3, dtype=np.uint8)
+        return self.local.staging
+
+    def put(self, i, frame, bgr=True):
+        """
+        Letterboxes uint8 HWC frame (BGR as OpenCV gives, or RGB with bgr=False) into slot i, returns its padding
+        """
+        h, w = frame.shape[:2]
+        scale = min(self.canvas_h / h, self.canvas_w / w)
+        t_w, t_h = min(self.canvas_w, max(1, int(w * scale))), min(self.canvas_h, max(1, int(h * scale)))
+        pad_x, pad_y = (self.canvas_w - t_w) // 2, (self.canvas_h - t_h) // 2
+
+        # Contiguous view of the staging array, so cv2 writes into it instead of allocating
+        sized = self.staging()[:t_h * t_w * 3].reshape(t_h, t_w, 3)
+        cv2.resize(frame, (t_w, t_h), dst=sized, interpolation=cv2.INTER_LINEAR)
+        src = torch.from_numpy(sized)
+
+        slot = self.buffer[i]
+        for c in range(3):
+            out = slot[c, pad_y:pad_y + t_h, pad_x:pad_x + t_w]
+            channel = src[:, :, 2 - c if bgr else c]
+            if self.scale == 1:
+                out.copy_(channel)
+            else:
+                torch.mul(channel, self.scale, out=out)
+
+        #PADDING OF THE PREVIOUS FRAME
+        slot[:, :pad_y] = self.fill
+        slot[:, pad_y + t_h:] = self.fill
+        slot[:, pad_y:pad_y + t_h, :pad_x] = self.fill
+        slot[:, pad_y:pad_y + t_h, pad_x + t_w:] = self.fill
+
+        self.padding[i] = torch.tensor([pad_x, pad_y, t_w, t_h], dtype=torch.float32)
+        self.sizes[i] = torch.tensor([w, h], dtype=torch.float32)
+        return self.padding[i]
+
+    def batch(self, n=None):
+        """
+        First n slots (all by default), a view of the buffer
+        """
+        return self.buffer if n is None else self.buffer[:n]
+
+    def unletterbox(self, i, bboxes):
+        """
+        Boxes of slot i from utils.get_bboxes_from_anchors (x, y, w, h in pixels of canvas, other columns are kept)
+        -> x1, y1, x2, y2 in pixels of the frame
+        """
+        return unletterbox_bboxes(bboxes, self.padding[i], self.sizes[i])
+
+
+class LetterboxPool:
+    """
+    Slots of a LetterboxBuffer shared by producer threads, so frames are letterboxed in parallel where they come from
+    and the thread running the model only gathers slots of a batch (one memory copy).
+    put(frame) waits for a free slot (backpressure), letterboxes the frame into it and returns the slot,
+    gather(slots, out) copies them into a batch tensor and frees them, release(slots) frees slots which never reach a batch.
+    Args:
+        slots (int): frames which can be letterboxed and waiting for their batch at once
+        img_size (int or (height, width)): canvas
+        dtype: of LetterboxBuffer
+    """
+    def __init__(self, slots, img_size, dtype=torch.uint8):
+        self.buffer = LetterboxBuffer(slots, img_size, dtype=dtype)
+        self.free = queue.Queue()
+        for i in range(slots):
+            self.free.put(i)
+
+    def new_batch(self, batch_size, pin_memory=False):
+        """
+        Batch tensor for gather(), pinned for asynchronous copy to GPU
+        """
+        batch = torch.empty((batch_size,) + tuple(self.buffer.buffer.shape[1:]), dtype=self.buffer.buffer.dtype)
+        return batch.pin_memory() if pin_memory and torch.cuda.is_available() else batch
+
+    def put(self, frame, bgr=True):
+        slot = self.free.get()
+        try:
+            self.buffer.put(slot, frame, bgr)
+        except Exception:
+            self.free.put(slot)
+            raise
+        return slot
+
+    def gather(self, slots, out):
+        """
+        Copies slots into the first len(slots) images of out and frees them. Returns (batch, padding, sizes) as LetterboxBuffer has them
+        """
+        index = torch.tensor(slots, dtype=torch.long)
+        batch = out[:len(slots)]
+        torch.index_select(self.buffer.buffer, 0, index, out=batch)
+        padding, sizes = self.buffer.padding[index], self.buffer.sizes[index]
+        self.release(slots)
+        return batch, padding, sizes
+
+    def release(self, slots):
+        for slot in slots:
+            self.free.put(slot)
+
+
+def unletterbox_bboxes(bboxes, padding, size):
+    """
+    Boxes from utils.get_bboxes_from_anchors (x, y, w, h in pixels of canvas, other columns are kept) -> x1, y1, x2, y2 in pixels of the frame.
+    padding and size (width, height) are LetterboxBuffer.padding[i] and sizes[i] of the frame (copies, if the slot is reused meanwhile)
+    """
+    bboxes = bboxes.float().cpu().clone()
+    bboxes[:, :4] = utils.xywh2xyxy(bboxes[:, :4])
+    return utils.unletterbox(bboxes, padding, size.tolist())
+
+
+def letterbox_reference(frame, img_size):
+    """
+    The same letterbox step by step (resize, cvtColor, new tensor, permute, float, / 255, pad), as inference code does without LetterboxBuffer
+    """
+    h, w = frame.shape[:2]
+    scale = min(img_size / h, img_size / w)
+    t_w, t_h = max(1, int(w * scale)), max(1, int(h * scale))
+    sized = cv2.resize(frame, (t_w, t_h))
+    sized = cv2.cvtColor(sized, cv2.COLOR_BGR2RGB)
+    x = torch.from_numpy(sized).permute(2, 0, 1).float() / 255
+    padded = x.new_zeros(3, img_size, img_size)
+    pad_x, pad_y = (img_size - t_w) // 2, (img_size - t_h) // 2
+    padded[:, pad_y:pad_y + t_h, pad_x:pad_x + t_w] = x
+    return padded
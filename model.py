@@ -386,13 +386,16 @@ class YOLOLayer(nn.Module):
             self.grid_size = 0  # grid size
 
     def compute_grid_offsets(self, grid_size, cuda=True):
+        # Grid can be rectangular (height, width) for aspect ratio bucketed batches, img_dim is height of input then
+        if isinstance(grid_size, int):
+            grid_size = (grid_size, grid_size)
         self.grid_size = grid_size
-        g = self.grid_size
+        g_h, g_w = self.grid_size
         FloatTensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
-        self.stride = self.img_dim / self.grid_size
+        self.stride = self.img_dim / g_h
         # Calculate offsets for each grid
-        self.grid_x = torch.arange(g).repeat(g, 1).view([1, 1, g, g]).type(FloatTensor)
-        self.grid_y = torch.arange(g).repeat(g, 1).t().view([1, 1, g, g]).type(FloatTensor)
+        self.grid_x = torch.arange(g_w).repeat(g_h, 1).view([1, 1, g_h, g_w]).type(FloatTensor)
+        self.grid_y = torch.arange(g_h).repeat(g_w, 1).t().view([1, 1, g_h, g_w]).type(FloatTensor)
         self.scaled_anchors = FloatTensor([(a_w / self.stride, a_h / self.stride) for a_w, a_h in self.anchors])
         self.anchor_w = self.scaled_anchors[:, 0:1].view((1, self.num_anchors, 1, 1))
         self.anchor_h = self.scaled_anchors[:, 1:2].view((1, self.num_anchors, 1, 1))
@@ -405,37 +408,45 @@ class YOLOLayer(nn.Module):
         nB = pred_boxes.size(0)
         nA = pred_boxes.size(1)
         nC = pred_cls.size(-1)  
-        nG = pred_boxes.size(2)
+        nGy = pred_boxes.size(2)
+        nGx = pred_boxes.size(3)
 
         # Output tensors
-        obj_mask = ByteTensor(nB, nA, nG, nG).fill_(0)
-        noobj_mask = ByteTensor(nB, nA, nG, nG).fill_(1)
-        class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
-        iou = FloatTensor(nB, nA, nG, nG).fill_(0)
-        tx = FloatTensor(nB, nA, nG, nG).fill_(0)
-        ty = FloatTensor(nB, nA, nG, nG).fill_(0)
-        tw = FloatTensor(nB, nA, nG, nG).fill_(0)
-        th = FloatTensor(nB, nA, nG, nG).fill_(0)
-        tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
-
-        target_boxes_grid = FloatTensor(nB, nA, nG, nG, 4).fill_(0)
+        obj_mask = ByteTensor(nB, nA, nGy, nGx).fill_(0)
+        noobj_mask = ByteTensor(nB, nA, nGy, nGx).fill_(1)
+        class_mask = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        iou = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        tx = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        ty = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        tw = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        th = FloatTensor(nB, nA, nGy, nGx).fill_(0)
+        tcls = FloatTensor(nB, nA, nGy, nGx, nC).fill_(0)
+
+        target_boxes_grid = FloatTensor(nB, nA, nGy, nGx, 4).fill_(0)
 
         # 2 3 xy
         # 4 5 wh
         # Convert to position relative to box
-        target_boxes = target[:, 2:6] * nG
+        target_boxes = target[:, 2:6] * FloatTensor([nGx, nGy, nGx, nGy])
         gxy = target_boxes[:, :2]
         gwh = target_boxes[:, 2:]
 
-        # Get anchors with best iou
-        ious = torch.stack([self.bbox_wh_iou(anchor, gwh) for anchor in anchors])
-        best_ious, best_n = ious.max(0)
+        if target.size(1) > 6:
+            # Anchor and grid cell assignment was precomputed in dataloader workers (targets.TargetAssigner)
+            best_n = target[:, 6].long()
+            gi, gj = target[:, 7:9].long().t()
+            ignore = ((target[:, 9].long()[:, None] >> torch.arange(nA, device=target.device)) & 1).bool()
+        else:
+            # Get anchors with best iou
+            ious = torch.stack([self.bbox_wh_iou(anchor, gwh) for anchor in anchors])
+            best_ious, best_n = ious.max(0)
+            gi, gj = gxy.long().t()
+            ignore = ious.t() > ignore_thres
 
         # Separate target values
         b, target_labels = target[:, :2].long().t()
         gx, gy = gxy.t()
         gw, gh = gwh.t()
-        gi, gj = gxy.long().t()
 
         #Setting target boxes to big grid, it would be used to count loss
         target_boxes_grid[b, best_n, gj, gi] = target_boxes
@@ -446,8 +457,8 @@ class YOLOLayer(nn.Module):
 
 
         # Set noobj mask to zero where iou exceeds ignore threshold
-        for i, anchor_ious in enumerate(ious.t()):
-            noobj_mask[b[i], anchor_ious > ignore_thres, gj[i], gi[i]] = 0
+        ignore_target, ignore_anchor = ignore.nonzero(as_tuple=True)
+        noobj_mask[b[ignore_target], ignore_anchor, gj[ignore_target], gi[ignore_target]] = 0
 
         # Coordinates
         tx[b, best_n, gj, gi] = gx - gx.floor()
@@ -535,17 +546,17 @@ class YOLOLayer(nn.Module):
         return xc1, yc1, xc2, yc2
 
 
-    def forward(self, x, targets=None):
+    def forward(self, x, targets=None, img_dim=None):
         # Tensors for cuda support
         FloatTensor = torch.cuda.FloatTensor if x.is_cuda else torch.FloatTensor
         LongTensor = torch.cuda.LongTensor if x.is_cuda else torch.LongTensor
         ByteTensor = torch.cuda.ByteTensor if x.is_cuda else torch.ByteTensor
 
         num_samples = x.size(0)
-        grid_size = x.size(2)
+        grid_size = (x.size(2), x.size(3))
 
         prediction = (
-            x.view(num_samples, self.num_anchors, self.num_classes + 5, grid_size, grid_size)
+            x.view(num_samples, self.num_anchors, self.num_classes + 5, *grid_size)
             .permute(0, 1, 3, 4, 2)
             .contiguous()
         )
@@ -558,6 +569,11 @@ class YOLOLayer(nn.Module):
         pred_conf = torch.sigmoid(prediction[..., 4])  # Conf
         pred_cls = torch.sigmoid(prediction[..., 5:])  # Cls pred.
 
+        # Input resolution can change between batches (multi-scale training), stride has to follow it
+        if img_dim is not None and img_dim != self.img_dim:
+            self.img_dim = img_dim
+            self.grid_size = 0
+
         # If grid size does not match current we compute new offsets
         if grid_size != self.grid_size or self.grid_x.is_cuda != x.is_cuda:
             self.compute_grid_offsets(grid_size, cuda=x.is_cuda)
@@ -640,6 +656,7 @@ class YOLOv4(nn.Module):
         self.img_dim = img_dim
 
         self.backbone = Backbone(in_channels)
+        self.backbone_frozen = False
 
         self.neck = Neck()
 
@@ -660,18 +677,55 @@ class YOLOv4(nn.Module):
             except RuntimeError as e:
                 print(f'[Warning] Ignoring {e}')
 
-
+    def freeze_backbone(self, freeze=True):
+        # Frozen backbone also stays in eval mode, so batchnorm statistics and dropblock do not change it
+        self.backbone.requires_grad_(not freeze)
+        self.backbone.train(self.training and not freeze)
+        self.backbone_frozen = freeze
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.backbone_frozen:
+            self.backbone.eval()
+        return self
+
+    def split_targets(self, y):
+        # Targets from targets.TargetAssigner have 4 precomputed assignment columns for every yolo layer after the 6 usual ones
+        if y is None or y.size(1) == 6:
+            return y, y, y
+        return tuple(torch.cat([y[:, :6], y[:, 6 + 4 * i : 10 + 4 * i]], 1) for i in range(3))
+
+    @staticmethod
+    def prepare_input(x):
+        # uint8 batches (ListDataset(uint8=True)) are converted to float once, on the device they were moved to
+        if x.dtype == torch.uint8:
+            return x.float().div_(255)
+        return x
 
     def forward(self, x, y=None):
+        x = self.prepare_input(x)
         b = self.backbone(x)
+        return self.forward_features(b, y, x.size(2))
+
+    def forward_features(self, b, y=None, img_dim=None):
+        """
+        Neck, head and yolo layers on backbone outputs (x5, x4, x3).
+        Used directly when backbone features are cached (feature_cache.py)
+        """
+        if img_dim is None:
+            #x3 is downsampled 8 times
+            img_dim = b[2].size(2) * 8
+
         n = self.neck(b)
         h = self.head(n)
 
         h1, h2, h3 = h
 
-        out1, loss1 = self.yolo1(h1, y)
-        out2, loss2 = self.yolo2(h2, y)
-        out3, loss3 = self.yolo3(h3, y)
+        y1, y2, y3 = self.split_targets(y)
+
+        out1, loss1 = self.yolo1(h1, y1, img_dim)
+        out2, loss2 = self.yolo2(h2, y2, img_dim)
+        out3, loss3 = self.yolo3(h3, y3, img_dim)
 
         out1 = out1.detach()
         out2 = out2.detach()
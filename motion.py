@@ -0,0 +1,238 @@
+import cv2
+import numpy as np
+import torch
+
+
+class MotionGate:
+    """
+    Cheap change detection: frame is downsampled to `width` pixels, blurred and compared with the last frame which passed the gate.
+    Args:
+        width (int): width of the downsampled grayscale frame
+        pixel_threshold (int): difference of a pixel (0-255), which counts as change
+        area_threshold (float): share of changed pixels, which opens the gate
+        max_skip (int): frames in a row which may be skipped, then the gate opens anyway (slow light changes, safety)
+        region_padding (float): changed regions are padded by this share of their size
+    Calling it with BGR frame returns (changed, regions [K, 4] x1, y1, x2, y2 in pixels of frame). Counters: processed, skipped.
+    check() and commit() split the call, when detections of an opened frame arrive later (and may never arrive).
+    """
+    def __init__(self, width=128, pixel_threshold=25, area_threshold=0.001, max_skip=150, region_padding=0.25):
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.area_threshold = area_threshold
+        self.max_skip = max_skip
+        self.region_padding = region_padding
+
+        self.reference = None
+        self.skipped_in_row = 0
+        self.processed = 0
+        self.skipped = 0
+
+    def small(self, frame):
+        h, w = frame.shape[:2]
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        small = cv2.resize(gray, (self.width, max(1, round(h * self.width / w))), interpolation=cv2.INTER_AREA)
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    def regions(self, mask, frame_shape):
+        # Bounding boxes of connected changed areas, scaled to the frame and padded
+        mask = cv2.dilate(mask.astype(np.uint8), np.ones((3, 3), np.uint8))
+        n, _, stats, _ = cv2.connectedComponentsWithStats(mask)
+        boxes = stats[1:, :4].astype(np.float32)
+        boxes[:, 2:] += boxes[:, :2]
+
+        h, w = frame_shape[:2]
+        boxes *= np.array([w, h, w, h], dtype=np.float32) / np.array([mask.shape[1], mask.shape[0]] * 2, dtype=np.float32)
+        pad = (boxes[:, 2:] - boxes[:, :2]) * self.region_padding
+        boxes[:, :2] -= pad
+        boxes[:, 2:] += pad
+        boxes[:, 0::2] = boxes[:, 0::2].clip(0, w)
+        boxes[:, 1::2] = boxes[:, 1::2].clip(0, h)
+        return torch.from_numpy(boxes)
+
+    def check(self, frame):
+        """
+        Like calling the gate, but the reference stays: returns (changed, regions, small).
+        Pass small of a changed frame to commit() once its detections exist, until then the following frames open the gate too.
+        """
+        small = self.small(frame)
+        if self.reference is None or self.reference.shape != small.shape or self.skipped_in_row >= self.max_skip:
+            mask = np.ones(small.shape, dtype=bool)
+        else:
+            mask = cv2.absdiff(small, self.reference) > self.pixel_threshold
+
+        if mask.mean() < self.area_threshold:
+            self.skipped += 1
+            self.skipped_in_row += 1
+            return False, torch.zeros(0, 4), small
+
+        self.processed += 1
+        return True, self.regions(mask, frame.shape), small
+
+    def commit(self, small):
+        # Following frames are compared with this one
+        self.reference = small
+        self.skipped_in_row = 0
+
+    def __call__(self, frame):
+        changed, regions, small = self.check(frame)
+        if changed:
+            self.commit(small)
+        return changed, regions
+
+    def stats(self):
+        return {"processed" : self.processed, "skipped" : self.skipped}
+
+
+def merge_regions(boxes):
+    """
+    Replaces overlapping boxes [K, 4] (x1, y1, x2, y2) with their union until none of them overlap
+    """
+    boxes = boxes.tolist()
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = [min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3])]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return torch.tensor(boxes, dtype=torch.long).reshape(-1, 4)
+
+
+class GatedDetector:
+    """
+    Skips detector on frames, which MotionGate finds static, and returns the previous detections.
+    With crops, changed regions (if they cover less than max_crop_area of the frame) are detected separately:
+    detections of the previous frame outside of them are kept, the ones inside are replaced.
+    Args:
+        detect: function(frame) -> [N, 4 + 1 + n_classes] x1, y1, x2, y2 in pixels of frame, confidence, class probabilities
+        gate (MotionGate)
+        crops (bool): detect only in changed regions
+        min_crop (int): smaller regions are grown to this size in pixels (tiny upscaled crops give false detections)
+        max_crop_area (float): regions covering more of the frame run detection on the whole frame
+    Counters: full (whole frame detections), crop_runs (detector calls on crops), gate.skipped
+    """
+    def __init__(self, detect, gate=None, crops=False, min_crop=160, max_crop_area=0.5):
+        self.detect = detect
+        self.gate = gate or MotionGate()
+        self.crops = crops
+        self.min_crop = min_crop
+        self.max_crop_area = max_crop_area
+        self.previous = None
+        self.full = 0
+        self.crop_runs = 0
+
+    def grow(self, regions, w, h):
+        centers = (regions[:, :2] + regions[:, 2:]) / 2
+        sizes = (regions[:, 2:] - regions[:, :2]).clamp(min=self.min_crop)
+        sizes = torch.minimum(sizes, torch.tensor([w, h], dtype=sizes.dtype))
+        x1y1 = torch.minimum((centers - sizes / 2).clamp(min=0), torch.tensor([w, h], dtype=sizes.dtype) - sizes)
+        return torch.cat([x1y1, x1y1 + sizes], 1).round().long()
+
+    def __call__(self, frame):
+        changed, regions = self.gate(frame)
+        if not changed and self.previous is not None:
+            return self.previous
+
+        h, w = frame.shape[:2]
+        area = ((regions[:, 2] - regions[:, 0]) * (regions[:, 3] - regions[:, 1])).sum() / (w * h)
+        if not self.crops or self.previous is None or area > self.max_crop_area:
+            self.previous = self.detect(frame)
+            self.full += 1
+            return self.previous
+
+        regions = merge_regions(self.grow(regions, w, h))
+        # Previous detections, which are not inside of changed regions (their center), stay
+        centers = (self.previous[:, :2] + self.previous[:, 2:4]) / 2
+        inside = ((centers[:, None] >= regions[None, :, :2]) & (centers[:, None] <= regions[None, :, 2:])).all(2).any(1)
+        detections = [self.previous[~inside]]
+        for x1, y1, x2, y2 in regions.tolist():
+            crop_detections = self.detect(np.ascontiguousarray(frame[y1:y2, x1:x2])).clone()
+            crop_detections[:, 0:4:2] += x1
+            crop_detections[:, 1:4:2] += y1
+            detections.append(crop_detections.to(self.previous.dtype))
+            self.crop_runs += 1
+        self.previous = torch.cat(detections)
+        return self.previous
+
+    def stats(self):
+        return dict(self.gate.stats(), full=self.full, crop_runs=self.crop_runs)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import utils
+    from letterbox import LetterboxBuffer
+    from model import YOLOv4
+    from tracker import agreement
+
+    parser = argparse.ArgumentParser(description="Frames skipped by motion gating, fps and agreement with detection on every frame")
+    parser.add_argument("--video", default=None, help="recorded clip, without it a synthetic mostly static one is used")
+    parser.add_argument("--frames", type=int, default=60, help="frames of synthetic clip")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--img_size", type=int, default=416)
+    parser.add_argument("--confidence_threshold", type=float, default=0.4)
+    parser.add_argument("--iou_threshold", type=float, default=0.5)
+    parser.add_argument("--pixel_threshold", type=int, default=25)
+    parser.add_argument("--area_threshold", type=float, default=0.001)
+    args = parser.parse_args()
+
+    if args.video is not None:
+        cap = cv2.VideoCapture(args.video)
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+        cap.release()
+    else:
+        # Static noisy scene, an object crosses it in the middle third of the clip
+        rng = np.random.RandomState(0)
+        background = cv2.GaussianBlur(rng.randint(0, 255, (720, 1280, 3), dtype=np.uint8), (0, 0), 5)
+        frames = []
+        for t in range(args.frames):
+            frame = np.clip(background.astype(np.int16) + rng.randint(-4, 5, background.shape), 0, 255).astype(np.uint8)
+            if args.frames // 3 <= t < 2 * args.frames // 3:
+                x = 100 + 20 * (t - args.frames // 3)
+                cv2.rectangle(frame, (x, 300), (x + 120, 500), (0, 0, 255), -1)
+            frames.append(frame)
+
+    #STATIC FRAMES ARE SKIPPED, MOVING OBJECT OPENS THE GATE
+    gate = MotionGate(pixel_threshold=args.pixel_threshold, area_threshold=args.area_threshold)
+    opened = [gate(frame)[0] for frame in frames]
+    if args.video is None:
+        third = args.frames // 3
+        assert opened[0] and not any(opened[1:third]) and all(opened[third:2 * third]), "Gate does not follow the synthetic object"
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    m = YOLOv4(weights_path=args.weights).eval().to(device)
+    buffer = LetterboxBuffer(1, args.img_size, pin_memory=True)
+
+    @torch.no_grad()
+    def detect(frame):
+        buffer.put(0, frame)
+        anchors, _ = m(buffer.batch().to(device, non_blocking=True))
+        bboxes, _ = utils.get_bboxes_from_anchors(anchors, args.confidence_threshold, args.iou_threshold, {}.fromkeys(range(anchors.size(2) - 5), ""))
+        return buffer.unletterbox(0, bboxes[0])
+
+    detect(frames[0])
+    t0 = time.time()
+    per_frame = [detect(frame) for frame in frames]
+    base_fps = len(frames) / (time.time() - t0)
+    print(f"{len(frames)} frames, detection on every frame: {base_fps:.1f} fps")
+
+    for crops in (False, True):
+        gated = GatedDetector(detect, MotionGate(pixel_threshold=args.pixel_threshold, area_threshold=args.area_threshold), crops=crops)
+        t0 = time.time()
+        outputs = [gated(frame) for frame in frames]
+        fps = len(frames) / (time.time() - t0)
+        f1, iou = np.mean([agreement(a[:, :4], b[:, :4]) for a, b in zip(outputs, per_frame)], 0)
+        print(f"gated{' + crops' if crops else ''}: {fps:.1f} fps ({fps / base_fps:.2f}x), {gated.stats()}, "
+              f"agreement with every frame detection F1 {f1:.3f}, matched IoU {iou:.3f}")
@@ -0,0 +1,172 @@
+import math
+import random
+from torch.utils.data import IterableDataset, Sampler
+
+# YOLO decodes with strides 8, 16 and 32, so every input size must be divisible by the biggest one
+STRIDE = 32
+
+
+class ResolutionScheduler:
+    """
+    Picks input resolution (and batch size for it) for multi-scale training.
+    Args:
+        min_size (int): smallest resolution, multiple of 32
+        max_size (int): biggest resolution, multiple of 32
+        base_batch_size (int): batch size used at max_size
+        mode (str): "batch" picks new resolution for every batch, "epoch" keeps one resolution for the whole epoch
+        progressive_epochs (int): if > 0, biggest allowed resolution grows from min_size to max_size during this amount of epochs (small to large curriculum)
+        keep_memory (bool): scale batch size with (max_size / size) ** 2, so memory per step stays roughly constant
+        max_batch_size (int): upper limit for the scaled batch size
+    """
+    def __init__(self, min_size=320, max_size=608, base_batch_size=8, mode="batch", progressive_epochs=0, keep_memory=True, max_batch_size=None):
+        if min_size % STRIDE or max_size % STRIDE:
+            raise ValueError(f"Resolutions should be multiples of {STRIDE}, got {min_size} and {max_size}")
+        if min_size > max_size:
+            raise ValueError(f"min_size ({min_size}) is bigger than max_size ({max_size})")
+        if mode not in ("batch", "epoch"):
+            raise ValueError("Please use one of suggested modes: batch, epoch.")
+
+        self.sizes = list(range(min_size, max_size + 1, STRIDE))
+        self.base_batch_size = base_batch_size
+        self.mode = mode
+        self.progressive_epochs = progressive_epochs
+        self.keep_memory = keep_memory
+        self.max_batch_size = max_batch_size
+
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def available_sizes(self):
+        if self.progressive_epochs <= 0 or self.epoch >= self.progressive_epochs - 1:
+            return self.sizes
+
+        #LINEARLY GROWING CAP, THERE IS ALWAYS AT LEAST ONE SIZE
+        progress = self.epoch / max(self.progressive_epochs - 1, 1)
+        n_sizes = 1 + int(progress * (len(self.sizes) - 1))
+        return self.sizes[:n_sizes]
+
+    def epoch_size(self, rng):
+        sizes = self.available_sizes()
+        # With curriculum epoch mode goes through sizes from small to large, otherwise random one
+        if self.progressive_epochs > 0:
+            return sizes[-1]
+        return rng.choice(sizes)
+
+    def batch_size(self, img_size):
+        if not self.keep_memory:
+            return self.base_batch_size
+
+        bs = max(1, int(self.base_batch_size * (self.sizes[-1] / img_size) ** 2))
+        if self.max_batch_size:
+            bs = min(bs, self.max_batch_size)
+        return bs
+
+    def plan(self, n, rng):
+        """
+        Returns list of (img_size, batch_size) for the epoch, which covers n samples
+        """
+        plan = []
+        covered = 0
+        epoch_size = self.epoch_size(rng)
+        sizes = self.available_sizes()
+        while covered < n:
+            img_size = epoch_size if self.mode == "epoch" else rng.choice(sizes)
+            bs = min(self.batch_size(img_size), n - covered)
+            plan.append((img_size, bs))
+            covered += bs
+        return plan
+
+
+class MultiScaleBatchSampler(Sampler):
+    """
+    Batch sampler, which yields batches of (index, img_size) pairs for ListDataset.
+    Resolution and batch size of every batch are given by ResolutionScheduler.
+    Call set_epoch at the start of every epoch (YOLOv4PL does it in on_epoch_start).
+    """
+    def __init__(self, dataset, scheduler, shuffle=True, drop_last=False, seed=0):
+        if isinstance(dataset, IterableDataset):
+            raise TypeError(f"{type(dataset).__name__} is streamed, multiscale batches need random access (ListDataset)")
+        self.n = len(dataset)
+        self.scheduler = scheduler
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.scheduler.set_epoch(epoch)
+        self._batches = None
+
+    def batches(self):
+        # Plan is built once per epoch, so __len__ and __iter__ agree even when batch size changes
+        if self._batches is not None:
+            return self._batches
+
+        rng = random.Random(self.seed + self.epoch)
+        indices = list(range(self.n))
+        if self.shuffle:
+            rng.shuffle(indices)
+
+        batches = []
+        start = 0
+        for img_size, bs in self.scheduler.plan(self.n, rng):
+            chunk = indices[start:start + bs]
+            start += bs
+            if self.drop_last and len(chunk) < self.scheduler.batch_size(img_size):
+                continue
+            batches.append([(index, img_size) for index in chunk])
+
+        self._batches = batches
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+
+def rect_shape(aspect_ratios, img_size, stride=STRIDE):
+    """
+    (height, width) of letterbox canvas for images with given height / width ratios.
+    Long side is img_size, short side is the smallest multiple of stride which fits all of the images. Mix of landscape and portrait images gets square.
+    """
+    highest, lowest = max(aspect_ratios), min(aspect_ratios)
+    if highest <= 1:
+        return math.ceil(img_size * highest / stride) * stride, img_size
+    if lowest >= 1:
+        return img_size, math.ceil(img_size / lowest / stride) * stride
+    return img_size, img_size
+
+
+class AspectRatioBatchSampler(Sampler):
+    """
+    Batch sampler for validation, which yields batches of (index, (height, width)) pairs for ListDataset.
+    Images are sorted by aspect ratio and every batch is letterboxed only to rect_shape of its images instead of img_size x img_size,
+    ListDataset then also returns padding of every image (see utils.unletterbox).
+    """
+    def __init__(self, dataset, batch_size, img_size=None, stride=STRIDE):
+        if isinstance(dataset, IterableDataset):
+            raise TypeError(f"{type(dataset).__name__} is streamed, aspect ratio buckets need random access (ListDataset)")
+        img_size = img_size or dataset.img_size
+        if img_size % stride:
+            raise ValueError(f"img_size should be multiple of {stride}, got {img_size}")
+
+        ratios = [height / width for width, height in dataset.image_sizes()]
+        order = sorted(range(len(ratios)), key=lambda i: ratios[i])
+
+        self._batches = []
+        for start in range(0, len(order), batch_size):
+            chunk = order[start:start + batch_size]
+            shape = rect_shape([ratios[i] for i in chunk], img_size, stride)
+            self._batches.append([(index, shape) for index in chunk])
+
+    def __iter__(self):
+        return iter(self._batches)
+
+    def __len__(self):
+        return len(self._batches)
@@ -0,0 +1,229 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from letterbox import LetterboxPool
+from profiling import StageProfiler, timed
+from video_pipeline import frame_detections
+
+STAGES = ("preprocess", "wait", "infer", "postprocess")
+
+
+class MultiStreamEngine:
+    """
+    Dynamic batching of frames of many streams (cameras) into one forward of YOLOv4.
+    Frames are collected until there are max_batch of them or the first one waited max_wait seconds.
+    Detections go back through futures, which are completed in order of submit, so every stream gets its results in order.
+    Frames are letterboxed in the submitting threads into slots of a preallocated letterbox.LetterboxPool,
+    the inference thread only gathers slots of a batch into a reused batch tensor.
+    Args:
+        model: YOLOv4 in eval mode, on its device
+        max_batch (int): frames in one forward
+        max_wait (float): seconds the first frame of a batch waits for others
+        img_size (int): input size of the model, model.img_dim by default
+        confidence_threshold, iou_threshold (float): of utils.get_bboxes_from_anchors
+        labels_dict (dict): class index -> name, without it labels are class indexes
+        queue_size (int): frames waiting for a batch, submit blocks when it is full (backpressure on the streams),
+            the pool has a slot for every one of them and every frame of the batch being formed
+    Usage:
+        with MultiStreamEngine(m) as engine:
+            bboxes, labels = engine.submit(stream_id, frame).result()
+    """
+    def __init__(self, model, max_batch=16, max_wait=0.005, img_size=None, confidence_threshold=0.4, iou_threshold=0.5, labels_dict=None, queue_size=64):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.img_size = img_size or model.img_dim
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.labels_dict = labels_dict
+
+        self.requests = queue.Queue(queue_size)
+        # Batches between inference and NMS, so the model does not wait for NMS of the previous batch
+        self.outputs = queue.Queue(2)
+        self.pool = LetterboxPool(queue_size + max_batch, self.img_size, dtype=torch.uint8)
+        self.batch = self.pool.new_batch(max_batch, pin_memory=self.device.type == "cuda")
+
+        self.profiler = StageProfiler(STAGES, max_workers=0)
+        self.batch_sizes = np.zeros(max_batch + 1, dtype=np.int64)
+        self.frames_n = {}
+        self.threads = []
+
+    def submit(self, stream_id, frame):
+        """
+        Queues BGR frame of the stream, returns Future of (bboxes, labels) as video_pipeline.frame_detections gives.
+        Letterboxing runs in the calling thread (every stream has its own).
+        """
+        with timed(self.profiler, "preprocess"):
+            slot = self.pool.put(frame)
+        future = Future()
+        self.requests.put((stream_id, slot, time.perf_counter(), future))
+        return future
+
+    def collect(self):
+        # Blocks for the first frame, then waits for others until max_batch or deadline
+        first = self.requests.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.requests.get(timeout=remaining) if remaining > 0 else self.requests.get(block=False)
+            except queue.Empty:
+                break
+            if item is None:
+                #STOP AFTER THIS BATCH
+                self.requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    @torch.no_grad()
+    def infer_loop(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                break
+            self.profiler.add("wait", time.perf_counter() - batch[0][2])
+            try:
+                with timed(self.profiler, "infer"):
+                    # Slots are free again after the gather, padding and sizes are copies for postprocess
+                    x, padding, sizes = self.pool.gather([item[1] for item in batch], self.batch)
+                    anchors, _ = self.model(x.to(self.device, non_blocking=True))
+                    if self.device.type == "cuda":
+                        torch.cuda.current_stream().synchronize()
+            except Exception as e:
+                for item in batch:
+                    item[3].set_exception(e)
+                continue
+            self.batch_sizes[len(batch)] += 1
+            self.outputs.put((batch, anchors, padding, sizes))
+        self.outputs.put(None)
+
+    def postprocess_loop(self):
+        while True:
+            out = self.outputs.get()
+            if out is None:
+                break
+            batch, anchors, padding, sizes = out
+            try:
+                with timed(self.profiler, "postprocess"):
+                    detections = frame_detections(anchors, padding, sizes, self.confidence_threshold, self.iou_threshold, self.labels_dict)
+            except Exception as e:
+                for item in batch:
+                    item[3].set_exception(e)
+                continue
+            for item, result in zip(batch, detections):
+                self.frames_n[item[0]] = self.frames_n.get(item[0], 0) + 1
+                item[3].set_result(result)
+
+    @torch.no_grad()
+    def warmup(self):
+        # One forward at max_batch, cudnn picks its algorithms for the biggest batch
+        self.model(torch.zeros((self.max_batch, 3, self.img_size, self.img_size), dtype=torch.uint8, device=self.device))
+
+    def start(self):
+        self.warmup()
+        self.threads = [threading.Thread(target=self.infer_loop, daemon=True), threading.Thread(target=self.postprocess_loop, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        """
+        Processes frames which were already submitted and stops
+        """
+        self.requests.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def stats(self):
+        """
+        Dict with processed frames of every stream, histogram of batch sizes (index is size), mean batch size and profiler summary
+        """
+        n_batches = self.batch_sizes.sum()
+        return {
+            "frames" : dict(self.frames_n),
+            "batch_sizes" : self.batch_sizes.tolist(),
+            "mean_batch" : float((self.batch_sizes * np.arange(len(self.batch_sizes))).sum() / max(n_batches, 1)),
+            "stages" : self.profiler.summary(),
+        }
+
+
+def run_streams(engine, n_streams, frames_per_stream, fps=None, frame_shape=(480, 640, 3)):
+    """
+    Synthetic streams: every one in its own thread submits frames (at most fps per second, as fast as possible without it)
+    and waits for their detections. Checks that every stream gets results in order.
+    Returns aggregate fps and latencies (submit to result, seconds) of all frames
+    """
+    latencies = [[] for _ in range(n_streams)]
+    completed = [[] for _ in range(n_streams)]
+
+    def stream(stream_id):
+        frame = np.random.RandomState(stream_id).randint(0, 255, frame_shape, dtype=np.uint8)
+        pending = []
+        t_start = time.perf_counter()
+        for i in range(frames_per_stream):
+            if fps:
+                # Camera does not wait for detections of the previous frame
+                time.sleep(max(0.0, t_start + i / fps - time.perf_counter()))
+            elif pending:
+                pending[-1][1].result()
+            t = time.perf_counter()
+            future = engine.submit(stream_id, frame)
+            future.add_done_callback(lambda f, i=i, t=t: (completed[stream_id].append(i), latencies[stream_id].append(time.perf_counter() - t)))
+            pending.append((t, future))
+        for t, future in pending:
+            future.result()
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=stream, args=(i,)) for i in range(n_streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - t0
+
+    assert all(c == list(range(frames_per_stream)) for c in completed), "Streams got results out of order"
+    all_latencies = np.concatenate([np.array(l) for l in latencies])
+    return len(all_latencies) / elapsed, all_latencies
+
+
+if __name__ == "__main__":
+    import argparse
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Aggregate fps and per frame latency of N synthetic streams, batched and frame per forward")
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    parser.add_argument("--frames", type=int, default=16, help="frames of every stream")
+    parser.add_argument("--fps", type=float, default=None, help="frames per second of every stream, as fast as possible without it")
+    parser.add_argument("--max_batch", type=int, default=16)
+    parser.add_argument("--max_wait", type=float, default=0.005)
+    parser.add_argument("--img_size", type=int, default=320)
+    parser.add_argument("--weights", default=None)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    m = YOLOv4(weights_path=args.weights).eval().to(device)
+
+    print(f"{'streams':>8}{'max batch':>11}{'fps':>9}{'p50 ms':>10}{'p99 ms':>10}{'mean batch':>12}")
+    for n_streams in args.streams:
+        for max_batch in sorted({1, args.max_batch}):
+            with MultiStreamEngine(m, max_batch=max_batch, max_wait=args.max_wait, img_size=args.img_size) as engine:
+                fps, latencies = run_streams(engine, n_streams, args.frames, args.fps)
+            p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+            print(f"{n_streams:>8}{max_batch:>11}{fps:>9.1f}{p50:>10.1f}{p99:>10.1f}{engine.stats()['mean_batch']:>12.2f}")
@@ -1,9 +1,15 @@
 import torch
 import pytorch_lightning as pl
-from torch.utils.data import DataLoader
 
 from dataset import ListDataset
 from model import YOLOv4
+from multiscale import ResolutionScheduler, MultiScaleBatchSampler, AspectRatioBatchSampler
+from evaluation import MAPEvaluator
+from feature_cache import FeatureStore
+from targets import TargetAssigner
+from dataloader import make_dataloader
+from shards import ShardDataset
+import utils
 
 from lars import LARS
 
@@ -14,20 +20,83 @@ class YOLOv4PL(pl.LightningModule):
 
         self.hparams = hparams
 
-        self.train_ds = ListDataset(hparams.train_ds, train=True)
-        self.valid_ds = ListDataset(hparams.valid_ds, train=False)
+        # With uint8 images are converted to float in YOLOv4.forward on the GPU, batches through workers are 4 times smaller
+        # With jpeg_draft big JPEGs are decoded at reduced scale, which still fits img_size
+        ds_kwargs = {"uint8" : getattr(hparams, "uint8", False), "jpeg_draft" : getattr(hparams, "jpeg_draft", False)}
+        # With profile_data time of every loading stage is logged at the end of training epoch
+        profile = getattr(hparams, "profile_data", False)
+        # Tar shards (shards.py) are read sequentially, for network filesystems and object storage
+        if getattr(hparams, "train_shards", None):
+            self.train_ds = ShardDataset(hparams.train_shards, shuffle_buffer=getattr(hparams, "shuffle_buffer", 1000), train=True, profile=profile, **ds_kwargs)
+        else:
+            self.train_ds = ListDataset(hparams.train_ds, train=True, profile=profile, **ds_kwargs)
+        self.valid_ds = ListDataset(hparams.valid_ds, train=False, **ds_kwargs)
 
         self.model = YOLOv4(n_classes = 5, pretrained=True).cuda()
+        if getattr(hparams, "freeze_backbone", False):
+            self.model.freeze_backbone()
+
+        self.train_batch_sampler = None
+
+        self.evaluator = MAPEvaluator(self.model.yolo1.num_classes)
+
+    def collate_fn(self, ds):
+        # Anchor assignment can be done in dataloader workers instead of yolo layers
+        if getattr(self.hparams, "precompute_targets", False):
+            return TargetAssigner.from_model(self.model, ds.collate_fn)
+        return ds.collate_fn
+
+    def make_dataloader(self, ds, **kwargs):
+        return make_dataloader(
+            ds,
+            num_workers=getattr(self.hparams, "num_workers", 0),
+            persistent_workers=getattr(self.hparams, "persistent_workers", True),
+            prefetch_factor=getattr(self.hparams, "prefetch_factor", 2),
+            pin_memory=getattr(self.hparams, "pin_memory", True),
+            seed=getattr(self.hparams, "seed", None),
+            **kwargs,
+        )
 
     def train_dataloader(self):
-        train_dl = DataLoader(self.train_ds, batch_size=self.hparams.bs, collate_fn=self.train_ds.collate_fn, pin_memory=True) 
+        # Frozen backbone fine-tuning: backbone outputs are computed once and neck + head train from the store
+        if getattr(self.hparams, "feature_cache", None):
+            store = FeatureStore(self.hparams.feature_cache, self.model, ListDataset(self.hparams.train_ds, train=False))
+            if not store.exists():
+                store.build(self.model, batch_size=self.hparams.bs)
+            feature_ds = store.feature_dataset()
+            train_dl = self.make_dataloader(feature_ds, batch_size=self.hparams.bs, collate_fn=feature_ds.collate_fn, shuffle=True)
+            return train_dl
+
+        if getattr(self.hparams, "multiscale", False):
+            if isinstance(self.train_ds, ShardDataset):
+                raise ValueError("hparams.multiscale can not be used with hparams.train_shards, shards are streamed without random access")
+            scheduler = ResolutionScheduler(
+                min_size=getattr(self.hparams, "min_img_size", 320),
+                max_size=getattr(self.hparams, "max_img_size", self.train_ds.img_size),
+                base_batch_size=self.hparams.bs,
+                mode=getattr(self.hparams, "multiscale_mode", "batch"),
+                progressive_epochs=getattr(self.hparams, "progressive_epochs", 0),
+            )
+            self.train_batch_sampler = MultiScaleBatchSampler(self.train_ds, scheduler)
+            train_dl = self.make_dataloader(self.train_ds, batch_sampler=self.train_batch_sampler, collate_fn=self.collate_fn(self.train_ds))
+            return train_dl
+
+        train_dl = self.make_dataloader(self.train_ds, batch_size=self.hparams.bs, collate_fn=self.collate_fn(self.train_ds))
         return train_dl
     
     def val_dataloader(self):
-        valid_dl = DataLoader(self.valid_ds, batch_size=self.hparams.bs, collate_fn=self.valid_ds.collate_fn, pin_memory=True)
+        # Batches of images with similar aspect ratio, letterboxed to rectangles instead of squares
+        if getattr(self.hparams, "rect_val", False):
+            batch_sampler = AspectRatioBatchSampler(self.valid_ds, self.hparams.bs)
+            return self.make_dataloader(self.valid_ds, batch_sampler=batch_sampler, collate_fn=self.collate_fn(self.valid_ds))
+
+        valid_dl = self.make_dataloader(self.valid_ds, batch_size=self.hparams.bs, collate_fn=self.collate_fn(self.valid_ds))
         return valid_dl
 
     def forward(self, x, y=None):
+        # Batches from FeatureDataset have cached fp16 backbone features instead of images
+        if isinstance(x, (tuple, list)):
+            return self.model.forward_features(tuple(level.float() for level in x), y)
         return self.model(x, y)
 
     def basic_training_step(self, batch):
@@ -61,18 +130,44 @@ class YOLOv4PL(pl.LightningModule):
         
         
 
+    def on_epoch_start(self):
+        if self.train_batch_sampler is not None:
+            self.train_batch_sampler.set_epoch(self.current_epoch)
+        if isinstance(self.train_ds, ShardDataset):
+            self.train_ds.set_epoch(self.current_epoch)
+
     def training_epoch_end(self, outputs):
         training_loss_mean = torch.stack([x['training_loss'] for x in outputs]).mean()
-        return {"loss" : training_loss_mean, "log" : {"training_loss_epoch" : training_loss_mean}}
+        logs = {"training_loss_epoch" : training_loss_mean}
+
+        if self.train_ds.profiler is not None:
+            summary = self.train_ds.profiler.summary()
+            shares = self.train_ds.profiler.shares(summary)
+            for stage, stats in summary.items():
+                logs[f"data_{stage}_mean_ms"] = stats["mean_ms"]
+                logs[f"data_{stage}_p95_ms"] = stats["p95_ms"]
+                logs[f"data_{stage}_share"] = shares[stage]
+            self.train_ds.profiler.reset()
+
+        return {"loss" : training_loss_mean, "log" : logs}
 
     def validation_step(self, batch, batch_idx):
-        filenames, images, labels = batch
+        # Rectangular validation batches also have padding of every image
+        filenames, images, labels = batch[:3]
         y_hat, loss = self(images, labels)
+
+        detections = utils.non_max_suppression(y_hat, getattr(self.hparams, "val_conf_threshold", 0.001), getattr(self.hparams, "val_iou_threshold", 0.6))
+        self.evaluator.update(detections, labels, images.shape[2:])
+
         return {"val_loss" : loss}
 
     def validation_epoch_end(self, outputs):
         val_loss_mean = torch.stack([x['val_loss'] for x in outputs]).mean()
-        logger_logs = {"validation_loss" : val_loss_mean}
+
+        metrics = self.evaluator.compute()
+        self.evaluator.reset()
+
+        logger_logs = {"validation_loss" : val_loss_mean, "mAP" : metrics["mAP"], "mAP50" : metrics["mAP50"], "mAP75" : metrics["mAP75"]}
 
         return {"val_loss" : val_loss_mean, "log" : logger_logs}
 
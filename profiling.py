@@ -0,0 +1,199 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+import torch
+
+# Stages of ListDataset, batch_mosaic and batch_jitter are timed per batch, everything else per image or per sample
+STAGES = ("decode", "resize", "labels", "jitter", "to_tensor", "mosaic", "letterbox", "sample", "collate", "batch_mosaic", "batch_jitter")
+
+
+class StageProfiler:
+    """
+    Timing histograms (log-spaced bins) of data loading stages, shared between dataloader workers.
+    Histograms are shared memory tensors and every worker writes only its own row, so no locks are needed.
+    Stages timed inside of other stages (f.e. decode inside sample, batch_jitter inside batch_mosaic inside collate)
+    are also subtracted from exclusive time of the outer stage, shares of exclusive time add up to 100%.
+    Has to be created before DataLoader starts its workers (ListDataset(profile=True) does it).
+    Args:
+        stages: names of stages
+        max_workers (int): rows of workers, main process has its own one
+        min_time, max_time (float): range of bins in seconds, faster and slower timings go to the edge bins
+        bins (int): number of bins between min_time and max_time
+    """
+    def __init__(self, stages=STAGES, max_workers=64, min_time=1e-5, max_time=10.0, bins=60):
+        self.stages = {stage : i for i, stage in enumerate(stages)}
+        self.edges = np.geomspace(min_time, max_time, bins + 1)
+        self.counts = torch.zeros(max_workers + 1, len(stages), bins + 2, dtype=torch.int64).share_memory_()
+        self.totals = torch.zeros(max_workers + 1, len(stages), dtype=torch.float64).share_memory_()
+        self.exclusive = torch.zeros(max_workers + 1, len(stages), dtype=torch.float64).share_memory_()
+        self._views = None
+        # Time of nested stages for every open stage() of a thread
+        self._local = threading.local()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_views"] = None
+        state["_local"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._local = threading.local()
+
+    def _row(self):
+        if self._views is None:
+            self._views = (self.counts.numpy(), self.totals.numpy(), self.exclusive.numpy())
+        worker_info = torch.utils.data.get_worker_info()
+        return 0 if worker_info is None else 1 + worker_info.id % (len(self.counts) - 1)
+
+    def add(self, stage, seconds, exclusive=None):
+        """
+        exclusive is the time without nested stages, all of seconds by default
+        """
+        row = self._row()
+        counts, totals, exclusive_totals = self._views
+        i = self.stages[stage]
+        counts[row, i, np.searchsorted(self.edges, seconds)] += 1
+        totals[row, i] += seconds
+        exclusive_totals[row, i] += seconds if exclusive is None else exclusive
+
+    @contextmanager
+    def stage(self, stage):
+        if not hasattr(self._local, "nested"):
+            self._local.nested = []
+        nested = self._local.nested
+        nested.append(0.0)
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - t0
+            inner = nested.pop()
+            if nested:
+                nested[-1] += seconds
+            self.add(stage, seconds, seconds - inner)
+
+    def reset(self):
+        self.counts.zero_()
+        self.totals.zero_()
+        self.exclusive.zero_()
+
+    def histogram(self, stage):
+        """
+        Counts of all workers in bins: below edges[0], between edges, above edges[-1]
+        """
+        return self.counts[:, self.stages[stage]].sum(0).numpy()
+
+    def percentile(self, stage, q):
+        hist = self.histogram(stage)
+        if hist.sum() == 0:
+            return float("nan")
+        # Geometric middle of the bin, edge bins take their edge
+        edges = np.concatenate([self.edges[:1], self.edges, self.edges[-1:]])
+        middles = np.sqrt(edges[:-1] * edges[1:])
+        return float(middles[np.searchsorted(np.cumsum(hist), q / 100 * hist.sum())])
+
+    def summary(self):
+        """
+        Dict stage -> count, total seconds, exclusive seconds (without nested stages), mean, median and 95th percentile in ms
+        (only stages which were timed)
+        """
+        totals = self.totals.sum(0).numpy()
+        exclusive = self.exclusive.sum(0).numpy()
+        result = {}
+        for stage, i in self.stages.items():
+            count = int(self.histogram(stage).sum())
+            if count == 0:
+                continue
+            result[stage] = {
+                "count" : count,
+                "total_s" : float(totals[i]),
+                "exclusive_s" : float(exclusive[i]),
+                "mean_ms" : totals[i] / count * 1000,
+                "p50_ms" : self.percentile(stage, 50) * 1000,
+                "p95_ms" : self.percentile(stage, 95) * 1000,
+            }
+        return result
+
+    def shares(self, summary=None, inclusive=()):
+        """
+        Dict stage -> share of exclusive time of all stages, they add up to 1.
+        inclusive stages (timed with add() over other stages, f.e. latency of VideoPipeline) get no share
+        """
+        summary = summary if summary is not None else self.summary()
+        all_time = sum(s["exclusive_s"] for stage, s in summary.items() if stage not in inclusive)
+        return {stage : s["exclusive_s"] / all_time if all_time else 0.0 for stage, s in summary.items() if stage not in inclusive}
+
+    def report(self, inclusive=()):
+        """
+        Table of summary(), total time includes nested stages, share is of exclusive time (see shares())
+        """
+        summary = self.summary()
+        shares = self.shares(summary, inclusive)
+        lines = [f"{'stage':<13}{'count':>8}{'total s':>10}{'share':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}"]
+        for stage, s in summary.items():
+            share = f"{shares[stage]:.0%}" if stage in shares else ""
+            lines.append(f"{stage:<13}{s['count']:>8}{s['total_s']:>10.2f}{share:>8}{s['mean_ms']:>10.2f}{s['p50_ms']:>10.2f}{s['p95_ms']:>10.2f}")
+        return "\n".join(lines)
+
+
+def profiled(stage):
+    """
+    Method decorator, which times the method with profiler of its object (self.profiler), if it has one
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.profiler is None:
+                return method(self, *args, **kwargs)
+            with self.profiler.stage(stage):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed(profiler, stage):
+    """
+    Context, which times the block with profiler, if it is not None
+    """
+    return profiler.stage(stage) if profiler is not None else nullcontext()
+
+
+if __name__ == "__main__":
+    import argparse
+    from dataset import ListDataset
+    from dataloader import make_dataloader
+
+    parser = argparse.ArgumentParser(description="Time spent by ListDataset in every stage of loading")
+    parser.add_argument("list_path")
+    parser.add_argument("--n", type=int, default=200, help="samples to profile")
+    parser.add_argument("--bs", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=0)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--train", type=int, default=1, help="1 for mosaic, 0 for letterbox")
+    parser.add_argument("--image_cache", default=None)
+    parser.add_argument("--label_index", default=None)
+    parser.add_argument("--jpeg_draft", type=int, default=0)
+    parser.add_argument("--batch_jitter", type=int, default=0)
+    parser.add_argument("--batch_mosaic", type=int, default=0)
+    parser.add_argument("--uint8", type=int, default=0)
+    args = parser.parse_args()
+
+    ds = ListDataset(args.list_path, img_size=args.img_size, train=bool(args.train), image_cache=args.image_cache, label_index=args.label_index,
+                     jpeg_draft=bool(args.jpeg_draft), batch_jitter=bool(args.batch_jitter), batch_mosaic=bool(args.batch_mosaic), uint8=bool(args.uint8), profile=True)
+    dl = make_dataloader(ds, batch_size=args.bs, shuffle=True, collate_fn=ds.collate_fn, num_workers=args.workers, seed=0)
+
+    t0 = time.time()
+    n = 0
+    while n < args.n:
+        for _, imgs, _ in dl:
+            n += len(imgs)
+            if n >= args.n:
+                break
+    elapsed = time.time() - t0
+
+    print(f"{n} samples in {elapsed:.2f}s ({n / elapsed:.1f} samples/s), {args.workers} workers")
+    print(ds.profiler.report())
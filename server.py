@@ -0,0 +1,392 @@
+import asyncio
+import copy
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+import torch
+
+from letterbox import LetterboxPool
+from profiling import StageProfiler
+from video_pipeline import frame_detections
+
+STAGES = ("decode", "queue", "infer", "request")
+
+REASONS = {200 : "OK", 400 : "Bad Request", 404 : "Not Found", 405 : "Method Not Allowed", 503 : "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class InferenceServer:
+    """
+    HTTP inference server (asyncio, no dependencies) with dynamic batching.
+    POST /detect with encoded image (jpeg, png) as body returns json {"detections": [{"box": [x1, y1, x2, y2], "confidence", "class", "label"}]}
+    in pixels of the image. GET /metrics returns queue depth, batch size histogram, rejected requests and latencies of stages.
+    Images are decoded and letterboxed into a slot of a preallocated letterbox.LetterboxPool (one per resolution) in a thread pool,
+    requests wait in a bounded queue (503 when it is full) for a free replica, which takes up to max_batch of them,
+    or less if the first one waited max_wait seconds. The replica only gathers slots of the batch into its reused batch tensor.
+    Args:
+        model: YOLOv4 in eval mode
+        devices (list): device of every replica (thread holding a copy of the model), f.e. ["cuda:0", "cuda:1"] or ["cpu"]
+        max_batch (int): requests in one forward
+        max_wait (float): seconds the first request of a batch waits for others (latency budget of batching)
+        max_queue (int): requests waiting for inference, more are rejected with 503
+        decode_workers (int): threads decoding images
+        img_size (int): input size of the model, model.img_dim by default
+        confidence_threshold, iou_threshold (float): of utils.get_bboxes_from_anchors
+        labels_dict (dict): class index -> name
+        controller (adaptive.ResolutionController): chooses input resolution from latencies and queue depth instead of img_size,
+            batches have only requests of one resolution
+    """
+    def __init__(self, model, devices=None, max_batch=8, max_wait=0.01, max_queue=64, decode_workers=4, img_size=None,
+                 confidence_threshold=0.4, iou_threshold=0.5, labels_dict=None, controller=None):
+        if devices is None:
+            devices = [next(model.parameters()).device]
+        self.replicas = [copy.deepcopy(model).to(device).eval() for device in devices]
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self.img_size = img_size or model.img_dim
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.labels_dict = labels_dict or {}
+        self.controller = controller
+
+        self.decode_pool = ThreadPoolExecutor(decode_workers)
+        self.infer_pool = ThreadPoolExecutor(len(self.replicas))
+
+        self.profiler = StageProfiler(STAGES, max_workers=0, bins=240)
+        self.batch_sizes = np.zeros(max_batch + 1, dtype=np.int64)
+        self.requests_n = 0
+        self.rejected = 0
+        self.errors = 0
+
+        self.queue = None
+        self.server = None
+        # Request of other resolution than its batch, it starts the next one
+        self.carry = None
+        # Slot for every request which can be queued, in a batch of a replica, carried or being decoded
+        slots = max_queue + max_batch * len(self.replicas) + decode_workers + 1
+        img_sizes = controller.resolutions if controller is not None else [self.img_size]
+        self.pools = {img_size : LetterboxPool(slots, img_size, dtype=torch.uint8) for img_size in img_sizes}
+        # (replica, resolution) -> batch tensor, a replica runs one batch at a time
+        self.batches = {}
+
+    #INFERENCE
+    def decode(self, body):
+        img = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise HTTPError(400, "Body is not an image")
+        img_size = self.controller.resolution if self.controller is not None else self.img_size
+        return self.pools[img_size].put(img), img_size
+
+    def batch(self, replica, img_size):
+        key = (id(replica), img_size)
+        if key not in self.batches:
+            device = next(replica.parameters()).device
+            self.batches[key] = self.pools[img_size].new_batch(self.max_batch, pin_memory=device.type == "cuda")
+        return self.batches[key]
+
+    @torch.no_grad()
+    def infer(self, replica, batch):
+        device = next(replica.parameters()).device
+        t0 = time.perf_counter()
+        img_size = batch[0][1]
+        x, padding, sizes = self.pools[img_size].gather([item[0] for item in batch], self.batch(replica, img_size))
+        anchors, _ = replica(x.to(device, non_blocking=True))
+        detections = frame_detections(anchors, padding, sizes, self.confidence_threshold, self.iou_threshold)
+        self.profiler.add("infer", time.perf_counter() - t0)
+        return detections
+
+    async def collect(self):
+        if self.carry is not None:
+            first, self.carry = self.carry, None
+        else:
+            first = await self.queue.get()
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            try:
+                item = self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(self.queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            if item[1] != first[1]:
+                self.carry = item
+                break
+            batch.append(item)
+        return batch
+
+    async def run_batch(self, replica, batch, free):
+        loop = asyncio.get_running_loop()
+        try:
+            detections = await loop.run_in_executor(self.infer_pool, self.infer, replica, batch)
+            for item, result in zip(batch, detections):
+                item[3].set_result(result)
+        except Exception as e:
+            for item in batch:
+                item[3].set_exception(e)
+        finally:
+            free.put_nowait(replica)
+
+    async def batcher(self):
+        # Batch is collected only when a replica is free, requests arriving meanwhile join it
+        free = asyncio.Queue()
+        for replica in self.replicas:
+            free.put_nowait(replica)
+        while True:
+            replica = await free.get()
+            batch = await self.collect()
+            now = time.perf_counter()
+            for item in batch:
+                self.profiler.add("queue", now - item[2])
+            self.batch_sizes[len(batch)] += 1
+            asyncio.ensure_future(self.run_batch(replica, batch, free))
+
+    async def detect(self, body):
+        loop = asyncio.get_running_loop()
+        t0 = time.perf_counter()
+        slot, img_size = await loop.run_in_executor(self.decode_pool, self.decode, body)
+        self.profiler.add("decode", time.perf_counter() - t0)
+
+        future = loop.create_future()
+        try:
+            self.queue.put_nowait((slot, img_size, time.perf_counter(), future))
+        except asyncio.QueueFull:
+            self.pools[img_size].release([slot])
+            self.rejected += 1
+            raise HTTPError(503, "Queue is full")
+        bboxes, labels = await future
+        if self.controller is not None:
+            self.controller.observe(time.perf_counter() - t0, self.queue.qsize(), img_size)
+
+        detections = []
+        for bbox in bboxes.tolist():
+            cls = int(np.argmax(bbox[5:]))
+            detections.append({"box" : [round(v, 1) for v in bbox[:4]], "confidence" : round(bbox[4], 4), "class" : cls, "label" : self.labels_dict.get(cls, str(cls))})
+        return {"detections" : detections}
+
+    def metrics(self):
+        return {
+            "requests" : self.requests_n,
+            "rejected" : self.rejected,
+            "errors" : self.errors,
+            "queue_depth" : self.queue.qsize() if self.queue is not None else 0,
+            "replicas" : len(self.replicas),
+            "batch_sizes" : {size : int(n) for size, n in enumerate(self.batch_sizes) if n},
+            "latency_ms" : self.profiler.summary(),
+            "adaptive" : self.controller.metrics() if self.controller is not None else None,
+        }
+
+    #HTTP
+    async def handle(self, method, path, body):
+        if path == "/detect":
+            if method != "POST":
+                raise HTTPError(405, "Use POST with image as body")
+            return await self.detect(body)
+        if path == "/metrics":
+            return self.metrics()
+        if path == "/health":
+            return {"ok" : True}
+        raise HTTPError(404, f"No {path}")
+
+    async def connection(self, reader, writer):
+        # HTTP/1.1 with keep alive, bodies only with Content-Length
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, value = line.decode("latin-1").split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                t0 = time.perf_counter()
+                status = 200
+                try:
+                    response = await self.handle(method, urlparse(target).path, body)
+                except HTTPError as e:
+                    status, response = e.status, {"error" : str(e)}
+                except Exception as e:
+                    self.errors += 1
+                    status, response = 500, {"error" : repr(e)}
+                if urlparse(target).path == "/detect":
+                    self.requests_n += 1
+                    self.profiler.add("request", time.perf_counter() - t0)
+
+                data = json.dumps(response).encode()
+                close = headers.get("connection", "").lower() == "close"
+                head = f"HTTP/1.1 {status} {REASONS.get(status, 'Internal Server Error')}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                if status == 503:
+                    head += "Retry-After: 1\r\n"
+                if close:
+                    head += "Connection: close\r\n"
+                writer.write(head.encode() + b"\r\n" + data)
+                await writer.drain()
+                if close:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @torch.no_grad()
+    def warmup(self):
+        # Every resolution the controller may switch to is warmed up (cudnn algorithms, grid offsets, batch tensors), so a switch has no cold start
+        for replica in self.replicas:
+            for img_size in self.pools:
+                replica(self.batch(replica, img_size).zero_().to(next(replica.parameters()).device))
+
+    async def start(self, host="127.0.0.1", port=8000):
+        self.warmup()
+        self.queue = asyncio.Queue(self.max_queue)
+        self.batcher_task = asyncio.ensure_future(self.batcher())
+        self.server = await asyncio.start_server(self.connection, host, port)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        self.batcher_task.cancel()
+
+    def serve_forever(self, host="127.0.0.1", port=8000):
+        async def main():
+            server = await self.start(host, port)
+            print(f"Serving on http://{host}:{port} (POST /detect, GET /metrics)")
+            async with server:
+                await server.serve_forever()
+        asyncio.run(main())
+
+
+async def request(host, port, method, path, body=b"", connection=None):
+    """
+    Minimal HTTP/1.1 client, returns (status, json) and connection (reader, writer) for keep alive
+    """
+    if connection is None:
+        connection = await asyncio.open_connection(host, port)
+    reader, writer = connection
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, value = line.decode().split(":", 1)
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length)), connection
+
+
+async def load(host, port, body, n_requests=None, concurrency=1, retry_after=0.05, duration=None):
+    """
+    Load generator: concurrency clients with keep alive connections send n_requests POST /detect in total
+    (or as many as they can in duration seconds), a rejected client waits retry_after seconds before its next request.
+    Returns successful requests per second, their latencies (seconds) and amount of rejected (503) requests
+    """
+    latencies = []
+    rejected = 0
+    remaining = n_requests if n_requests is not None else float("inf")
+    t_end = time.perf_counter() + duration if duration is not None else float("inf")
+
+    async def client():
+        nonlocal remaining, rejected
+        connection = None
+        while remaining > 0 and time.perf_counter() < t_end:
+            remaining -= 1
+            t0 = time.perf_counter()
+            status, _, connection = await request(host, port, "POST", "/detect", body, connection)
+            if status == 200:
+                latencies.append(time.perf_counter() - t0)
+            elif status == 503:
+                rejected += 1
+                await asyncio.sleep(retry_after)
+            else:
+                raise RuntimeError(f"Status {status}")
+        if connection is not None:
+            connection[1].close()
+            await connection[1].wait_closed()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return len(latencies) / (time.perf_counter() - t0), np.array(latencies), rejected
+
+
+if __name__ == "__main__":
+    import argparse
+    from model import YOLOv4
+    from video_demo import coco_dict
+
+    parser = argparse.ArgumentParser(description="Dynamic batching inference server and its load generator")
+    parser.add_argument("mode", choices=["serve", "load"], help="load starts the server in this process, unless --url is given")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--devices", nargs="+", default=None, help="device of every replica")
+    parser.add_argument("--max_batch", type=int, nargs="+", default=[8], help="several values are compared in load mode")
+    parser.add_argument("--max_wait", type=float, default=0.01)
+    parser.add_argument("--max_queue", type=int, default=64)
+    parser.add_argument("--url", default=None, help="load: server to load, f.e. http://127.0.0.1:8000")
+    parser.add_argument("--image", default=None, help="load: image to send, random 640x480 jpeg without it")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    def make_server(max_batch):
+        m = YOLOv4(weights_path=args.weights).eval()
+        devices = args.devices or ["cuda" if torch.cuda.is_available() else "cpu"]
+        return InferenceServer(m, devices, max_batch=max_batch, max_wait=args.max_wait, max_queue=args.max_queue, img_size=args.img_size, labels_dict=coco_dict)
+
+    if args.mode == "serve":
+        make_server(args.max_batch[0]).serve_forever(args.host, args.port)
+    else:
+        if args.image is not None:
+            with open(args.image, "rb") as file:
+                body = file.read()
+        else:
+            body = cv2.imencode(".jpg", np.random.RandomState(0).randint(0, 255, (480, 640, 3), dtype=np.uint8))[1].tobytes()
+
+        async def main():
+            print(f"{'max batch':>10}{'clients':>9}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'rejected':>10}  batch sizes")
+            for max_batch in args.max_batch:
+                server = None
+                if args.url is None:
+                    server = make_server(max_batch)
+                    await server.start(args.host, args.port)
+                    host, port = args.host, args.port
+                else:
+                    url = urlparse(args.url)
+                    host, port = url.hostname, url.port
+                for concurrency in args.concurrency:
+                    if server is not None:
+                        server.batch_sizes[:] = 0
+                    rps, latencies, rejected = await load(host, port, body, args.requests, concurrency)
+                    p50, p99 = np.percentile(latencies, [50, 99]) * 1000 if len(latencies) else (float("nan"),) * 2
+                    _, metrics, connection = await request(host, port, "GET", "/metrics")
+                    connection[1].close()
+                    await connection[1].wait_closed()
+                    print(f"{max_batch:>10}{concurrency:>9}{rps:>9.1f}{p50:>10.1f}{p99:>10.1f}{rejected:>10}  {metrics['batch_sizes']}")
+                if server is not None:
+                    await server.stop()
+
+        asyncio.run(main())
@@ -0,0 +1,199 @@
+import io
+import json
+import os
+import random
+import tarfile
+
+import numpy as np
+import torch
+from torch.utils.data import IterableDataset
+
+from dataset import ListDataset, label_path_from_img_path
+from profiling import profiled
+
+
+def write_shards(list_path, out_dir, samples_per_shard=1000, img_dir="images", labels_dir="labels", img_extensions=[".JPG"]):
+    """
+    Converts train.txt + images/labels layout to tar shards. Every sample is 3 consecutive members:
+    <key>.img (image file bytes), <key>.txt (label file, empty if there is none) and <key>.path (original image path).
+    index.json lists shards and amount of samples in every one of them. Returns list of shard paths.
+    """
+    with open(list_path, "r") as file:
+        img_files = [path.rstrip() for path in file.read().splitlines()]
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    def add(tar, name, data):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+    shards = []
+    counts = []
+    for shard_n, start in enumerate(range(0, len(img_files), samples_per_shard)):
+        name = f"shard-{shard_n:06d}.tar"
+        tmp_path = os.path.join(out_dir, name + ".tmp")
+        with tarfile.open(tmp_path, "w") as tar:
+            for i, img_path in enumerate(img_files[start:start + samples_per_shard], start):
+                label_path = label_path_from_img_path(img_path, img_dir, labels_dir, img_extensions)
+                with open(img_path, "rb") as file:
+                    add(tar, f"{i:09d}.img", file.read())
+                label = b""
+                if os.path.exists(label_path):
+                    with open(label_path, "rb") as file:
+                        label = file.read()
+                add(tar, f"{i:09d}.txt", label)
+                add(tar, f"{i:09d}.path", img_path.encode())
+        os.rename(tmp_path, os.path.join(out_dir, name))
+
+        shards.append(name)
+        counts.append(min(samples_per_shard, len(img_files) - start))
+
+    # Written last, folder without it is not a complete set of shards
+    with open(os.path.join(out_dir, "index.json"), "w") as file:
+        json.dump({"shards" : shards, "counts" : counts}, file)
+
+    return [os.path.join(out_dir, name) for name in shards]
+
+
+def read_shard(shard_path):
+    """
+    Reads tar shard sequentially, yields (path, image bytes, label bytes)
+    """
+    sample = {}
+    key = None
+    with tarfile.open(shard_path, "r|") as tar:
+        for member in tar:
+            member_key, ext = member.name.rsplit(".", 1)
+            if key is not None and member_key != key:
+                yield sample["path"].decode(), sample["img"], sample["txt"]
+                sample = {}
+            key = member_key
+            sample[ext] = tar.extractfile(member).read()
+    if sample:
+        yield sample["path"].decode(), sample["img"], sample["txt"]
+
+
+def node_rank():
+    """
+    (rank, world size) of this process, from torch.distributed or RANK/WORLD_SIZE environment variables
+    """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank(), torch.distributed.get_world_size()
+    return int(os.environ.get("RANK", 0)), int(os.environ.get("WORLD_SIZE", 1))
+
+
+class ShardDataset(ListDataset, IterableDataset):
+    """
+    Streams samples of tar shards (write_shards) sequentially and yields the same (path, img, targets) as ListDataset.
+    Shards are split between nodes, shuffled every epoch and split between dataloader workers, samples are shuffled with a buffer.
+    len() is the amount of samples of this node.
+    Mosaic takes its other 3 tiles from the shuffle buffer.
+    Args:
+        shards_dir (str): folder with shards and index.json
+        shuffle_buffer (int): samples kept in memory for shuffling (undecoded), 0 yields samples in order of shards
+        seed (int): seed of shard order, the same on every node and worker
+        **kwargs: ListDataset arguments (img_size, train, augmentation ranges, batch_jitter, batch_mosaic, uint8, jpeg_draft)
+    Call set_epoch at the start of every epoch (YOLOv4PL does it in on_epoch_start).
+    """
+    def __init__(self, shards_dir, shuffle_buffer=1000, seed=0, **kwargs):
+        super().__init__(None, **kwargs)
+
+        with open(os.path.join(shards_dir, "index.json")) as file:
+            index = json.load(file)
+        self.shards = [os.path.join(shards_dir, name) for name in index["shards"]]
+        self.counts = index["counts"]
+
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        # Persistent workers keep their copy of dataset and never see set_epoch, iterations of the copy move shard order instead
+        self._iterations = 0
+
+        # (path, image bytes, boxes) of buffered samples, img_files are their paths
+        self._buffer = []
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def worker_shards(self):
+        # Shards of a node do not change between epochs, so len() of every node is known up front
+        rank, world_size = node_rank()
+        shards = self.shards[rank::world_size]
+        if self.shuffle_buffer > 0:
+            random.Random(self.seed + self.epoch + self._iterations).shuffle(shards)
+
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+
+        return shards[worker_id::num_workers]
+
+    def samples(self):
+        for shard in self.worker_shards():
+            for path, img_bytes, label in read_shard(shard):
+                boxes = torch.from_numpy(np.loadtxt(io.BytesIO(label), ndmin=2).reshape(-1, 5)) if label.strip() else torch.zeros((0, 5), dtype=torch.float64)
+                yield path, img_bytes, boxes
+
+    def set_slot(self, i, sample):
+        if i == len(self._buffer):
+            self._buffer.append(sample)
+            self.img_files.append(sample[0])
+        else:
+            self._buffer[i] = sample
+            self.img_files[i] = sample[0]
+
+    def __iter__(self):
+        self._buffer = []
+        self.img_files = []
+
+        self._iterations += 1
+
+        for sample in self.samples():
+            if len(self._buffer) < max(self.shuffle_buffer, 1):
+                self.set_slot(len(self._buffer), sample)
+                continue
+
+            i = random.randrange(len(self._buffer)) if self.shuffle_buffer > 0 else 0
+            yield self[i]
+            if self.shuffle_buffer > 0:
+                self.set_slot(i, sample)
+            else:
+                self._buffer, self.img_files = [sample], [sample[0]]
+
+        #DRAIN THE BUFFER
+        while self._buffer:
+            i = random.randrange(len(self._buffer)) if self.shuffle_buffer > 0 else 0
+            yield self[i]
+            self._buffer[i], self.img_files[i] = self._buffer[-1], self.img_files[-1]
+            self._buffer.pop()
+            self.img_files.pop()
+
+    @profiled("decode")
+    def open_image(self, index, img_size=None):
+        return self.decode_image(io.BytesIO(self._buffer[index][1]), img_size)
+
+    def load_boxes(self, index):
+        return self._buffer[index][2].clone()
+
+    def image_sizes(self):
+        raise TypeError("ShardDataset is streamed, aspect ratio buckets need random access (ListDataset)")
+
+    def __len__(self):
+        rank, world_size = node_rank()
+        return sum(self.counts[rank::world_size])
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Converts train.txt + images/labels layout to tar shards")
+    parser.add_argument("list_path")
+    parser.add_argument("out_dir")
+    parser.add_argument("--samples_per_shard", type=int, default=1000)
+    parser.add_argument("--img_dir", default="images")
+    parser.add_argument("--labels_dir", default="labels")
+    parser.add_argument("--img_extensions", nargs="+", default=[".JPG"])
+    args = parser.parse_args()
+
+    shards = write_shards(args.list_path, args.out_dir, args.samples_per_shard, args.img_dir, args.labels_dir, args.img_extensions)
+    print(f"Wrote {len(shards)} shards to {args.out_dir}")
@@ -0,0 +1,177 @@
+import torch
+
+# Strides of yolo1, yolo2 and yolo3 layers of YOLOv4
+STRIDES = (8, 16, 32)
+
+
+def wh_iou(anchors, wh):
+    """
+    IoU [n_anchors, N] of anchors and boxes, both are only width and height (same as YOLOLayer.bbox_wh_iou)
+    """
+    w1, h1 = anchors[:, 0:1], anchors[:, 1:2]
+    w2, h2 = wh[:, 0][None], wh[:, 1][None]
+    inter_area = torch.min(w1, w2) * torch.min(h1, h2)
+    union_area = (w1 * h1 + 1e-16) + w2 * h2 - inter_area
+    return inter_area / union_area
+
+
+def assign_targets(targets, anchors, stride, grid_w, grid_h, ignore_thres=0.5):
+    """
+    Anchor and grid cell assignment of one yolo layer, the same as YOLOLayer.build_targets does.
+    targets: [N, 6] dataset targets (img index, class, x, y, w, h relative)
+    anchors: [n_anchors, 2] anchors in pixels
+    Returns [N, 4] float tensor: best anchor, grid x, grid y, bitmask of anchors with IoU over ignore_thres
+    """
+    scaled_anchors = anchors / stride
+    gxy = targets[:, 2:4] * torch.tensor([grid_w, grid_h], dtype=targets.dtype)
+    gwh = targets[:, 4:6] * torch.tensor([grid_w, grid_h], dtype=targets.dtype)
+
+    ious = wh_iou(scaled_anchors, gwh)
+    best_n = ious.max(0)[1]
+    gi, gj = gxy.long().t()
+
+    ignore_bits = ((ious > ignore_thres).long() << torch.arange(len(anchors))[:, None]).sum(0)
+
+    return torch.stack([best_n, gi, gj, ignore_bits], 1).to(targets.dtype)
+
+
+def build_targets_reference(layer, pred_boxes, pred_cls, target, anchors, ignore_thres):
+    """
+    YOLOLayer.build_targets as it was before the assignment was vectorized and precomputed (square grid, per target loop),
+    the baseline of the benchmark below
+    """
+    ByteTensor = torch.cuda.BoolTensor if pred_boxes.is_cuda else torch.BoolTensor
+    FloatTensor = torch.cuda.FloatTensor if pred_boxes.is_cuda else torch.FloatTensor
+
+    nB = pred_boxes.size(0)
+    nA = pred_boxes.size(1)
+    nC = pred_cls.size(-1)
+    nG = pred_boxes.size(2)
+
+    obj_mask = ByteTensor(nB, nA, nG, nG).fill_(0)
+    noobj_mask = ByteTensor(nB, nA, nG, nG).fill_(1)
+    class_mask = FloatTensor(nB, nA, nG, nG).fill_(0)
+    iou = FloatTensor(nB, nA, nG, nG).fill_(0)
+    tx = FloatTensor(nB, nA, nG, nG).fill_(0)
+    ty = FloatTensor(nB, nA, nG, nG).fill_(0)
+    tw = FloatTensor(nB, nA, nG, nG).fill_(0)
+    th = FloatTensor(nB, nA, nG, nG).fill_(0)
+    tcls = FloatTensor(nB, nA, nG, nG, nC).fill_(0)
+    target_boxes_grid = FloatTensor(nB, nA, nG, nG, 4).fill_(0)
+
+    target_boxes = target[:, 2:6] * nG
+    gxy = target_boxes[:, :2]
+    gwh = target_boxes[:, 2:]
+
+    ious = torch.stack([layer.bbox_wh_iou(anchor, gwh) for anchor in anchors])
+    best_ious, best_n = ious.max(0)
+
+    b, target_labels = target[:, :2].long().t()
+    gx, gy = gxy.t()
+    gw, gh = gwh.t()
+    gi, gj = gxy.long().t()
+
+    target_boxes_grid[b, best_n, gj, gi] = target_boxes
+    obj_mask[b, best_n, gj, gi] = 1
+    noobj_mask[b, best_n, gj, gi] = 0
+
+    for i, anchor_ious in enumerate(ious.t()):
+        noobj_mask[b[i], anchor_ious > ignore_thres, gj[i], gi[i]] = 0
+
+    tx[b, best_n, gj, gi] = gx - gx.floor()
+    ty[b, best_n, gj, gi] = gy - gy.floor()
+    tw[b, best_n, gj, gi] = torch.log(gw / anchors[best_n][:, 0] + 1e-16)
+    th[b, best_n, gj, gi] = torch.log(gh / anchors[best_n][:, 1] + 1e-16)
+    tcls[b, best_n, gj, gi, target_labels] = 0.9
+
+    class_mask[b, best_n, gj, gi] = (pred_cls[b, best_n, gj, gi].argmax(-1) == target_labels).float()
+    iou[b, best_n, gj, gi] = layer.bbox_iou(pred_boxes[b, best_n, gj, gi], target_boxes, x1y1x2y2=False)
+
+    tconf = obj_mask.float()
+
+    return iou, class_mask, obj_mask, noobj_mask, tx, ty, tw, th, tcls, tconf, target_boxes_grid
+
+
+class TargetAssigner:
+    """
+    Collate function, which computes anchor/grid assignment of every yolo layer inside dataloader workers.
+    Targets get 4 extra columns per layer, YOLOv4 passes them to yolo layers and build_targets skips the assignment.
+    Args:
+        anchors: anchors of yolo1, yolo2, yolo3 in pixels (as in YOLOv4)
+        collate_fn: base collate function (f.e. ListDataset.collate_fn)
+    """
+    def __init__(self, anchors, collate_fn, strides=STRIDES, ignore_thres=0.5):
+        self.anchors = [torch.tensor(a, dtype=torch.float32) for a in anchors]
+        self.collate_fn = collate_fn
+        self.strides = strides
+        self.ignore_thres = ignore_thres
+
+    @classmethod
+    def from_model(cls, model, collate_fn):
+        layers = (model.yolo1, model.yolo2, model.yolo3)
+        return cls([layer.anchors for layer in layers], collate_fn, ignore_thres=layers[0].ignore_thres)
+
+    def __call__(self, batch):
+        paths, imgs, targets, *rest = self.collate_fn(batch)
+        img_h, img_w = imgs.shape[2:]
+
+        columns = [targets[:, :6]]
+        for anchors, stride in zip(self.anchors, self.strides):
+            columns.append(assign_targets(targets, anchors, stride, img_w // stride, img_h // stride, self.ignore_thres))
+
+        return (paths, imgs, torch.cat(columns, 1), *rest)
+
+
+if __name__ == "__main__":
+    import time
+    from model import YOLOv4
+
+    #MAIN PROCESS TIME OF build_targets PER STEP: BASELINE, VECTORIZED ON RAW TARGETS, WITH PRECOMPUTED ASSIGNMENT
+    bs, boxes_per_img, img_size, n_classes, steps = 16, 50, 608, 80, 20
+    model = YOLOv4(n_classes=n_classes, img_dim=img_size)
+    layers = (model.yolo1, model.yolo2, model.yolo3)
+    assigner = TargetAssigner.from_model(model, collate_fn=None)
+
+    g = torch.Generator().manual_seed(0)
+    n = bs * boxes_per_img
+    targets = torch.cat([torch.arange(bs).repeat_interleave(boxes_per_img)[:, None].float(),
+                         torch.randint(0, n_classes, (n, 1), generator=g).float(),
+                         torch.rand(n, 2, generator=g) * 0.8 + 0.1,
+                         torch.rand(n, 2, generator=g) * 0.2 + 0.01], 1)
+    imgs = torch.zeros(bs, 3, img_size, img_size)
+    assigner.collate_fn = lambda batch: (None, imgs, targets)
+
+    preds = []
+    for layer, stride in zip(layers, STRIDES):
+        grid = img_size // stride
+        layer.compute_grid_offsets(grid, cuda=False)
+        preds.append((torch.rand(bs, 3, grid, grid, 4) * grid, torch.rand(bs, 3, grid, grid, n_classes)))
+
+    def run(layer_targets, build_targets=None):
+        t0 = time.time()
+        for _ in range(steps):
+            for layer, (pred_boxes, pred_cls), y in zip(layers, preds, layer_targets):
+                if build_targets is None:
+                    layer.build_targets(pred_boxes, pred_cls, y, layer.scaled_anchors, layer.ignore_thres)
+                else:
+                    build_targets(layer, pred_boxes, pred_cls, y, layer.scaled_anchors, layer.ignore_thres)
+        return (time.time() - t0) / steps
+
+    t0 = time.time()
+    for _ in range(steps):
+        _, _, assigned = assigner(None)
+    worker_time = (time.time() - t0) / steps
+
+    baseline = run((targets, targets, targets), build_targets_reference)
+    vectorized = run((targets, targets, targets))
+    precomputed = run(model.split_targets(assigned))
+
+    #SAME RESULT
+    for layer, (pred_boxes, pred_cls), y in zip(layers, preds, model.split_targets(assigned)):
+        a = build_targets_reference(layer, pred_boxes, pred_cls, targets, layer.scaled_anchors, layer.ignore_thres)
+        b = layer.build_targets(pred_boxes, pred_cls, targets, layer.scaled_anchors, layer.ignore_thres)
+        c = layer.build_targets(pred_boxes, pred_cls, y, layer.scaled_anchors, layer.ignore_thres)
+        assert all(torch.equal(x1, x2) and torch.equal(x1, x3) for x1, x2, x3 in zip(a, b, c))
+
+    print(f"build_targets per step in main process: baseline {baseline * 1000:.2f}ms, vectorized {vectorized * 1000:.2f}ms, "
+          f"precomputed assignment {precomputed * 1000:.2f}ms (assignment in worker {worker_time * 1000:.2f}ms)")
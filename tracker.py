@@ -0,0 +1,265 @@
+import torch
+from torchvision.ops import box_iou
+
+import utils
+
+
+def greedy_match(iou, iou_threshold):
+    """
+    Pairs (row, column) of iou matrix, highest iou first, every row and column is used once. Returns two long tensors.
+    Vectorized in rounds: every pair which is the best of its row and of its column would be taken by the greedy order,
+    so all of them are taken at once, their rows and columns are masked out and the rest goes to the next round.
+    """
+    iou = torch.where(iou >= iou_threshold, iou, torch.full_like(iou, -1))
+    rows, cols = [], []
+    row_idx = torch.arange(iou.size(0), device=iou.device)
+    while iou.numel():
+        row_max, row_arg = iou.max(1)
+        best = (row_max >= iou_threshold) & (iou.argmax(0)[row_arg] == row_idx)
+        if not best.any():
+            break
+        i = best.nonzero()[:, 0]
+        j = row_arg[i]
+        rows.append(i)
+        cols.append(j)
+        iou[i, :] = -1
+        iou[:, j] = -1
+    if not rows:
+        return torch.zeros(0, dtype=torch.long), torch.zeros(0, dtype=torch.long)
+    return torch.cat(rows).cpu(), torch.cat(cols).cpu()
+
+
+class Tracker:
+    """
+    IoU association + constant velocity Kalman filter of all tracks at once (batched matrices).
+    State of a track is cx, cy, w, h and their velocities per frame, noise is relative to the height of box (as in DeepSORT).
+    Call predict() every frame and update(detections) on frames with detections.
+    Args:
+        iou_threshold (float): minimal IoU of detection and predicted track to match them
+        max_misses (int): detector runs in a row, which may miss a track before it is removed
+        score_decay (float): confidence of a track is its last detection score * score_decay ** frames since it
+    """
+    def __init__(self, iou_threshold=0.3, max_misses=1, score_decay=0.9, std_position=1 / 20, std_velocity=1 / 160):
+        self.iou_threshold = iou_threshold
+        self.max_misses = max_misses
+        self.score_decay = score_decay
+        self.std_position = std_position
+        self.std_velocity = std_velocity
+
+        self.F = torch.eye(8, dtype=torch.float64)
+        self.F[:4, 4:] = torch.eye(4)
+
+        self.mean = torch.zeros(0, 8, dtype=torch.float64)
+        self.cov = torch.zeros(0, 8, 8, dtype=torch.float64)
+        self.ids = torch.zeros(0, dtype=torch.long)
+        self.scores = torch.zeros(0)
+        self.classes = torch.zeros(0, dtype=torch.long)
+        self.age = torch.zeros(0, dtype=torch.long)
+        self.misses = torch.zeros(0, dtype=torch.long)
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def noise(self, std, h):
+        # Diagonal covariance [T, n, n] with std of every component multiplied by height of box
+        return torch.diag_embed((std[None] * h[:, None]) ** 2)
+
+    def predict(self):
+        if len(self) == 0:
+            return
+        h = self.mean[:, 3]
+        std = torch.tensor([self.std_position] * 4 + [self.std_velocity] * 4, dtype=torch.float64)
+        self.mean = self.mean @ self.F.T
+        self.cov = self.F @ self.cov @ self.F.T + self.noise(std, h)
+        self.mean[:, 2:4].clamp_(min=1)
+        self.age += 1
+
+    def update(self, detections):
+        """
+        detections: [N, 4 + 1 (+ class probabilities)] x1, y1, x2, y2 in pixels, confidence
+        """
+        detections = detections.double().cpu()
+        z = utils.xyxy2xywh(detections[:, :4])
+        classes = detections[:, 5:].argmax(1) if detections.size(1) > 5 else torch.zeros(len(detections), dtype=torch.long)
+
+        det_idx, track_idx = greedy_match(box_iou(detections[:, :4], self.boxes()), self.iou_threshold)
+
+        #KALMAN UPDATE OF MATCHED TRACKS
+        if len(track_idx):
+            mean, cov = self.mean[track_idx], self.cov[track_idx]
+            std = torch.full((4,), self.std_position, dtype=torch.float64)
+            S = cov[:, :4, :4] + self.noise(std, mean[:, 3])
+            K = torch.linalg.solve(S, cov[:, :4, :]).transpose(1, 2)
+            self.mean[track_idx] = mean + (K @ (z[det_idx] - mean[:, :4])[:, :, None])[:, :, 0]
+            self.cov[track_idx] = cov - K @ cov[:, :4, :]
+            self.scores[track_idx] = detections[det_idx, 4].float()
+            self.classes[track_idx] = classes[det_idx]
+            self.age[track_idx] = 0
+
+        matched = torch.zeros(len(self), dtype=torch.bool)
+        matched[track_idx] = True
+        self.misses = torch.where(matched, torch.zeros_like(self.misses), self.misses + 1)
+
+        #NEW TRACKS FOR UNMATCHED DETECTIONS
+        new = torch.ones(len(detections), dtype=torch.bool)
+        new[det_idx] = False
+        n_new = int(new.sum())
+        if n_new:
+            mean = torch.cat([z[new], torch.zeros(n_new, 4, dtype=torch.float64)], 1)
+            std = torch.tensor([2 * self.std_position] * 4 + [10 * self.std_velocity] * 4, dtype=torch.float64)
+            self.mean = torch.cat([self.mean, mean])
+            self.cov = torch.cat([self.cov, self.noise(std, mean[:, 3])])
+            self.ids = torch.cat([self.ids, torch.arange(self.next_id, self.next_id + n_new)])
+            self.scores = torch.cat([self.scores, detections[new, 4].float()])
+            self.classes = torch.cat([self.classes, classes[new]])
+            self.age = torch.cat([self.age, torch.zeros(n_new, dtype=torch.long)])
+            self.misses = torch.cat([self.misses, torch.zeros(n_new, dtype=torch.long)])
+            self.next_id += n_new
+
+        keep = self.misses <= self.max_misses
+        for name in ("mean", "cov", "ids", "scores", "classes", "age", "misses"):
+            setattr(self, name, getattr(self, name)[keep])
+
+    def boxes(self):
+        return utils.xywh2xyxy(self.mean[:, :4])
+
+    def confidence(self):
+        """
+        Mean decayed score of visible tracks, 1 without them (nothing to lose)
+        """
+        visible = self.misses == 0
+        if not visible.any():
+            return 1.0
+        return (self.scores[visible] * self.score_decay ** self.age[visible].float()).mean().item()
+
+    def tracks(self):
+        """
+        Tracks, which the last detector run saw: [T, 4] x1, y1, x2, y2, decayed scores [T], classes [T], ids [T]
+        """
+        visible = self.misses == 0
+        return (self.boxes()[visible].float(), (self.scores * self.score_decay ** self.age.float())[visible],
+                self.classes[visible], self.ids[visible])
+
+
+class TrackedDetector:
+    """
+    Runs detector every `every` frames, or earlier when confidence of the tracker drops below min_confidence,
+    boxes of other frames are predicted by Tracker.
+    Args:
+        detect: function(frame) -> [N, 4 + 1 + n_classes] x1, y1, x2, y2 in pixels of frame, confidence, class probabilities
+            (f.e. video_pipeline.frame_detections or letterbox.LetterboxBuffer.unletterbox of get_bboxes_from_anchors output)
+        every (int): frames per detector run, 1 runs it on every frame
+        min_confidence (float): Tracker.confidence() below it runs detector
+        **kwargs: Tracker arguments
+    Calling it with frame returns Tracker.tracks() (boxes, scores, classes, stable ids)
+    """
+    def __init__(self, detect, every=5, min_confidence=0.3, **kwargs):
+        self.detect = detect
+        self.every = every
+        self.min_confidence = min_confidence
+        self.tracker = Tracker(**kwargs)
+        self.since_detect = None
+        self.frames_n = 0
+        self.detections_n = 0
+
+    def __call__(self, frame):
+        self.tracker.predict()
+        if self.since_detect is None or self.since_detect + 1 >= self.every or self.tracker.confidence() < self.min_confidence:
+            self.tracker.update(self.detect(frame))
+            self.since_detect = 0
+            self.detections_n += 1
+        else:
+            self.since_detect += 1
+        self.frames_n += 1
+        return self.tracker.tracks()
+
+
+def agreement(boxes_a, boxes_b, iou_threshold=0.5):
+    """
+    F1 of boxes matched with IoU >= iou_threshold (1 when both are empty) and mean IoU of matched pairs
+    """
+    if len(boxes_a) == 0 and len(boxes_b) == 0:
+        return 1.0, 1.0
+    rows, cols = greedy_match(box_iou(boxes_a.float(), boxes_b.float()), iou_threshold)
+    iou = box_iou(boxes_a[rows].float(), boxes_b[cols].float()).diagonal().mean().item() if len(rows) else 0.0
+    return 2 * len(rows) / (len(boxes_a) + len(boxes_b)), iou
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    import cv2
+    import numpy as np
+    from letterbox import LetterboxBuffer
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="FPS and agreement of detection every N frames + tracker with detection on every frame")
+    parser.add_argument("--video", default=None, help="recorded clip, without it a synthetic one is written")
+    parser.add_argument("--frames", type=int, default=60, help="frames of synthetic clip")
+    parser.add_argument("--every", type=int, nargs="+", default=[2, 5, 10])
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--img_size", type=int, default=416)
+    parser.add_argument("--confidence_threshold", type=float, default=0.4)
+    parser.add_argument("--iou_threshold", type=float, default=0.5)
+    args = parser.parse_args()
+
+    #IDS STAY THE SAME ON MOVING BOXES, DETECTED EVERY 5TH FRAME
+    def synthetic_boxes(t):
+        return torch.tensor([[10 + 4 * t, 20 + 1 * t, 60 + 4 * t, 120 + 1 * t, 0.9],
+                             [400 - 3 * t, 300, 480 - 3 * t, 340, 0.8]], dtype=torch.float32)
+    tracked = TrackedDetector(synthetic_boxes, every=5)
+    for t in range(40):
+        boxes, scores, classes, ids = tracked(t)
+        f1, iou = agreement(boxes, synthetic_boxes(t)[:, :4])
+        # Velocity is known after a few detector runs
+        assert t < 10 or (f1 == 1.0 and iou > 0.95), f"Frame {t}: F1 {f1}, IoU {iou}"
+    assert ids.tolist() == [0, 1] and tracked.detections_n == 8, "Tracks lost their ids"
+
+    video = args.video
+    if video is None:
+        import os
+        import tempfile
+        video = os.path.join(tempfile.mkdtemp(), "synthetic.avi")
+        writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*"MJPG"), 30, (640, 480))
+        for t in range(args.frames):
+            frame = np.full((480, 640, 3), 90, dtype=np.uint8)
+            cv2.rectangle(frame, (10 + 5 * t, 100), (110 + 5 * t, 300), (0, 0, 255), -1)
+            cv2.circle(frame, (600 - 4 * t, 350), 40, (0, 255, 0), -1)
+            writer.write(frame)
+        writer.release()
+
+    cap = cv2.VideoCapture(video)
+    frames = []
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    m = YOLOv4(weights_path=args.weights).eval().to(device)
+    buffer = LetterboxBuffer(1, args.img_size, pin_memory=True)
+
+    @torch.no_grad()
+    def detect(frame):
+        buffer.put(0, frame)
+        anchors, _ = m(buffer.batch().to(device, non_blocking=True))
+        bboxes, _ = utils.get_bboxes_from_anchors(anchors, args.confidence_threshold, args.iou_threshold, {}.fromkeys(range(anchors.size(2) - 5), ""))
+        return buffer.unletterbox(0, bboxes[0])
+
+    detect(frames[0])
+    t0 = time.time()
+    per_frame = [detect(frame)[:, :4] for frame in frames]
+    base_fps = len(frames) / (time.time() - t0)
+    print(f"{len(frames)} frames, detection on every frame: {base_fps:.1f} fps")
+
+    for every in args.every:
+        tracked = TrackedDetector(detect, every=every)
+        t0 = time.time()
+        outputs = [tracked(frame)[0] for frame in frames]
+        fps = len(frames) / (time.time() - t0)
+        f1, iou = np.mean([agreement(a, b) for a, b in zip(outputs, per_frame)], 0)
+        print(f"every {every}: {fps:.1f} fps ({fps / base_fps:.2f}x), detector ran on {tracked.detections_n} frames, "
+              f"agreement with every frame detection F1 {f1:.3f}, matched IoU {iou:.3f}")
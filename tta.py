@@ -0,0 +1,180 @@
+import torch
+import torch.nn.functional as F
+from torchvision.ops import box_iou, batched_nms
+
+import utils
+
+
+def fuse_boxes(boxes, scores, classes, views, iou_threshold, n_views, max_det=300):
+    """
+    Weighted box fusion of NMS outputs of all views of one image, vectorized: boxes kept by class aware NMS are cluster centers,
+    every box joins the best center of its class it overlaps with IoU > iou_threshold. Fused box is the score weighted mean
+    of its cluster, its score is the mean score * min(views which found it, n_views) / n_views, so boxes found by fewer views rank lower.
+    Only the max_det best centers are used, boxes of no cluster are dropped.
+    views: long [N] view index of every box
+    Returns [K, 6] x1, y1, x2, y2, score, class
+    """
+    if len(boxes) == 0:
+        return boxes.new_zeros(0, 6)
+    keep = batched_nms(boxes, scores, classes, iou_threshold)[:max_det]
+    iou = box_iou(boxes[keep], boxes)
+    iou[classes[keep][:, None] != classes[None, :]] = -1
+    # Centers are sorted by score, argmax takes the first (best) center over threshold
+    member = iou > iou_threshold
+    cluster = torch.where(member.any(0), member.float().argmax(0), torch.full_like(classes, -1))
+
+    valid = cluster >= 0
+    cluster, boxes, scores, views = cluster[valid], boxes[valid], scores[valid], views[valid]
+    K = len(keep)
+    weights = scores.new_zeros(K).index_add_(0, cluster, scores)
+    counts = scores.new_zeros(K).index_add_(0, cluster, torch.ones_like(scores))
+    fused = boxes.new_zeros(K, 4).index_add_(0, cluster, boxes * scores[:, None])
+    fused /= weights[:, None]
+    # Distinct (cluster, view) pairs
+    found = torch.bincount(torch.unique(cluster * n_views + views) // n_views, minlength=K).to(scores.dtype)
+    fused_scores = weights / counts * found.clamp(max=n_views) / n_views
+    return torch.cat([fused, fused_scores[:, None], classes[keep][:, None].to(boxes.dtype)], 1)
+
+
+class TTA:
+    """
+    Test time augmentation with one forward per resolution: all flips of a scale are stacked into one batch.
+    Boxes of every view are mapped back to the input batch (vectorized over the whole output) and fused with
+    weighted box fusion of per view NMS outputs (fuse_boxes) or class aware NMS of all anchors.
+    Args:
+        model: YOLOv4
+        scales (list): input scales, resized sizes are rounded to multiples of 32
+        flip (bool): also horizontally flipped views
+        fusion (str): "wbf" or "nms"
+        confidence_threshold, iou_threshold (float): score threshold of boxes of every view and IoU of fusion
+        max_det (int): detections per image
+    Calling it with batch [B, 3, H, W] (float or uint8) returns list of [N, 6] x1, y1, x2, y2 (pixels of the batch), score, class,
+    as utils.non_max_suppression does.
+    """
+    def __init__(self, model, scales=(1.0,), flip=True, fusion="wbf", confidence_threshold=0.001, iou_threshold=0.55, max_det=300):
+        if fusion not in ("wbf", "nms"):
+            raise ValueError(f"Unknown fusion {fusion}, use wbf or nms")
+        self.model = model
+        self.scales = scales
+        self.flip = flip
+        self.fusion = fusion
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.max_det = max_det
+
+    @property
+    def n_views(self):
+        return len(self.scales) * (2 if self.flip else 1)
+
+    @torch.no_grad()
+    def views(self, x):
+        """
+        Anchors of every view mapped back to x: list (one per view) of [B, anchors, 5 + n_classes] (x, y, w, h in pixels of x)
+        """
+        x = self.model.prepare_input(x)
+        B, _, H, W = x.shape
+        outputs = []
+        for scale in self.scales:
+            h, w = max(32, round(H * scale / 32) * 32), max(32, round(W * scale / 32) * 32)
+            scaled = x if (h, w) == (H, W) else F.interpolate(x, size=(h, w), mode="bilinear", align_corners=False)
+            if self.flip:
+                scaled = torch.cat([scaled, scaled.flip(3)])
+            anchors, _ = self.model(scaled)
+
+            if self.flip:
+                anchors[B:, :, 0] = w - anchors[B:, :, 0]
+            anchors[..., 0:4:2] *= W / w
+            anchors[..., 1:4:2] *= H / h
+            outputs.extend(anchors.split(B))
+        return outputs
+
+    def __call__(self, x):
+        views = self.views(x)
+        if self.fusion == "nms":
+            return utils.non_max_suppression(torch.cat(views, 1), self.confidence_threshold, self.iou_threshold, self.max_det)
+
+        # Per view NMS first, so a cluster gets one box of every view which found the object instead of all its anchors
+        per_view = [utils.non_max_suppression(anchors, self.confidence_threshold, self.iou_threshold, self.max_det) for anchors in views]
+        batch_detections = []
+        for image_detections in zip(*per_view):
+            detections = torch.cat(image_detections)
+            view_idx = torch.repeat_interleave(torch.arange(len(image_detections), device=detections.device),
+                                               torch.tensor([len(d) for d in image_detections], device=detections.device))
+            fused = fuse_boxes(detections[:, :4], detections[:, 4], detections[:, 5].long(), view_idx, self.iou_threshold, self.n_views, self.max_det)
+            batch_detections.append(fused[fused[:, 4].argsort(descending=True)])
+        return batch_detections
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    from dataset import ListDataset
+    from evaluation import MAPEvaluator
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="mAP and time of TTA configurations on a validation list")
+    parser.add_argument("list_path", nargs="?", default=None, help="validation txt, synthetic images (timing only) without it")
+    parser.add_argument("--weights", default=None)
+    parser.add_argument("--n_classes", type=int, default=80)
+    parser.add_argument("--img_size", type=int, default=416)
+    parser.add_argument("--bs", type=int, default=4)
+    parser.add_argument("--n", type=int, default=None, help="first n images")
+    parser.add_argument("--conf", type=float, default=0.001)
+    parser.add_argument("--iou", type=float, default=0.55)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    m = YOLOv4(n_classes=args.n_classes, weights_path=args.weights, img_dim=args.img_size).eval().to(device)
+
+    list_path = args.list_path
+    if list_path is None:
+        from benchmark import make_synthetic_dataset
+        list_path = make_synthetic_dataset("synthetic_dataset", args.n or 8, 640, 480)
+    ds = ListDataset(list_path, img_size=args.img_size, train=False)
+    if args.n is not None:
+        ds.img_files = ds.img_files[:args.n]
+    batches = [ds.collate_fn([ds[i] for i in range(start, min(start + args.bs, len(ds)))]) for start in range(0, len(ds), args.bs)]
+
+    #FLIPPED VIEW OF A FLIPPED BATCH IS THE MIRRORED PLAIN VIEW
+    x = batches[0][1].to(device)
+    a = TTA(m, flip=True).views(x)
+    b = TTA(m, flip=True).views(x.flip(3))
+    mirrored = a[0][..., :4].clone()
+    mirrored[..., 0] = x.size(3) - mirrored[..., 0]
+    assert torch.allclose(mirrored, b[1][..., :4], atol=1e-2), "Flipped boxes are not mapped back"
+
+    #MANY WEAK BOXES OF ONE VIEW DO NOT OUTRANK A STRONG BOX FOUND BY TWO VIEWS
+    weak = torch.tensor([[100, 100, 150, 150.0]]).repeat(40, 1) + torch.rand(40, 1) * 2
+    strong = torch.tensor([[10, 10, 60, 60.0], [11, 10, 61, 60]])
+    fused = fuse_boxes(torch.cat([weak, strong]), torch.cat([torch.full((40,), 0.3), torch.tensor([0.9, 0.9])]), torch.zeros(42, dtype=torch.long),
+                       torch.cat([torch.zeros(40, dtype=torch.long), torch.tensor([0, 1])]), 0.55, n_views=2)
+    assert len(fused) == 2 and abs(fused[0, 4] - 0.9) < 1e-6 and abs(fused[1, 4] - 0.15) < 1e-6, fused
+
+    configs = [("none", dict(scales=(1.0,), flip=False, fusion="nms")),
+               ("flip, nms", dict(scales=(1.0,), flip=True, fusion="nms")),
+               ("flip, wbf", dict(scales=(1.0,), flip=True, fusion="wbf")),
+               ("flip + 2 scales, wbf", dict(scales=(0.83, 1.0, 1.17), flip=True, fusion="wbf")),
+               ("flip + 2 scales, nms", dict(scales=(0.83, 1.0, 1.17), flip=True, fusion="nms"))]
+
+    base = None
+    print(f"{len(ds)} images, {args.img_size}x{args.img_size}, batch {args.bs}")
+    print(f"{'config':<24}{'views':>6}{'mAP':>8}{'mAP50':>8}{'ms/img':>9}{'x time':>8}")
+    for name, kwargs in configs:
+        tta = TTA(m, confidence_threshold=args.conf, iou_threshold=args.iou, **kwargs)
+        evaluator = MAPEvaluator(args.n_classes)
+        tta(batches[0][1].to(device))
+        elapsed = 0.0
+        for _, imgs, targets in batches:
+            imgs = imgs.to(device)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            t0 = time.time()
+            detections = tta(imgs)
+            if device == "cuda":
+                torch.cuda.synchronize()
+            elapsed += time.time() - t0
+            evaluator.update(detections, targets, imgs.shape[2:])
+        result = evaluator.compute()
+        ms = elapsed / len(ds) * 1000
+        base = base or ms
+        print(f"{name:<24}{tta.n_views:>6}{result['mAP']:>8.4f}{result['mAP50']:>8.4f}{ms:>9.1f}{ms / base:>8.2f}")
@@ -3,7 +3,7 @@ from torch import nn
 import numpy as np
 import cv2
 from PIL import Image
-from torchvision.ops import nms
+from torchvision.ops import nms, batched_nms
 
 def xyxy2xywh(x):
     # Convert bounding box format from [x1, y1, x2, y2] to [x, y, w, h]
@@ -139,5 +139,40 @@ def get_bboxes_from_anchors(anchors, confidence_threshold, iou_threshold, labels
         labels.append([labels_dict[x.item()] for x in img_bboxes[:, 5:].argmax(1)])
 
     return batch_bboxes, labels
-     
 
+
+def non_max_suppression(anchors, confidence_threshold, iou_threshold, max_det=300):
+    """
+    Class aware NMS for evaluation. Score of the box is confidence * class probability.
+    Returns list (one per image) of [N, 6] tensors: x1, y1, x2, y2 (pixels), score, class
+    """
+    batch_detections = []
+    for img_anchor in anchors:
+        cls_conf, cls_idx = img_anchor[:, 5:].max(1)
+        scores = img_anchor[:, 4] * cls_conf
+        confidence_filter = scores > confidence_threshold
+
+        boxes = xywh2xyxy(img_anchor[confidence_filter, :4])
+        scores = scores[confidence_filter]
+        cls_idx = cls_idx[confidence_filter]
+
+        keep = batched_nms(boxes, scores, cls_idx, iou_threshold)[:max_det]
+        batch_detections.append(torch.cat([boxes[keep], scores[keep, None], cls_idx[keep, None].float()], 1))
+
+    return batch_detections
+
+
+def unletterbox(boxes, padding, img_size=None):
+    """
+    Maps boxes (x1, y1, x2, y2 in pixels of letterboxed image, other columns are kept) back to the image before letterbox.
+    padding: (pad x, pad y, width, height) of the image inside letterbox canvas, as ListDataset returns for aspect ratio buckets
+    img_size: (width, height) of original image, without it boxes are returned relative (0-1)
+    """
+    pad_x, pad_y, width, height = padding.tolist()
+    out = boxes.clone()
+    out[:, 0:4:2] = ((boxes[:, 0:4:2] - pad_x) / width).clamp(0, 1)
+    out[:, 1:4:2] = ((boxes[:, 1:4:2] - pad_y) / height).clamp(0, 1)
+    if img_size is not None:
+        out[:, 0:4:2] *= img_size[0]
+        out[:, 1:4:2] *= img_size[1]
+    return out
@@ -2,8 +2,9 @@ from model import YOLOv4
 import cv2
 from torch.backends import cudnn
 import torch
-import utils
-import time
+import argparse
+from video_pipeline import VideoPipeline, draw_detections
+from motion import MotionGate
 
 coco_dict = {0: 'person',
             1: 'bicycle',
@@ -87,60 +88,51 @@ coco_dict = {0: 'person',
             79: 'toothbrush'}
 
 
-cudnn.fastest = True
-cudnn.benchmark = True
-threshold = 0.2
-iou_threshold = 0.2
 
-m = YOLOv4(weights_path="weights/yolov4.pth")
-m.requires_grad_(False)
-m.eval()
-
-m = m.cuda()
-
-#To warm up JIT
-m(torch.zeros((1, 3, 608, 608)).cuda())
-
-cap = cv2.VideoCapture(0)
-
-frames_n = 0
-start_time = time.time()
-
-while True:
-    ret, frame = cap.read()
-    if not ret:
-        break
-    
-
-    sized = cv2.resize(frame, (m.img_dim, m.img_dim))
-    sized = cv2.cvtColor(sized, cv2.COLOR_BGR2RGB)
-    
-
-    x = torch.from_numpy(sized)
-    x = x.permute(2, 0, 1)
-    x = x.float()
-    x /= 255    
-
-    anchors, _ = m(x[None].cuda())
-
-    confidence_threshold = 0.5
-    iou_threshold = 0.5
-
-    bboxes, labels = utils.get_bboxes_from_anchors(anchors, 0.4, 0.5, coco_dict)
-    arr = utils.get_img_with_bboxes(x.cpu(), bboxes[0].cpu(), resize=False, labels=labels[0])
-    arr = cv2.cvtColor(arr, cv2.COLOR_RGB2BGR)
-    
-    frames_n += 1
-
-    arr = cv2.putText(arr, "FPS: " + str(frames_n / (time.time() - start_time)), (100, 100), cv2.FONT_HERSHEY_DUPLEX, 0.75, (255, 255, 255))
-
-    cv2.imshow("test", arr)
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
-
-    
-
-    
-    
-
-    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Realtime detection on camera or video file")
+    parser.add_argument("source", nargs="?", default="0", help="camera index, stream url or video file")
+    parser.add_argument("--weights", default="weights/yolov4.pth")
+    parser.add_argument("--img_size", type=int, default=608)
+    parser.add_argument("--confidence_threshold", type=float, default=0.4)
+    parser.add_argument("--iou_threshold", type=float, default=0.5)
+    parser.add_argument("--headless", action="store_true", help="do not show frames, only print timings of stages")
+    parser.add_argument("--output", default=None, help="write frames with detections to this video file")
+    parser.add_argument("--motion_gate", action="store_true", help="skip inference on static frames, reuse previous detections")
+    parser.add_argument("--pixel_threshold", type=int, default=25, help="motion gate: difference of a downsampled pixel (0-255), which counts as change")
+    parser.add_argument("--area_threshold", type=float, default=0.001, help="motion gate: share of changed pixels, which runs inference")
+    args = parser.parse_args()
+
+    cudnn.fastest = True
+    cudnn.benchmark = True
+
+    m = YOLOv4(weights_path=args.weights)
+    m.requires_grad_(False)
+    m.eval()
+    if torch.cuda.is_available():
+        m = m.cuda()
+
+    writer = None
+
+    def sink(frame_n, frame, bboxes, labels):
+        global writer
+        if args.headless and args.output is None:
+            return
+        arr = draw_detections(frame, bboxes, labels)
+        if args.output is not None:
+            if writer is None:
+                writer = cv2.VideoWriter(args.output, cv2.VideoWriter_fourcc(*"mp4v"), 30, (arr.shape[1], arr.shape[0]))
+            writer.write(arr)
+        if not args.headless:
+            cv2.imshow("test", arr)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                return False
+
+    gate = MotionGate(pixel_threshold=args.pixel_threshold, area_threshold=args.area_threshold) if args.motion_gate else None
+    pipeline = VideoPipeline(m, args.source, sink=sink, labels_dict=coco_dict, img_size=args.img_size,
+                             confidence_threshold=args.confidence_threshold, iou_threshold=args.iou_threshold, gate=gate)
+    pipeline.run()
+    if writer is not None:
+        writer.release()
+
+    print(pipeline.report())
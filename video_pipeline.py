@@ -0,0 +1,319 @@
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+
+import utils
+from letterbox import LetterboxBuffer, unletterbox_bboxes
+from profiling import StageProfiler, timed
+
+# Per frame stages of VideoPipeline, latency is the whole way of a frame from capture to sink
+STAGES = ("capture", "preprocess", "infer", "postprocess", "sink", "latency")
+
+
+class LatestQueue(queue.Queue):
+    """
+    Bounded queue, which drops its oldest item instead of blocking the producer when it is full (latest frame wins).
+    dropped counts items which were thrown away.
+    """
+    def __init__(self, maxsize=1):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put(self, item, block=True, timeout=None):
+        while True:
+            try:
+                return super().put(item, block=False)
+            except queue.Full:
+                try:
+                    super().get(block=False)
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+def is_live(source):
+    # Camera index or stream url, files are read losslessly
+    return isinstance(source, int) or str(source).isdigit() or "://" in str(source)
+
+
+class _Identity(dict):
+    # Labels are class indexes when there is no labels_dict
+    def __missing__(self, key):
+        return key
+
+
+def frame_detections(anchors, padding, sizes, confidence_threshold=0.4, iou_threshold=0.5, labels_dict=None):
+    """
+    utils.get_bboxes_from_anchors for a batch letterboxed by letterbox.LetterboxBuffer, boxes go back to pixels of their frames.
+    padding [B, 4] and sizes [B, 2] are LetterboxBuffer.padding and sizes of the batch.
+    Returns list of (bboxes [N, 4 + 1 + n_classes] with x1, y1, x2, y2, labels) for every frame
+    """
+    batch_bboxes, batch_labels = utils.get_bboxes_from_anchors(anchors, confidence_threshold, iou_threshold, labels_dict or _Identity())
+    return [(unletterbox_bboxes(bboxes, pad, size), labels) for bboxes, labels, pad, size in zip(batch_bboxes, batch_labels, padding, sizes)]
+
+
+def draw_detections(frame, bboxes, labels=None):
+    """
+    Draws bboxes (x1, y1, x2, y2, confidence, ... in pixels of frame) on BGR frame in place
+    """
+    for i, bbox in enumerate(bboxes.tolist()):
+        x1, y1, x2, y2 = (int(round(v)) for v in bbox[:4])
+        cv2.rectangle(frame, (x1, y1), (x2, y2), (255, 0, 0), 3)
+        if labels:
+            cv2.putText(frame, f"{labels[i]} {bbox[4]:.2f}", (x1, y1), cv2.FONT_HERSHEY_DUPLEX, 0.75, (255, 255, 255))
+    return frame
+
+
+class VideoPipeline:
+    """
+    Video inference in 5 threads connected by bounded queues, so the model does not wait for capture, NMS and drawing:
+    capture -> preprocess -> infer -> postprocess -> sink.
+    Live sources (camera index, rtsp/http url) drop the oldest waiting frame before preprocess and infer (latest frame wins),
+    files are processed losslessly, every frame in order.
+    Args:
+        model: YOLOv4 in eval mode, on its device
+        source: camera index, url or path of video file (cv2.VideoCapture)
+        sink: function(frame_n, frame, bboxes, labels) called for every processed frame in order of capture,
+            frame is BGR, bboxes are [N, 4 + 1 + n_classes] (x1, y1, x2, y2 in pixels of frame, confidence, class probabilities).
+            Returning False stops the pipeline.
+        labels_dict (dict): class index -> name, without it labels are class indexes
+        img_size (int): input size of the model, model.img_dim by default
+        confidence_threshold, iou_threshold (float): of utils.get_bboxes_from_anchors
+        live (bool): drop policy, by default is_live(source)
+        queue_size (int): items between stages, live sources use 1
+        gate (motion.MotionGate): frames it finds static skip inference and get detections of the previous frame.
+            Its reference moves only in postprocess, so a frame dropped by a live queue after opening the gate does not count.
+    Frames are letterboxed into a ring of slots of a preallocated letterbox.LetterboxBuffer, one per frame which can be between preprocess and infer.
+    Timings of every stage and capture to sink latency are in self.profiler (profiling.StageProfiler), see report().
+    """
+    def __init__(self, model, source, sink=None, labels_dict=None, img_size=None, confidence_threshold=0.4, iou_threshold=0.5, live=None, queue_size=4, gate=None):
+        self.model = model
+        self.device = next(model.parameters()).device
+        self.source = int(source) if str(source).isdigit() else source
+        self.sink = sink
+        self.labels_dict = labels_dict
+        self.img_size = img_size or model.img_dim
+        self.confidence_threshold = confidence_threshold
+        self.iou_threshold = iou_threshold
+        self.live = is_live(self.source) if live is None else live
+
+        if self.live:
+            self.queues = [LatestQueue(1), LatestQueue(1), queue.Queue(1), queue.Queue(1)]
+        else:
+            self.queues = [queue.Queue(queue_size) for _ in range(4)]
+
+        # Slot is free again when its frame went through infer: waiting in the queue, in infer and the one being written
+        self.buffer = LetterboxBuffer(self.queues[1].maxsize + 2, self.img_size, dtype=torch.uint8, pin_memory=self.device.type == "cuda")
+        self.slot = 0
+
+        self.profiler = StageProfiler(STAGES, max_workers=0)
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.frames_n = 0
+        self.elapsed = 0.0
+
+        self.gate = gate
+        self.previous = None
+
+    def capture(self, q_out):
+        cap = cv2.VideoCapture(self.source)
+        if not cap.isOpened():
+            raise IOError(f"Can not open video source {self.source}")
+        try:
+            n = 0
+            while not self.stop_event.is_set():
+                t0 = time.perf_counter()
+                ret, frame = cap.read()
+                if not ret:
+                    break
+                self.profiler.add("capture", time.perf_counter() - t0)
+                q_out.put({"n" : n, "t" : t0, "frame" : frame})
+                n += 1
+        finally:
+            cap.release()
+
+    def preprocess(self, item):
+        # Postprocess runs in order of frames, so the skipped frame gets detections of the frame before it
+        if self.gate is not None:
+            changed, _, item["reference"] = self.gate.check(item["frame"])
+            if not changed:
+                item["skip"] = True
+                return item
+        slot = self.slot
+        self.slot = (slot + 1) % len(self.buffer.padding)
+        item["padding"] = self.buffer.put(slot, item["frame"]).clone()
+        item["size"] = self.buffer.sizes[slot].clone()
+        item["x"] = self.buffer.batch()[slot:slot + 1]
+        return item
+
+    @torch.no_grad()
+    def infer(self, item):
+        if item.get("skip"):
+            return item
+        anchors, _ = self.model(item.pop("x").to(self.device, non_blocking=True))
+        if self.device.type == "cuda":
+            torch.cuda.current_stream().synchronize()
+        item["anchors"] = anchors
+        return item
+
+    def postprocess(self, item):
+        reference = item.pop("reference", None)
+        if item.get("skip"):
+            # Gate opens until the first detections are committed, so there always is something to reuse
+            item["bboxes"], item["labels"] = self.previous
+            return item
+        [(item["bboxes"], item["labels"])] = frame_detections(item.pop("anchors"), item["padding"][None], item["size"][None],
+                                                              self.confidence_threshold, self.iou_threshold, self.labels_dict)
+        self.previous = item["bboxes"], item["labels"]
+        if reference is not None:
+            self.gate.commit(reference)
+        return item
+
+    def write(self, item):
+        if self.sink is not None and self.sink(item["n"], item["frame"], item["bboxes"], item["labels"]) is False:
+            self.stop_event.set()
+        self.frames_n += 1
+        self.profiler.add("latency", time.perf_counter() - item["t"])
+
+    def worker(self, stage, fn, q_in, q_out):
+        # Every stage passes None (end of stream) further and keeps draining its input after an error, so no thread blocks forever
+        failed = False
+        while True:
+            item = q_in.get()
+            if item is None:
+                break
+            if failed:
+                continue
+            try:
+                with timed(self.profiler, stage):
+                    item = fn(item)
+                if q_out is not None:
+                    q_out.put(item)
+            except Exception as e:
+                self.errors.append(e)
+                self.stop_event.set()
+                failed = True
+        if q_out is not None:
+            q_out.put(None)
+
+    def run_capture(self, q_out):
+        try:
+            self.capture(q_out)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            q_out.put(None)
+
+    @torch.no_grad()
+    def warmup(self):
+        self.model(torch.zeros((1, 3, self.img_size, self.img_size), dtype=torch.uint8, device=self.device))
+
+    def run(self):
+        """
+        Processes the source until its end, sink returning False or stop(). Returns stats().
+        """
+        self.warmup()
+        self.profiler.reset()
+        self.stop_event.clear()
+        self.errors = []
+        self.frames_n = 0
+
+        q = self.queues
+        threads = [threading.Thread(target=self.run_capture, args=(q[0],), daemon=True)]
+        for stage, fn, q_in, q_out in [("preprocess", self.preprocess, q[0], q[1]),
+                                       ("infer", self.infer, q[1], q[2]),
+                                       ("postprocess", self.postprocess, q[2], q[3])]:
+            threads.append(threading.Thread(target=self.worker, args=(stage, fn, q_in, q_out), daemon=True))
+
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        # Sink runs in the calling thread, cv2.imshow has to be called from the main thread on some platforms
+        self.worker("sink", self.write, q[3], None)
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - t0
+
+        if self.errors:
+            raise self.errors[0]
+        return self.stats()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def stats(self):
+        """
+        Dict with processed frames, fps, frames dropped by every queue and profiler summary of stages
+        """
+        return {
+            "frames" : self.frames_n,
+            "fps" : self.frames_n / self.elapsed if self.elapsed else 0.0,
+            "dropped" : [getattr(q, "dropped", 0) for q in self.queues],
+            "stages" : self.profiler.summary(),
+            "gate" : self.gate.stats() if self.gate is not None else None,
+        }
+
+    def report(self):
+        stats = self.stats()
+        gate = f", motion gate skipped {stats['gate']['skipped']}" if self.gate is not None else ""
+        return (f"{stats['frames']} frames in {self.elapsed:.2f}s ({stats['fps']:.1f} fps), dropped {sum(stats['dropped'])}{gate}\n"
+                + self.profiler.report(inclusive=("latency",)))
+
+
+def sequential(model, source, img_size=None, confidence_threshold=0.4, iou_threshold=0.5, max_frames=None):
+    """
+    The same stages one after another in one thread, as video_demo.py used to run, for comparison. Returns fps.
+    """
+    pipeline = VideoPipeline(model, source, img_size=img_size, confidence_threshold=confidence_threshold, iou_threshold=iou_threshold, live=False)
+    pipeline.warmup()
+    cap = cv2.VideoCapture(pipeline.source)
+    n = 0
+    t0 = time.perf_counter()
+    while max_frames is None or n < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        pipeline.postprocess(pipeline.infer(pipeline.preprocess({"n" : n, "t" : 0, "frame" : frame})))
+        n += 1
+    cap.release()
+    return n / (time.perf_counter() - t0)
+
+
+if __name__ == "__main__":
+    import argparse
+    import os
+    import tempfile
+    from model import YOLOv4
+
+    parser = argparse.ArgumentParser(description="Pipelined and sequential video inference on a video file (synthetic one by default), headless")
+    parser.add_argument("--video", default=None, help="video file, without it a synthetic one is written")
+    parser.add_argument("--frames", type=int, default=60, help="frames of synthetic video")
+    parser.add_argument("--img_size", type=int, default=320)
+    parser.add_argument("--weights", default=None)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    m = YOLOv4(weights_path=args.weights).eval().to(device)
+
+    video = args.video
+    if video is None:
+        video = os.path.join(tempfile.mkdtemp(), "synthetic.avi")
+        writer = cv2.VideoWriter(video, cv2.VideoWriter_fourcc(*"MJPG"), 30, (640, 480))
+        rng = np.random.RandomState(0)
+        background = rng.randint(0, 255, (480, 640, 3), dtype=np.uint8)
+        for i in range(args.frames):
+            frame = background.copy()
+            cv2.rectangle(frame, (10 + 5 * i, 100), (110 + 5 * i, 250), (0, 0, 255), -1)
+            writer.write(frame)
+        writer.release()
+
+    seen = []
+    pipeline = VideoPipeline(m, video, sink=lambda n, frame, bboxes, labels: seen.append(n), img_size=args.img_size)
+    pipeline.run()
+    assert seen == list(range(len(seen))), "Frames of a file have to be processed losslessly and in order"
+    print("pipelined:", pipeline.report(), sep="\n")
+    print(f"sequential: {sequential(m, video, img_size=args.img_size):.1f} fps")